@@ -1,3 +1,5 @@
 from pyfityk.io import *
 from pyfityk.support import *
-from pyfityk.mapping import fitMap, fitSpectrum, match_template
\ No newline at end of file
+from pyfityk.mapping import fitMap, fitSpectrum, match_template
+from pyfityk.table import TableWriter, read_table
+from pyfityk.formula import compile_model, evaluate_models
@@ -0,0 +1,341 @@
+import re
+import numpy as np
+from pyfityk.formula import split_args
+from pyfityk.fitfile import _parse_variable
+
+# -----------------------------------------------------------------
+# Batched Levenberg-Marquardt fit of the standard Fityk functions
+# -----------------------------------------------------------------
+# Many spectra with the same model are fitted at once: the parameters are
+# a (n_spectra, n_params) array, the model and its analytic Jacobian are
+# evaluated with broadcasting and each spectrum has its own damping
+# factor and stops independently. The weights follow Fityk default_sigma.
+# Only the normal equations are kept for the whole batch, the Jacobian is
+# evaluated in blocks of spectra bounded by a memory budget.
+
+LN2 = np.log(2)
+
+def _constant(x, a):
+    return a + 0*x, [np.ones_like(a + 0*x)]
+
+def _polynomial(x, *a):
+    powers = [np.ones_like(x)]
+    for _ in a[1:]:
+        powers.append(powers[-1]*x)
+    y = sum(ai*p for ai, p in zip(a, powers))
+    return y, powers
+
+def _gaussian(x, height, center, hwhm):
+    z = (x-center)/hwhm
+    g = np.exp(-LN2*z*z)
+    dcenter = height*g*2*LN2*z/hwhm
+    return height*g, [g, dcenter, dcenter*z]
+
+def _lorentzian(x, height, center, hwhm):
+    z = (x-center)/hwhm
+    l = 1/(1+z*z)
+    dcenter = height*2*z*l*l/hwhm
+    return height*l, [l, dcenter, dcenter*z]
+
+def _pseudo_voigt(x, height, center, hwhm, shape):
+    z = (x-center)/hwhm
+    g = np.exp(-LN2*z*z)
+    l = 1/(1+z*z)
+    profile = (1-shape)*g + shape*l
+    dcenter = height*((1-shape)*g*2*LN2*z + shape*2*z*l*l)/hwhm
+    return height*profile, [profile, dcenter, dcenter*z, height*(l-g)]
+
+# function: (number of parameters, function returning value and derivatives)
+FUNCTIONS = {
+    "Constant":(1, _constant),
+    "Linear":(2, _polynomial),
+    "Quadratic":(3, _polynomial),
+    "Cubic":(4, _polynomial),
+    "Polynomial4":(5, _polynomial),
+    "Polynomial5":(6, _polynomial),
+    "Polynomial6":(7, _polynomial),
+    "Gaussian":(3, _gaussian),
+    "Lorentzian":(3, _lorentzian),
+    "PseudoVoigt":(4, _pseudo_voigt),
+}
+
+class BatchModel:
+    """
+    Fityk model made of the functions supported by the batched fit.
+
+    Attributes
+    ------
+    fnames: list of str
+        function types, in order
+    slices: list of slice
+        columns of the parameters of each function
+    p0: np.array (n_params,)
+        starting parameters
+    free: np.array of bool (n_params,)
+        fittable (~) parameters, the others are constants
+    lo, hi: np.array (n_params,)
+        domains of the parameters, -inf/inf if not given
+    """
+
+    def __init__(self, fnames, p0, free, lo, hi):
+        self.fnames = list(fnames)
+        bounds = np.cumsum([0] + [FUNCTIONS[f][0] for f in self.fnames])
+        self.slices = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        self.p0 = np.asarray(p0, dtype=float)
+        self.free = np.asarray(free, dtype=bool)
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+
+    @property
+    def n_params(self):
+        return len(self.p0)
+
+    def evaluate(self, x, params, jacobian=True):
+        """
+        Model (n_spectra, n_points) and, if **jacobian**, its derivatives
+        (n_spectra, n_points, n_params) for the parameters (n_spectra, n_params)
+        """
+        params = np.atleast_2d(params)
+        shape = (params.shape[0], np.size(x))
+        columns = params.T[:, :, None]
+        y = np.zeros(shape)
+        jac = np.empty(shape + (self.n_params,)) if jacobian else None
+        for fname, s in zip(self.fnames, self.slices):
+            value, derivatives = FUNCTIONS[fname][1](x, *columns[s])
+            y += value
+            if jacobian:
+                for j, d in zip(range(s.start, s.stop), derivatives):
+                    jac[:, :, j] = d
+        return y, jac
+
+    def format(self, params):
+        """Fitted functions as returned by pyfityk.support.format_functions"""
+        funcs = {}
+        for i, (fname, s) in enumerate(zip(self.fnames, self.slices)):
+            pars = []
+            for j in range(s.start, s.stop):
+                if not self.free[j]:
+                    pars.append(repr(float(params[j])))
+                    continue
+                text = "~" + repr(float(params[j]))
+                if np.isfinite(self.lo[j]) or np.isfinite(self.hi[j]):
+                    lo = repr(float(self.lo[j])) if np.isfinite(self.lo[j]) else ""
+                    hi = repr(float(self.hi[j])) if np.isfinite(self.hi[j]) else ""
+                    text += f" [{lo}:{hi}]"
+                pars.append(text)
+            funcs[f"%_{i+1}"] = f"{fname}({', '.join(pars)})"
+        return funcs
+
+def parse_model(model):
+    """
+    Reads a model with resolved parameters (the model of the template
+    datasets, e.g. 'Constant(~12.3) + Gaussian(~100, ~500 [400:600], 25)').
+
+    Return
+    ------
+    BatchModel or None
+        None if the model contains functions not supported by the batched
+        fit or compound parameters
+    """
+    if not isinstance(model, str):
+        return None
+    fnames, p0, free, lo, hi = [], [], [], [], []
+    for func in _split_sum(model):
+        m = re.fullmatch(r"\s*(\w+)\((.*)\)\s*", func, re.S)
+        if m is None or m.group(1) not in FUNCTIONS:
+            return None
+        pars = split_args(m.group(2))
+        if len(pars) != FUNCTIONS[m.group(1)][0]:
+            return None
+        for p in pars:
+            value, is_free, a, b = _parse_variable(p)
+            if np.isnan(value):
+                return None
+            p0.append(value)
+            free.append(is_free)
+            lo.append(-np.inf if a is None else a)
+            hi.append(np.inf if b is None else b)
+        fnames.append(m.group(1))
+    if not fnames:
+        return None
+    return BatchModel(fnames, p0, free, lo, hi)
+
+def _split_sum(model):
+    """Splits a model at the top level '+' signs"""
+    terms, depth, current = [], 0, ""
+    for c in model:
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        if c == "+" and depth == 0:
+            terms.append(current)
+            current = ""
+        else:
+            current += c
+    terms.append(current)
+    return terms
+
+def fit_settings(sets):
+    """
+    Fityk settings used by the batched fit, read from the sets of a
+    session (see pyfityk.support.get_session_initials).
+
+    Return
+    ------
+    dict:
+        default_sigma, lambda_start, lambda_up, lambda_down, max_lambda,
+        rel_change and max_evaluations
+    """
+    settings = dict(default_sigma="sqrt", lambda_start=1e-3, lambda_up=10., lambda_down=10.,
+        max_lambda=1e15, rel_change=1e-7, max_evaluations=1000)
+    names = dict(default_sigma="default_sigma", lambda_start="lm_lambda_start", lambda_up="lm_lambda_up_factor",
+        lambda_down="lm_lambda_down_factor", max_lambda="lm_max_lambda", rel_change="lm_stop_rel_change",
+        max_evaluations="max_wssr_evaluations")
+    for key, name in names.items():
+        m = re.search(rf"set {name} = ([^;]+)", sets or "")
+        if m is None:
+            continue
+        value = m.group(1).strip()
+        settings[key] = value if key == "default_sigma" else float(value)
+    return settings
+
+def weights(y, active, default_sigma="sqrt"):
+    """
+    Weights 1/sigma^2 of the points, 0 for the inactive ones. With
+    default_sigma='sqrt' sigma is max(sqrt(y), 1) as in Fityk, else 1
+    """
+    if default_sigma == "sqrt":
+        w = 1/np.maximum(y, 1.)
+    else:
+        w = np.ones_like(y, dtype=float)
+    return w*np.asarray(active, dtype=bool)
+
+def _normal_equations(model, x, y, w, params, free, block):
+    """
+    WSSR (n,), J^T W J (n, k, k) and J^T W r (n, k) of the spectra for the
+    free parameters. The model and its Jacobian are evaluated **block**
+    spectra at a time, so the dense Jacobian is never built for the whole
+    batch.
+    """
+    n, k = len(params), free.size
+    wssr = np.empty(n)
+    alpha = np.empty((n, k, k))
+    beta = np.empty((n, k))
+    for a in range(0, n, block):
+        b = min(a + block, n)
+        f, jac = model.evaluate(x, params[a:b], jacobian=k > 0)
+        r = y[a:b] - f
+        wr = w[a:b]*r
+        wssr[a:b] = np.einsum("ij,ij->i", wr, r)
+        if k:
+            J = jac[:, :, free]
+            alpha[a:b] = np.einsum("nmk,nm,nml->nkl", J, w[a:b], J, optimize=True)
+            beta[a:b] = np.einsum("nmk,nm->nk", J, wr)
+    return wssr, alpha, beta
+
+def _block_size(model, n_points, max_memory):
+    """Spectra evaluated at once so that the Jacobian and the temporary
+    arrays of a block take about **max_memory** bytes"""
+    per_spectrum = 8*n_points*(2*model.n_params + 4)
+    return max(1, int(max_memory//per_spectrum))
+
+def levenberg_marquardt(model, x, y, w, params=None, lambda_start=1e-3, lambda_up=10., lambda_down=10., max_lambda=1e15, rel_change=1e-7, max_evaluations=1000, max_memory=64*2**20, **kwargs):
+    """
+    Fits many spectra with the same model at once.
+
+    Inputs
+    ------
+    model: BatchModel
+    x: np.array (n_points,)
+    y: np.array (n_spectra, n_points)
+    w: np.array (n_spectra, n_points)
+        weights of the points (see weights)
+    params: np.array (n_spectra, n_params), default=None
+        starting parameters. If None model.p0 is used for all the spectra
+    lambda_start, lambda_up, lambda_down, max_lambda, rel_change, max_evaluations:
+        Levenberg-Marquardt settings, with the meaning of the Fityk lm_*
+        and max_wssr_evaluations settings (see fit_settings). A spectrum
+        stops when the relative WSSR change of two consecutive successful
+        steps is below rel_change, or lambda exceeds max_lambda
+    max_memory: int, default=64 MB
+        approximate memory in bytes used for the Jacobian. Only the normal
+        equations (n_spectra, n_free, n_free) are kept for the whole batch
+    Return
+    ------
+    tuple:
+        (params (n_spectra, n_params), wssr (n_spectra,))
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    n = y.shape[0]
+    params = np.tile(model.p0, (n, 1)) if params is None else np.array(params, dtype=float)
+    free = np.flatnonzero(model.free)
+    block = _block_size(model, x.size, max_memory)
+    wssr, alpha, beta = _normal_equations(model, x, y, w, params, free, block)
+    if free.size == 0:
+        return params, wssr
+    k = free.size
+    lam = np.full(n, lambda_start)
+    small = np.zeros(n, dtype=int)
+    running = np.ones(n, dtype=bool)
+    diag = np.arange(k)
+    for _ in range(int(max_evaluations)):
+        idx = np.flatnonzero(running)
+        if idx.size == 0:
+            break
+        A = alpha[idx]
+        d = A[:, diag, diag]
+        d = np.where(d > 0, d, 1.)
+        A[:, diag, diag] += lam[idx, None]*d
+        try:
+            step = np.linalg.solve(A, beta[idx][:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum("nkl,nl->nk", np.linalg.pinv(A), beta[idx])
+        trial = params[idx].copy()
+        trial[:, free] += step
+        trial = np.clip(trial, model.lo, model.hi)
+        wssr_trial, alpha_trial, beta_trial = _normal_equations(model, x, y[idx], w[idx], trial, free, block)
+        better = np.isfinite(wssr_trial) & (wssr_trial < wssr[idx])
+        # accepted steps
+        a = idx[better]
+        change = (wssr[a] - wssr_trial[better])/np.where(wssr[a] > 0, wssr[a], 1.)
+        small[a] = np.where(change < rel_change, small[a] + 1, 0)
+        params[a] = trial[better]
+        alpha[a] = alpha_trial[better]
+        beta[a] = beta_trial[better]
+        wssr[a] = wssr_trial[better]
+        lam[a] /= lambda_down
+        # rejected steps
+        lam[idx[~better]] *= lambda_up
+        running[idx] = (small[idx] < 2) & (lam[idx] <= max_lambda) & (wssr[idx] > 0)
+    return params, wssr
+
+def fit_spectra(model, x, y, active, settings=None, params=None):
+    """
+    Fits spectra with the batched Levenberg-Marquardt.
+
+    Inputs
+    ------
+    model: BatchModel
+    x: np.array (n_points,)
+    y: np.array (n_spectra, n_points)
+    active: array of bool (n_points,) or (n_spectra, n_points)
+        active points
+    settings: dict, default=None
+        see fit_settings. If None the Fityk defaults are used
+    params: np.array (n_spectra, n_params), default=None
+        starting parameters, model.p0 if None
+    Return
+    ------
+    tuple:
+        (params, wssr, ok) where ok is False for the spectra whose fit
+        did not give finite parameters
+    """
+    settings = dict(fit_settings(""), **(settings or {}))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    w = weights(y, active, settings["default_sigma"])
+    with np.errstate(all="ignore"):
+        params, wssr = levenberg_marquardt(model, x, y, w, params, **settings)
+    ok = np.isfinite(params).all(axis=1) & np.isfinite(wssr)
+    return params, wssr, ok
@@ -0,0 +1,120 @@
+import os
+import pickle
+import hashlib
+from uuid import uuid4
+
+# -----------------------------------------------------------------
+# On disk cache
+# -----------------------------------------------------------------
+
+def default_cache_dir():
+    """Returns the default cache folder. It can be set with the
+    PYFITYK_CACHE environment variable"""
+    return os.environ.get("PYFITYK_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pyfityk"))
+
+def hash_file(filename, chunk_size=1<<20):
+    """Returns the sha256 hex digest of the file content"""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while (chunk := f.read(chunk_size)):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_key(*parts):
+    """Returns the sha256 hex digest of the repr of **parts**"""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+class DiskCache:
+    """
+    Size bounded on disk cache of pickled objects. When the total size
+    exceeds **max_size** the least recently used entries are removed until
+    it is below **low_water** times max_size, so that the folder is not
+    scanned again at every put.
+
+    Inputs
+    ------
+    folder: str
+        folder where the entries are stored. It is created if missing
+    max_size: int, default=256 MB
+        maximum size in bytes of the stored entries
+    low_water: float, default=0.8
+        fraction of max_size kept after an eviction
+    """
+    suffix = ".pkl"
+
+    def __init__(self, folder, max_size=256*2**20, low_water=0.8):
+        self.folder = folder
+        self.max_size = max_size
+        self.low_water = low_water
+        os.makedirs(folder, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        # two level layout to avoid huge folders
+        return os.path.join(self.folder, key[:2], key + self.suffix)
+
+    def _entries(self):
+        """Yields (path, size, last access time) of the stored entries"""
+        for sub in os.scandir(self.folder):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(self.suffix):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def get(self, key, default=None):
+        """Returns the value stored for **key** or **default**"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except Exception:
+            # unreadable or written by incompatible library versions
+            return default
+        # the modification time is used as last access time
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Stores **value** for **key**, evicting old entries if needed"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            self.size -= os.path.getsize(path)
+        except OSError:
+            pass
+        tmp = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(tmp, path)
+        # the size is updated incrementally, the folder is scanned only by evict
+        self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache size is
+        below low_water*max_size"""
+        # the folder may be shared with other processes, resync the size
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(size for _, size, _ in entries)
+        target = self.low_water*self.max_size
+        for path, size, _ in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """Removes all the entries"""
+        for path, _, _ in list(self._entries()):
+            os.remove(path)
+        self.size = 0
@@ -15,44 +15,139 @@ Possible values:
       'yule']
 """
 
-def exporter(argv=None):
+def _export_inputs(file):
+    """Fityk files to export: *file* itself, the .fit files of a folder or
+    the files matching a glob pattern"""
+    import os
+    from glob import glob
+    if os.path.isdir(file):
+        return sorted(glob(os.path.join(file, "*.fit")))
+    if os.path.isfile(file):
+        return [file]
+    return sorted(glob(file))
+
+def _stamp_file(file, output):
+    """File marking the last successful export of *file* in *output*"""
+    import os
+    return os.path.join(output, "." + os.path.basename(file) + ".exported")
+
+def _uptodate(file, output, options):
+    """True if *file* was exported to *output* with the same options after
+    its last modification"""
+    import os, json
+    stamp = _stamp_file(file, output)
+    try:
+        if os.path.getmtime(stamp) < os.path.getmtime(file):
+            return False
+        with open(stamp) as f:
+            return json.load(f) == options
+    except (OSError, ValueError):
+        return False
+
+def _export_file(file, output, options):
+    """
+    Export a Fityk file (see exporter). Used by the worker processes.
+    Returns (file, status, message) where status is 'exported' or 'failed'
+    """
+    import os, json, traceback
     from pyfityk import io
     from fityk import Fityk
+    try:
+        f = Fityk()
+        f.execute(f"exec '{file}'")
+        if options["bundle"]:
+            io.export_bundle(f, os.path.join(output, options["bundle"]), options["errors"], data=not options["po"], peaks=not options["do"])
+        else:
+            if not options["po"]:
+                io.export_data(f, output)
+            if not options["do"]:
+                io.export_peaks(f, output, options["errors"])
+        with open(_stamp_file(file, output), "w") as out:
+            json.dump(options, out)
+        return file, "exported", ""
+    except Exception as e:
+        return file, "failed", f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+def exporter(argv=None):
     import os
+    import json
+    from concurrent.futures import ProcessPoolExecutor
     parser = argparse.ArgumentParser("")
-    parser.add_argument("file")
+    parser.add_argument("file", help="Fityk file, folder (all its .fit files) or glob pattern (quote it)")
     parser.add_argument("-o", dest="output", nargs="?", default="", help="output folder. If nothing is passed the *file* containing folder is used")
     parser.add_argument("--errors", dest="errors", action="store_true", help="flag to enable the export of the peaks' parameters errors")
     parser.add_argument("--data-only", dest="do", action="store_true", help="export only data")
     parser.add_argument("--peaks-only", dest="po", action="store_true", help="export peaks data")
+    parser.add_argument("--bundle", default="", help="export everything to this single file (.h5, .npz or .parquet) instead of a file per dataset. A relative name is placed in the output folder. With several input files it is prefixed with the file name")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of files exported in parallel")
+    parser.add_argument("--force", action="store_true", help="export also the files already exported after their last change")
+    parser.add_argument("--report", default="", help="save the list of exported, skipped and failed files to a JSON file")
     args = parser.parse_args(argv)
-    file = args.file
-
-    output = args.output
-    if output == "":
-        output = os.path.dirname(file)
-
-    f = Fityk()
-    f.execute(f"exec '{file}'")
-    if not args.po:
-        io.export_data(f, output)
-    if not args.do:
-        io.export_peaks(f, output, args.errors)
-    return 0
+
+    files = _export_inputs(args.file)
+    if not files:
+        print(f"No file found at {args.file}")
+        return 1
+    tasks = []
+    results = []
+    for file in files:
+        output = args.output or os.path.dirname(file)
+        bundle = args.bundle
+        if bundle and len(files) > 1:
+            bundle = os.path.splitext(os.path.basename(file))[0] + "_" + bundle
+        options = dict(errors=args.errors, do=args.do, po=args.po, bundle=bundle)
+        if not args.force and _uptodate(file, output, options):
+            results.append((file, "skipped", ""))
+        else:
+            tasks.append((file, output, options))
+
+    if args.jobs <= 1 or len(tasks) <= 1:
+        results += [_export_file(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            results += list(pool.map(_export_file, *zip(*tasks)))
+
+    failed = [r for r in results if r[1] == "failed"]
+    counts = {status:sum(r[1] == status for r in results) for status in ("exported", "skipped", "failed")}
+    if len(files) > 1 or failed:
+        print(", ".join(f"{n} {status}" for status, n in counts.items()))
+    for file, _, message in failed:
+        print("-"*10, f"FAILED {file}", message, sep="\n")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([dict(file=file, status=status, message=message) for file, status, message in results], f, indent=1)
+    return 1 if failed else 0
 
 def mapping(argv=None):
-    import pandas as pd
+    from pyfityk.io import open_map
     from pyfityk.mapping import edit_filename, fitMap
     parser = argparse.ArgumentParser("")
     parser.add_argument("file", help="file containing the data")
     parser.add_argument("template", help="template file to get spectra kinds")
     parser.add_argument("--out", default="", help="template file to get spectra kinds")
     parser.add_argument("--style", default="jasko", help="Style of the input file")
+    parser.add_argument("--no_map_cache", dest="map_cache", action="store_false", help="Do not convert the file in the binary memory mapped format (file.npmap) used to load it")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output from Fityk")
     parser.add_argument("--match_preprocess", default="", help="Add data preprocessing for the spectra template matching. Possible inputs are b=baseline subtracrtion, n=normalize, s=smooth, a=all.")
+    parser.add_argument("--match_window", type=int, default=50, help="Window length of the smoothing filter used in the matching preprocess")
+    parser.add_argument("--match_polyorder", type=int, default=2, help="Polynomial order of the smoothing filter used in the matching preprocess")
     parser.add_argument("--match_method", default="pearsonr", help="Method used for matching the template.\n"+doc_methods)
     parser.add_argument("--split", type=int, default=0, help="Splits the output file")
     parser.add_argument("--nofit", action="store_false", help="Set up but does not perform fit")
+    parser.add_argument("--warm_start", action="store_true", help="Start each fit from the last fitted spectrum with the same template")
+    parser.add_argument("--order", default="raster", choices=["raster", "serpentine", "hilbert"], help="Order used to fit the map spectra")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run from its checkpoint journal")
+    parser.add_argument("--fit_cache", nargs="?", const=True, default=None, help="Reuse the fits of identical spectra from an on disk cache. A cache folder can be passed, else the default one is used")
+    parser.add_argument("--fit_cache_size", type=float, default=1024, help="Maximum size of the fit cache in MB")
+    parser.add_argument("--coarse", type=int, default=1, help="Fit first the spectra binned by COARSE points, then refine at full resolution")
+    parser.add_argument("--backend", default="fityk", choices=["fityk", "numpy"], help="Fit the spectra one by one with Fityk or in batches with NumPy (standard peak functions only, the others are fitted by Fityk)")
+    parser.add_argument("--background_save", action="store_true", help="Save the split files in a background process while fitting the next ones")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Read, match and fit the map CHUNK_SIZE spectra at a time to bound the memory used")
+    parser.add_argument("--progress", type=float, default=5., help="Print the progress at most every PROGRESS seconds, 0 to disable")
+    parser.add_argument("--report", default="", help="Save the timing report to a JSON (or Prometheus .prom) file")
+    parser.add_argument("--table", default="", help="Also write the fitted parameters to a columnar file (.parquet, .h5 or .npz)")
+    parser.add_argument("--template_cache", nargs="?", const=True, default=None, help="Cache the compiled template on disk. A cache folder can be passed, else the default one is used")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used for fitting")
 
     args = parser.parse_args(argv)
     
@@ -65,12 +160,8 @@ def mapping(argv=None):
     if style not in accepted_styles:
         parser.error("Unknown style.")        
     elif args.style=="jasko":
-        data = pd.read_table(args.file, header=[13,14], dtype=float)
-        x = data.iloc[:,0]
-        ys = data.iloc[:,1:]
-
-        # x = data.iloc[:,0].astype(float)
-        # ys = data.iloc[:,1:].astype(float)
+        ys = open_map(args.file, style, cache=args.map_cache)
+        x = ys["x"]
 
     if out == "":
         out = edit_filename(args.file, ".fit", replace=True)
@@ -85,5 +176,5 @@ def mapping(argv=None):
             print("Unknown preprocess option. Accepted keys are b, n, s, a.")
             return 1
 
-    fitMap(x, ys,  args.template, fileout=out, split=args.split, fit=args.nofit, match_preprocess=preprocess, match_method=args.match_method, verbosity = verbose)
+    fitMap(x, ys,  args.template, fileout=out, split=args.split, fit=args.nofit, match_preprocess=preprocess, match_method=args.match_method, verbosity = verbose, workers=args.jobs, template_cache=args.template_cache, match_window=args.match_window, match_polyorder=args.match_polyorder, warm_start=args.warm_start, order=args.order, resume=args.resume, table_out=args.table, fit_cache=args.fit_cache, fit_cache_size=args.fit_cache_size, progress=args.progress, report_out=args.report, coarse=args.coarse, backend=args.backend, background_save=args.background_save, chunk_size=args.chunk_size)
     return 0
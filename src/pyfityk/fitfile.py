@@ -0,0 +1,235 @@
+import re
+import numpy as np
+import pandas as pd
+from pyfityk.support import substitute_with_dict, convert_peaks, deactivate_points
+
+# -----------------------------------------------------------------
+# Native reader of the Fityk state files (info state > file.fit)
+# -----------------------------------------------------------------
+
+SECTION = re.compile(rb"^# ------------\s+(.*?)\s+------------")
+POINT_VALUES = re.compile(rb"=([^,\s]+)")
+DOMAIN = re.compile(r"\s*\[([^:\]]*):([^\]]*)\]\s*$")
+VARIABLE = re.compile(r"\$[A-Za-z0-9_]+")
+FUNCTION = re.compile(r"%[A-Za-z0-9_]+")
+
+def _decode(line):
+    return line.decode("utf-8", errors="replace").rstrip("\r\n")
+
+def _parse_variable(text):
+    """
+    Parse the right hand side of a variable definition.
+
+    Return
+    ------
+    tuple:
+        (value, free, lo, hi). value is NaN for compound variables,
+        lo and hi are None if no domain is given
+    """
+    lo = hi = None
+    if (m := DOMAIN.search(text)):
+        lo = float(m.group(1)) if m.group(1).strip() else None
+        hi = float(m.group(2)) if m.group(2).strip() else None
+        text = text[:m.start()]
+    text = text.strip()
+    free = text.startswith("~")
+    try:
+        value = float(text.lstrip("~"))
+    except ValueError:
+        value = np.nan
+    return value, free, lo, hi
+
+def _resolve(text, pattern, definitions):
+    """Substitute recursively the names matching pattern with their definitions"""
+    for _ in range(100):
+        new = substitute_with_dict(text, pattern, definitions)
+        if new == text:
+            break
+        text = new
+    return text
+
+def scan_fit_file(filename):
+    """
+    Scan a Fityk state file without reading the data points.
+
+    Input
+    ------
+    filename: str
+        name of the .fit file
+    Return
+    ------
+    dict:
+        - settings: list of 'set ...' lines
+        - defines: list of 'define ...' lines
+        - datasets: list of (dataset index, file offset) of each data block
+        - variables: dict {$name: text of the definition}
+        - functions: dict {%name: text of the definition}
+        - models: dict {dataset index: {'F': model, 'Z': zero shift}}
+    """
+    info = dict(settings=[], defines=[], datasets=[], variables={}, functions={}, models={})
+    section = None
+    with open(filename, "rb") as f:
+        while (line := f.readline()):
+            # the data points are most of the file, skip them quickly
+            if line.startswith(b"X["):
+                continue
+            if (m := SECTION.match(line)):
+                section = m.group(1).decode()
+                continue
+            text = _decode(line).strip()
+            if not text:
+                continue
+            if section == "settings" and text.startswith("set "):
+                info["settings"].append(text)
+            elif section == "datasets" and text.startswith("use @"):
+                info["datasets"].append((int(text[5:]), f.tell()))
+            elif section == "(un)defines" and text.startswith("define "):
+                info["defines"].append(text)
+            elif section == "variables and functions" and " = " in text:
+                name, value = text.split(" = ", 1)
+                if name.startswith("$"):
+                    info["variables"][name] = value
+                elif name.startswith("%"):
+                    info["functions"][name] = value
+            elif section == "models" and text.startswith("@") and " = " in text:
+                lhs, model = text.split(" = ", 1)
+                index, kind = lhs[1:].split(":")
+                info["models"].setdefault(int(index), {})[kind.strip()] = model
+    return info
+
+def read_data_block(f, offset):
+    """
+    Read the data block of a dataset starting at offset.
+
+    Input
+    ------
+    f: binary file
+        opened .fit file
+    offset: int
+        position of the line following 'use @n'
+    Return
+    ------
+    tuple:
+        (title, pd.DataFrame with x, y, active, sigma columns)
+    """
+    f.seek(offset)
+    title = ""
+    points = []
+    while (line := f.readline()):
+        if line.startswith(b"X["):
+            points.append(line)
+        elif line.startswith(b"title = "):
+            title = _decode(line)[len("title = "):].strip()[1:-1]
+        elif line.startswith((b"@+", b"use @", b"#")) or (points and not line.strip()):
+            break
+    values = np.array(POINT_VALUES.findall(b"".join(points)), dtype=float).reshape(-1, 4)
+    data = pd.DataFrame(values[:,[0,1,3,2]], columns=["x", "y", "active", "sigma"])
+    return title, data
+
+def function_table(model, functions):
+    """
+    Build the functions table of a model without Fityk.
+
+    Input
+    ------
+    model: str
+        model with function names, e.g. '%_1 + %_2'
+    functions: dict
+        {%name: definition with resolved parameters}
+    Return
+    ------
+    pd.DataFrame
+        functions identifier, name and parameters a0..an
+    """
+    lines = []
+    for fid in FUNCTION.findall(model):
+        fname, pars = functions[fid].split("(", 1)
+        pars = [p for p in pars.rstrip(")").split(", ") if p]
+        lines.append([fid, fname] + [_parse_variable(p)[0] for p in pars])
+    df = pd.DataFrame(lines)
+    if not df.empty:
+        df.columns = ["fid","fname"] + [f"a{i}" for i in range(len(df.columns)-2)]
+    return df
+
+def iter_fityk_text(filename, evaluate=False, errors=True):
+    """
+    Read a Fityk state file dataset by dataset without replaying it
+    through Fityk. The variables and functions are resolved directly
+    and the data points are decoded in NumPy arrays.
+
+    Input
+    ------
+    filename: str
+        name of the file
+    evaluate: bool, default=False
+        if True a Fityk session is used to compute the model formula,
+        the peaks table (Center, Height, Area, FWHM) and the model curves
+    errors: bool, default=True
+        include the parameters errors in the peaks table. Used only when
+        **evaluate** is True
+    Yield
+    ------
+    dict:
+        - title
+        - model (fityk like model)
+        - model_formula (general formula for the model, None if not evaluated)
+        - functions (a pd.DataFrame with the functions parameters)
+        - data (a pd.DataFrame with the data)
+        A dataset without model has model=0, model_formula=0, functions=None
+    """
+    info = scan_fit_file(filename)
+    variables = {name:_resolve(value, VARIABLE.pattern, info["variables"]) for name, value in info["variables"].items()}
+    functions = {name:substitute_with_dict(value, VARIABLE.pattern, variables) for name, value in info["functions"].items()}
+
+    session = None
+    if evaluate:
+        from fityk import Fityk
+        session = Fityk()
+        session.execute("set verbosity = -1")
+        session.execute("set numeric_format = '%f'")
+        for d in info["defines"]:
+            session.execute(d)
+
+    with open(filename, "rb") as f:
+        for index, offset in info["datasets"]:
+            title, data = read_data_block(f, offset)
+            d = dict(title=title)
+            F = info["models"].get(index, {}).get("F", "0").strip()
+            if F in ("0", ""):
+                d["model"] = 0
+                d["model_formula"] = 0
+                d["functions"] = None
+                d["data"] = data
+                yield d
+                continue
+            d["model"] = substitute_with_dict(F, FUNCTION.pattern, functions)
+            if session is None:
+                d["model_formula"] = None
+                d["functions"] = function_table(F, functions)
+                d["data"] = data
+            else:
+                d.update(_evaluate(session, d["model"], data, title, errors))
+            yield d
+
+def _evaluate(session, model, data, title, errors):
+    """Evaluate a dataset in a Fityk session"""
+    from pyfityk.io import get_data
+    session.load_data(0, data["x"].to_numpy(), data["y"].to_numpy(), data["sigma"].to_numpy(), title)
+    deactivate_points(session, data["active"].to_numpy(dtype=bool), 0)
+    session.execute(f"@0: F = {model}")
+    peaks = None
+    if errors:
+        try:
+            peaks = session.get_info("peaks_err", 0)
+        except Exception:
+            pass
+    if peaks is None:
+        peaks = session.get_info("peaks", 0)
+    curves = get_data(session, 0)
+    out = dict(
+        model_formula = session.get_info("gnuplot_formula", 0),
+        functions = convert_peaks(peaks),
+        data = pd.concat([data, curves.iloc[:,3:]], axis=1),
+        )
+    session.execute("@0: F = 0")
+    return out
@@ -0,0 +1,380 @@
+import re
+import inspect
+import numpy as np
+from scipy.special import erf, erfc, gammaln, gamma, digamma
+from pyfityk.shapes import SHAPES, _humlik
+
+# -----------------------------------------------------------------
+# Compile Fityk function definitions into NumPy functions
+# -----------------------------------------------------------------
+# A define like 'Gaussian(height, center, hwhm) = height*exp(-ln(2)*((x-center)/hwhm)^2)'
+# is parsed and translated to a Python expression on NumPy arrays. The
+# compiled functions broadcast: with x of shape (n_points,) and parameters
+# of shape (n_spectra, 1) the result is (n_spectra, n_points), so a whole
+# map is evaluated with a few array operations.
+
+# Fityk math functions and their NumPy version
+MATH = {
+    "sqrt":"np.sqrt", "exp":"np.exp", "ln":"np.log", "log10":"np.log10",
+    "sin":"np.sin", "cos":"np.cos", "tan":"np.tan", "sinh":"np.sinh",
+    "cosh":"np.cosh", "tanh":"np.tanh", "atan":"np.arctan", "asin":"np.arcsin",
+    "acos":"np.arccos", "abs":"np.abs", "round":"np.round", "erf":"erf",
+    "erfc":"erfc", "lgamma":"gammaln", "gamma":"gamma", "digamma":"digamma",
+    "voigt":"_humlik", "min2":"np.minimum", "max2":"np.maximum",
+    }
+NAMESPACE = dict(np=np, erf=erf, erfc=erfc, gammaln=gammaln, gamma=gamma, digamma=digamma, _humlik=_humlik)
+
+# parameters of the built-in polynomials (pyfityk.shapes.polynomial)
+POLYNOMIALS = {"Linear":2, "Quadratic":3, "Cubic":4, "Polynomial4":5, "Polynomial5":6, "Polynomial6":7}
+
+TOKEN = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(<=|>=|==|!=|[-+*/^(),?:<>]))")
+DEFINE = re.compile(r"^\s*(?:define\s+)?([A-Za-z_]\w*)\s*\((.*?)\)\s*=\s*(.*)$", re.S)
+
+class FormulaError(ValueError):
+    """The formula cannot be compiled"""
+
+def tokenize(text):
+    """Splits a Fityk expression in tokens"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise FormulaError(f"Unexpected '{text[pos:].strip()[:20]}' in '{text}'")
+        tokens.append(m.group(m.lastindex))
+        pos = m.end()
+    return tokens
+
+class _Parser:
+    """Recursive descent parser translating a Fityk expression in a Python
+    expression. Every operation is parenthesized in the output."""
+
+    def __init__(self, text, params, functions):
+        self.tokens = tokenize(text)
+        self.pos = 0
+        self.params = params
+        self.functions = functions
+        self.text = text
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        if self.next() != token:
+            raise FormulaError(f"Expected '{token}' in '{self.text}'")
+
+    def parse(self):
+        out = self.ternary()
+        if self.peek() is not None:
+            raise FormulaError(f"Unexpected '{self.peek()}' in '{self.text}'")
+        return out
+
+    def ternary(self):
+        cond = self.logic_or()
+        if self.peek() == "?":
+            self.next()
+            a = self.ternary()
+            self.expect(":")
+            b = self.ternary()
+            return f"np.where({cond}, {a}, {b})"
+        return cond
+
+    def logic_or(self):
+        out = self.logic_and()
+        while self.peek() == "or":
+            self.next()
+            out = f"({out} | {self.logic_and()})"
+        return out
+
+    def logic_and(self):
+        out = self.logic_not()
+        while self.peek() == "and":
+            self.next()
+            out = f"({out} & {self.logic_not()})"
+        return out
+
+    def logic_not(self):
+        if self.peek() == "not":
+            self.next()
+            return f"(~{self.logic_not()})"
+        return self.comparison()
+
+    def comparison(self):
+        out = self.additive()
+        if self.peek() in ("<", ">", "<=", ">=", "==", "!="):
+            op = self.next()
+            out = f"({out} {op} {self.additive()})"
+        return out
+
+    def additive(self):
+        out = self.term()
+        while self.peek() in ("+", "-"):
+            op = self.next()
+            out = f"({out} {op} {self.term()})"
+        return out
+
+    def term(self):
+        out = self.unary()
+        while self.peek() in ("*", "/"):
+            op = self.next()
+            out = f"({out} {op} {self.unary()})"
+        return out
+
+    def unary(self):
+        if self.peek() in ("-", "+"):
+            op = self.next()
+            return f"({op}{self.unary()})"
+        return self.power()
+
+    def power(self):
+        out = self.atom()
+        if self.peek() == "^":
+            self.next()
+            out = f"({out} ** {self.unary()})"
+        return out
+
+    def arguments(self):
+        self.expect("(")
+        args = []
+        if self.peek() != ")":
+            args.append(self.ternary())
+            while self.peek() == ",":
+                self.next()
+                args.append(self.ternary())
+        self.expect(")")
+        return args
+
+    def atom(self):
+        token = self.next()
+        if token is None:
+            raise FormulaError(f"Unexpected end of '{self.text}'")
+        if token == "(":
+            out = self.ternary()
+            self.expect(")")
+            return f"({out})"
+        if token[0].isdigit() or token[0] == ".":
+            return repr(float(token))
+        if not (token[0].isalpha() or token[0] == "_"):
+            raise FormulaError(f"Unexpected '{token}' in '{self.text}'")
+        if self.peek() == "(":
+            args = self.arguments()
+            if token in MATH:
+                return f"{MATH[token]}({', '.join(args)})"
+            if token not in SHAPES and token not in self.functions.defines:
+                raise FormulaError(f"Function {token} is not defined in '{self.text}'")
+            # another Fityk function
+            return f"F[{token!r}](x, {', '.join(args)})"
+        if token == "x":
+            return "x"
+        if token == "pi":
+            return "np.pi"
+        if token in self.params:
+            return f"p[{self.params.index(token)}]"
+        raise FormulaError(f"Unknown name '{token}' in '{self.text}'")
+
+def split_args(text):
+    """Splits **text** (e.g. the parameters of a define) at the top level commas"""
+    args, depth, current = [], 0, ""
+    for c in text:
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        if c == "," and depth == 0:
+            args.append(current)
+            current = ""
+        else:
+            current += c
+    if current.strip():
+        args.append(current)
+    return args
+
+def parse_define(definition):
+    """
+    Splits a Fityk define in name, parameters and formula.
+
+    Input
+    ------
+    definition: str
+        e.g. 'Gaussian(height, center, hwhm) = height*exp(-ln(2)*((x-center)/hwhm)^2)'
+        as returned by pyfityk.support.get_define_functions. The default
+        values of the parameters are ignored
+    Return
+    ------
+    tuple:
+        (name, list of parameter names, formula)
+    """
+    m = DEFINE.match(definition)
+    if m is None:
+        raise FormulaError(f"Not a function definition: '{definition}'")
+    params = [re.match(r"\s*([A-Za-z_]\w*)", a).group(1) for a in split_args(m.group(2))]
+    return m.group(1), params, m.group(3).strip()
+
+class FunctionLibrary(dict):
+    """
+    Dictionary {Fityk function name: NumPy function f(x, *params)} filled
+    on demand. The built-in functions use pyfityk.shapes, the others are
+    compiled from **defines**.
+
+    Inputs
+    ------
+    defines: dict, default=None
+        {function name: definition} as returned by get_define_functions
+    """
+
+    def __init__(self, defines=None):
+        super().__init__()
+        self.defines = defines or {}
+
+    def __missing__(self, name):
+        if name in SHAPES:
+            function = SHAPES[name]
+        elif name in self.defines:
+            function = compile_define(self.defines[name], self)
+        else:
+            raise FormulaError(f"Function {name} is not defined")
+        self[name] = function
+        return function
+
+def compile_define(definition, library=None):
+    """
+    Compiles a Fityk define in a NumPy function f(x, *params).
+
+    Input
+    ------
+    definition: str
+        function definition (see parse_define)
+    library: FunctionLibrary, default=None
+        functions used to resolve the calls to other Fityk functions
+    Return
+    ------
+    function
+    """
+    if library is None:
+        library = FunctionLibrary()
+    name, params, formula = parse_define(definition)
+    code = _Parser(formula, params, library).parse()
+    namespace = dict(NAMESPACE, F=library)
+    source = f"def {name}(x, *p):\n    return {code}\n"
+    exec(compile(source, f"<fityk define {name}>", "exec"), namespace)
+    function = namespace[name]
+    function.__doc__ = definition
+    function.n_params = len(params)
+    return function
+
+class CompiledModel:
+    """
+    Sum of Fityk functions evaluated at once for many spectra.
+
+    Inputs
+    ------
+    fnames: list of str
+        function types of the model, in order (the fname column of the
+        functions tables)
+    defines: dict, default=None
+        user defines (see get_define_functions)
+    n_params: list of int, default=None
+        number of parameters of each function. Needed for the defines
+        with a variable number of parameters, else it is taken from the
+        definitions
+
+    Calling the model with x (n_points,) and params (n_spectra, total
+    parameters) returns the model curves (n_spectra, n_points). The
+    columns of params are the a0..an of each function in order.
+    """
+
+    def __init__(self, fnames, defines=None, n_params=None):
+        self.library = FunctionLibrary(defines)
+        self.fnames = list(fnames)
+        self.functions = [self.library[name] for name in self.fnames]
+        if n_params is None:
+            n_params = [self._count(name, f) for name, f in zip(self.fnames, self.functions)]
+        bounds = np.cumsum([0] + list(n_params))
+        self.slices = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        self.n_params = int(bounds[-1])
+
+    def _count(self, name, function):
+        if hasattr(function, "n_params"):
+            return function.n_params
+        if name in POLYNOMIALS:
+            return POLYNOMIALS[name]
+        return len(inspect.signature(function).parameters) - 1
+
+    def components(self, x, params):
+        """Returns the list of the curves of each function (n_spectra, n_points)"""
+        x = np.asarray(x, dtype=float)
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        if params.shape[1] != self.n_params:
+            raise ValueError(f"The model has {self.n_params} parameters, {params.shape[1]} passed.")
+        columns = params.T[:, :, None] # (n_params, n_spectra, 1), broadcast over x
+        shape = np.broadcast_shapes((params.shape[0], 1), x.shape)
+        return [np.broadcast_to(f(x, *columns[s]), shape) for f, s in zip(self.functions, self.slices)]
+
+    def __call__(self, x, params):
+        x = np.asarray(x, dtype=float)
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        y = np.zeros(np.broadcast_shapes((params.shape[0], 1), x.shape))
+        for c in self.components(x, params):
+            y += c
+        return y
+
+def compile_model(fnames, defines=None, n_params=None):
+    """Returns a CompiledModel of the functions **fnames** (see CompiledModel)"""
+    return CompiledModel(fnames, defines, n_params)
+
+def model_params(functions):
+    """
+    Parameters vector of a model from its functions table (the functions
+    DataFrame of read_fityk or read_fityk_text).
+
+    Return
+    ------
+    tuple:
+        (fnames, n_params, params) with the parameters a0..an of each
+        function concatenated
+    """
+    columns = [c for c in functions.columns if re.fullmatch(r"a\d+", str(c))]
+    values = functions[columns].to_numpy(dtype=float)
+    n = (~np.isnan(values)).sum(axis=1)
+    params = np.concatenate([row[:k] for row, k in zip(values, n)]) if len(values) else np.zeros(0)
+    return list(functions["fname"]), [int(k) for k in n], params
+
+def evaluate_models(x, datasets, defines=None):
+    """
+    Evaluates the models of many datasets sharing the same x. The datasets
+    with the same functions are evaluated together with a single
+    CompiledModel call.
+
+    Input
+    ------
+    x: np.array (n_points,)
+    datasets: list of dict
+        datasets as returned by read_fityk or read_fityk_text, with the
+        functions table
+    defines: dict, default=None
+        user defines (see get_define_functions)
+    Return
+    ------
+    np.array (n_datasets, n_points)
+        model curves, 0 for the datasets without model
+    """
+    x = np.asarray(x, dtype=float)
+    out = np.zeros((len(datasets), x.size))
+    groups = {}
+    for i, d in enumerate(datasets):
+        if d["functions"] is None or len(d["functions"]) == 0:
+            continue
+        fnames, n_params, params = model_params(d["functions"])
+        groups.setdefault((tuple(fnames), tuple(n_params)), ([], []))
+        groups[(tuple(fnames), tuple(n_params))][0].append(i)
+        groups[(tuple(fnames), tuple(n_params))][1].append(params)
+    for (fnames, n_params), (index, params) in groups.items():
+        model = CompiledModel(fnames, defines, n_params)
+        out[index] = model(x, np.array(params))
+    return out
@@ -2,8 +2,16 @@ from fityk import Fityk, ExecuteError
 import pandas as pd
 import numpy as np
 from os.path import isfile
+import os
+import json
+import shutil
+from glob import glob, escape as glob_escape
+from concurrent.futures import ThreadPoolExecutor
 from .support import *
-import re
+from .fitfile import iter_fityk_text
+from .table import TableWriter
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
 
 
 # -----------------------------------------------------------------
@@ -26,8 +34,9 @@ def get_data(session, dataset):
         pandas Dataframe with x,y,f0..fn,ftot columns
     """
     xy = pd.DataFrame(points_to_arrays(session.get_data(dataset)), columns=["x","y","active"])
-    x = xy["x"]
-    funcs = np.array([get_func_y(x,f) for f in session.get_components(dataset)])
+    x = xy["x"].to_numpy()
+    cutoff = get_function_cutoff(session)
+    funcs = np.array([get_func_y(x,f,cutoff) for f in session.get_components(dataset)], dtype=float)
     if len(funcs)>0:
         df = pd.concat([xy, pd.DataFrame(funcs.T, columns=[f"f{i}" for i in range(funcs.shape[0])])], axis=1)
         df["ftot"] = funcs.sum(axis=0)
@@ -88,7 +97,7 @@ def get_functions(session, dataset):
     return df
 
 
-def read_fityk(session):
+def read_fityk(session, lazy=False, cache_size=64):
     """
     Read Fityk file and convert it to a python-like structure. 
     Warning: at the present state the function does not read read if a variable
@@ -99,9 +108,14 @@ def read_fityk(session):
     session: str or Fityk session
         if the file is a string it opens a session with that filename
         else it uses the Fityk session passed 
+    lazy: bool, default=False
+        if True a SessionView is returned: the datasets are evaluated only
+        when accessed
+    cache_size: int, default=64
+        number of evaluated datasets kept by the SessionView
     Return
     ------
-    list of dict:
+    list of dict or SessionView:
         Each element of the list is a dictionary containing:
         - title
         - model (fityk like model) !!!NOT IMPLEMENTED returns None!!! 
@@ -115,6 +129,8 @@ def read_fityk(session):
     else:
         f = session
 
+    if lazy:
+        return SessionView(f, cache_size)
     return [
         {
             "title":f.get_info("title",i),
@@ -126,14 +142,146 @@ def read_fityk(session):
         for i in range(f.get_dataset_count())
     ]
 
+class LazyDataset(Mapping):
+    """
+    Dataset of a SessionView. It has the keys of the read_fityk 
+    dictionaries (title, model, model_formula, functions, data), each one
+    is evaluated from the session the first time it is accessed.
+    values(), items() and dict(dataset) evaluate all the keys, data 
+    included. Two datasets are equal if they are the same dataset of the
+    same session, the values are not compared.
+    """
+    KEYS = ("title", "model", "model_formula", "functions", "data")
+
+    def __init__(self, session, index):
+        self.session = session
+        self.index = index
+        self._values = {}
+
+    def _evaluate(self, key):
+        f, i = self.session, self.index
+        if key == "title":
+            return f.get_info("title", i)
+        if key == "model":
+            return None
+        if key == "model_formula":
+            return f.get_info("gnuplot_formula", i)
+        if key == "functions":
+            return get_functions(f, i)
+        return get_data(f, i)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        if key not in self._values:
+            self._values[key] = self._evaluate(key)
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __eq__(self, other):
+        if not isinstance(other, LazyDataset):
+            return NotImplemented
+        return self.session is other.session and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.session), self.index))
+
+    def __getattr__(self, key):
+        if key in LazyDataset.KEYS:
+            return self[key]
+        raise AttributeError(key)
+
+    def clear(self):
+        """Drops the evaluated values"""
+        self._values.clear()
+
+    def __repr__(self):
+        return f"LazyDataset(@{self.index}, evaluated={list(self._values)})"
+
+class SessionView(Sequence):
+    """
+    Lazy view of the datasets of a Fityk session, returned by 
+    read_fityk(lazy=True). The datasets can be indexed by number (negative
+    numbers count from the end), slice or title, and are evaluated only 
+    when their values are accessed (see LazyDataset). Only the last 
+    **cache_size** accessed datasets keep their values.
+
+    Inputs
+    ------
+    session: Fityk
+    cache_size: int, default=64
+        number of datasets kept evaluated
+    """
+
+    def __init__(self, session, cache_size=64):
+        self.session = session
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._titles = None
+        self._titles_list = []
+
+    def __len__(self):
+        return self.session.get_dataset_count()
+
+    def _dataset(self, i):
+        d = self._cache.get(i)
+        if d is None:
+            d = LazyDataset(self.session, i)
+            self._cache[i] = d
+            if len(self._cache) > self.cache_size:
+                _, old = self._cache.popitem(last=False)
+                old.clear()
+        else:
+            self._cache.move_to_end(i)
+        return d
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._dataset(i) for i in range(*key.indices(len(self)))]
+        if isinstance(key, str):
+            index = self.titles.get(key)
+            if index is None:
+                raise KeyError(key)
+            return self._dataset(index)
+        n = len(self)
+        i = int(key)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"dataset {key} out of range")
+        return self._dataset(i)
+
+    @property
+    def titles(self):
+        """dict {title: dataset index}, the first dataset is used for 
+        duplicated titles"""
+        if self._titles is None or len(self._titles_list) != len(self):
+            self._titles_list = [self.session.get_info("title", i) for i in range(len(self))]
+            self._titles = {}
+            for i, title in enumerate(self._titles_list):
+                self._titles.setdefault(title, i)
+        return self._titles
+
+    def __repr__(self):
+        return f"SessionView({len(self)} datasets, {len(self._cache)} cached)"
+
 def read_fityk_text(filename, errors=True):
     """
     Read Fityk file and convert it to a python-like structure.
     It is advisable to use instead of read_fityk.
+    The file is parsed natively (see pyfityk.fitfile.iter_fityk_text),
+    Fityk is used only to evaluate the models.
     Input
     ------
     filename: str
         name of the file
+    errors: bool, default=True
+        include the parameters errors in the functions table
     Return
     ------
     list of dict:
@@ -144,74 +292,9 @@ def read_fityk_text(filename, errors=True):
         - functions (a pd.DataFrame with the functions parameters)
         - data (a pd.DataFrame with the data)
     """
-
-    with open(filename) as f:
-        content = f.read()
-    sections = re.split(r'(?=^# ------------)', content, flags=re.IGNORECASE | re.MULTILINE)
-
-    f = Fityk()
-    f.execute("set verbosity = -1") 
-    f.execute("set numeric_format = '%f'") 
-    
-    #read sections
-    for sec in sections:
-        if sec.startswith("# ------------  (un)defines  ------------"):
-            defines = sec
-            for d in [d for d in defines.split("\n")]:
-                f.execute(d)
-
-        if sec.startswith("# ------------  datasets ------------"):
-            data = sec.split("\n")
-
-        if sec.startswith("# ------------  variables and functions  ------------"):
-            s = sec.split("\n\n")
-            par, funcs = s[0], s[1]
-
-            #edit par
-            par = dict([x.split(" = ") for x in par.split("\n")[1:]])
-
-            # edit func
-            funcs = funcs.strip()
-            if(funcs==""):
-                funcs = {}
-                models = {}
-                break             
-            else:
-                funcs = substitute_with_dict(funcs, r"\$_[0-9]*", par) #replace parameters with their values
-                funcs = dict([x.split(" = ") for x in funcs.split("\n")])
-
-        if sec.startswith("# ------------  models  ------------"):
-            sec = substitute_with_dict(sec, r"%_[0-9]*", funcs) #replace functions with their values
-            sec = sec.split("\n\n")[0].split("\n")[1:]
-            models = {int(l[1:l.find(":")]): l.split(" = ")[1] for l in sec}
-
-    for line in data:
-        f.execute(line)
-
     dfs = []
-    for i in range((f.get_dataset_count())):
-        d = dict()
-        d["title"] = f.get_info("title",i)
-        if i in models:
-            model = models[i]
-            f.execute(f"@{i}:F ={model}")
-            if errors:
-                try:
-                    peaks = f.get_info("peaks_err",i)
-                except:
-                    peaks = f.get_info("peaks",i)
-            else:
-                    peaks = f.get_info("peaks",i)
-            peaks = convert_peaks(peaks)
-            d["model"] = model
-            d["model_formula"] = f.get_info("gnuplot_formula",i)
-            d["functions"] = peaks
-        else:
-            d["model"] = 0
-            d["model_formula"] = 0
-            d["functions"] = None
-        d["data"] = get_data(f,i)
-        f.execute(f"@{i}:F=0")
+    for d in iter_fityk_text(filename, evaluate=True, errors=errors):
+        d["data"] = d["data"].drop(columns="sigma")
         dfs.append(d)
     return dfs
 
@@ -238,10 +321,172 @@ def read_peaks(filename):
         peaks = f.read()
     return convert_peaks(peaks)
 
+def read_peaks_dir(folder, pattern="*.peaks", workers=None):
+    """
+    Reads all the .peaks files of a folder (e.g. written by export_peaks)
+    in a single DataFrame. The files are read by a pool of threads and 
+    parsed all together.
+
+    Input
+    -----------------------------------------------
+    folder: str
+        folder containing the files
+    pattern: str, default="*.peaks"
+        glob pattern of the files to read
+    workers: int, default=None
+        number of threads reading the files. If None the ThreadPoolExecutor
+        default is used
+    Returns
+    -----------------------------------------------
+    pandas.DataFrame:
+        DataFrame containing the source file, the title (file name 
+        without extension), the functions identifier, name and parameters
+        of all the files
+    """
+    files = sorted(glob(os.path.join(glob_escape(folder), pattern)))
+    columns = ["source", "title"] + PEAKS_COLUMNS
+    with ThreadPoolExecutor(workers) as pool:
+        texts = list(pool.map(_read_text, files))
+
+    # all the files are parsed at once, the lines are prefixed with the
+    # file index. Files with and without errors have different columns
+    groups = {True:[], False:[]}
+    for k, text in enumerate(texts):
+        groups["+/-" in text].extend(f"{k} {line}" for line in clean_peaks(text))
+    tables = [peaks_table(lines, errors, indexed=True) for errors, lines in groups.items() if lines]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(tables).sort_values("index", kind="stable")
+    index = df.pop("index").to_numpy()
+    names = np.array(files, dtype=object)
+    df.insert(0, "title", [os.path.splitext(os.path.basename(f))[0] for f in names[index]])
+    df.insert(0, "source", names[index])
+    return df.reset_index(drop=True)
+
+def _read_text(filename):
+    with open(filename) as f:
+        return f.read()
+
+def read_jasco_map(file):
+    """
+    Read a Jasco mapping file in a single pass.
+    -----------------------------------------------------------------
+    file: str
+        name of the file. The map x and y coordinates are in the rows 14
+        and 15, followed by the spectra: the first column contains the 
+        x values, the others one spectrum each.
+    Return
+    ------
+    tuple:
+        (x, xmap, ymap, spectra) where x is the np.array of the spectra x 
+        values, xmap and ymap the lists of the coordinates (as written in 
+        the file) and spectra a np.array (n_spectra, spectrum_y)
+    """
+    with open(file) as f:
+        _ = [next(f) for i in range(13)]
+        xmap = next(f).rstrip("\r\n").split("\t")[1:]
+        ymap = next(f).rstrip("\r\n").split("\t")[1:]
+        values = pd.read_table(f, header=None, dtype=float).to_numpy()
+    x = np.ascontiguousarray(values[:,0])
+    spectra = np.ascontiguousarray(values[:,1:len(xmap)+1].T)
+    return x, xmap, ymap, spectra
+
+# version of the binary map format, change it to invalidate the converted maps
+MAP_CACHE_VERSION = 1
+
+def _source_stamp(file):
+    st = os.stat(file)
+    return dict(source=os.path.abspath(file), size=st.st_size, mtime_ns=st.st_mtime_ns, version=MAP_CACHE_VERSION)
+
+def convert_map(file, folder=None, style="jasko"):
+    """
+    Convert a mapping file in a binary folder that can be memory mapped:
+        - spectra.npy: np.array (n_spectra, spectrum_y), one spectrum per row
+        - x.npy: spectra x values
+        - coords.npy: map coordinates (as written in the file) of each spectrum
+        - meta.json: source file, size and modification time
+    -----------------------------------------------------------------
+    file: str
+        name of the file 
+    folder: str, default=None
+        output folder. If None *file*.npmap is used
+    style: str, default="jasko"
+        identify the formatting style of the mapping file
+        Accepted values:
+            - "jasko"
+    Return
+    ------
+    str:
+        the output folder
+    """
+    if style != "jasko":
+        raise ValueError(f"Style {style} not recognized.")
+    folder = folder or file + ".npmap"
+    meta = _source_stamp(file)
+    x, xmap, ymap, spectra = read_jasco_map(file)
+
+    # write in a temporary folder first, so that a partial conversion is never used
+    tmp = f"{folder}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, "spectra.npy"), spectra)
+    np.save(os.path.join(tmp, "x.npy"), x)
+    np.save(os.path.join(tmp, "coords.npy"), np.array([xmap, ymap], dtype=str).T)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp, folder)
+    return folder
+
+def open_map(file, style="jasko", cache=True, folder=None):
+    """
+    Open a mapping file. With **cache** the file is converted once with
+    convert_map and the spectra are memory mapped, so that only the read
+    spectra are loaded in memory. The conversion is reused as long as the
+    source file is unchanged.
+    -----------------------------------------------------------------
+    file: str
+        name of the file 
+    style: str, default="jasko"
+        identify the formatting style of the mapping file
+    cache: bool, default=True
+        use the binary conversion of the file
+    folder: str, default=None
+        folder of the binary conversion. If None *file*.npmap is used
+    Return
+    ------
+    dict:
+        - x: np.array of the spectra x values
+        - spectra: np.array or np.memmap (n_spectra, spectrum_y)
+        - coords: list of (x, y) coordinates as strings
+        - path: the memory mapped spectra file, None if not cached
+    """
+    if not cache:
+        x, xmap, ymap, spectra = read_jasco_map(file)
+        return dict(x=x, spectra=spectra, coords=list(zip(xmap, ymap)), path=None)
+
+    folder = folder or file + ".npmap"
+    try:
+        with open(os.path.join(folder, "meta.json")) as f:
+            uptodate = json.load(f) == _source_stamp(file)
+    except (OSError, ValueError):
+        uptodate = False
+    if not uptodate:
+        convert_map(file, folder, style)
+
+    path = os.path.join(folder, "spectra.npy")
+    coords = np.load(os.path.join(folder, "coords.npy"))
+    return dict(
+        x=np.load(os.path.join(folder, "x.npy")),
+        spectra=np.load(path, mmap_mode="r"),
+        coords=[tuple(c) for c in coords.tolist()],
+        path=path,
+        )
 
 def read_map(file, style = "jasko", split=250, save=True):
     """
     Read a mapping file uploading spectra in fityk.
+    The file is parsed once and each spectrum is loaded with load_data.
     -----------------------------------------------------------------
     file: str
         name of the file 
@@ -254,20 +499,22 @@ def read_map(file, style = "jasko", split=250, save=True):
         time
     save: bool, default=True
         save to file 
+    Return
+    ------
+    Fityk:
+        the session with the last loaded spectra
     """
     fk = Fityk()
     if style == "jasko":
-        with open(file) as f:
-            _ = [next(f) for i in range(13)]
-            xmap = list(map(float,next(f).split("\t")[1:]) )
-            ymap = list(map(float,next(f).split("\t")[1:]) )
-            points = len(xmap)
-        for i,(x,y) in enumerate(zip(xmap,ymap)):
-            s = f"@+ < '{file}:1:{i+2}::'"
-            fk.execute(s)
-            # rename dataset using positions
-            s = f"@{(fk.get_dataset_count()-1)}: title = '{x}:{y}'"
-            fk.execute(s)
+        x, xmap, ymap, spectra = read_jasco_map(file)
+        points = len(xmap)
+        dataset = 0
+        for i,(xm,ym,y) in enumerate(zip(xmap,ymap,spectra)):
+            #Fityk creates an empty dataset at position 0. Do not create a new one for dataset 0
+            if dataset!=0: fk.execute("@+ = 0")
+            # title using positions
+            fk.load_data(dataset, x, y, [], f"{float(xm)}:{float(ym)}")
+            dataset += 1
             if save and split and (((((i+1)%split) == 0) and i!=0) or i==(points-1)):
                 if "." in file:
                     pos = file.rfind(".")
@@ -276,11 +523,13 @@ def read_map(file, style = "jasko", split=250, save=True):
                     fname = file + f"_{i}"
                 save_session(fk,fname)
                 fk.execute("reset")
+                dataset = 0
     else:
         raise ValueError(f"Style {style} not recognized.")
         
     if save and (not split):
         save_session(fk,file)
+    return fk
 
 #-----------------------------------------------------------------
 # Save and export
@@ -350,3 +599,67 @@ def export_peaks(session, outfolder, errors = False):
                 s = f"@{i}: info peaks >'{outfolder}{title}.peaks'"
                 f.execute(s)
 
+def export_bundle(session, filename, errors=False, data=True, peaks=True, batch_size=100000):
+    """
+    Export data, components and peaks of all the datasets to a single 
+    columnar file instead of a file per dataset (see export_data and 
+    export_peaks). The values are read with NumPy (see get_data) and 
+    written in batches of **batch_size** rows with 
+    pyfityk.table.TableWriter, so the memory used is bounded.
+    -----------------------------------------------------------------
+    Inputs
+    ------
+    session
+        fityk object
+    filename: string
+        output file (.h5, .npz or .parquet). HDF5 and npz files contain the
+        'data' and 'peaks' tables, with Parquet a file is written per table
+        (filename_data.parquet, filename_peaks.parquet)
+    errors: bool, default=False
+        flag to export or not the parameter errors
+    data, peaks: bool, default=True
+        export the data (dataset, title, x, y, active, f0..fn, ftot) and
+        the peaks (dataset, title, fid, fname, Center, Height, Area, FWHM,
+        a0..an)
+    batch_size: int, default=100000
+        rows written at once
+    Return
+    ------
+    dict:
+        number of rows written for each table
+    """
+    f = session
+    n = f.get_dataset_count()
+    # the columns of a table are fixed, find the largest model first
+    components = [f.get_components(i) for i in range(n)]
+    n_funcs = max((len(c) for c in components), default=0)
+    n_params = max((len(get_func_params(func)) for c in components for func in c), default=0)
+    data_columns = ["dataset", "title", "x", "y", "active"] + [f"f{i}" for i in range(n_funcs)] + (["ftot"] if n_funcs else [])
+    pars = [f"a{i}" for i in range(n_params)]
+    if errors:
+        pars = [p for a in pars for p in (a, "err_" + a)]
+    peaks_columns = ["dataset", "title"] + PEAKS_COLUMNS + pars
+
+    rows = dict(data=0, peaks=0)
+    with TableWriter(filename, batch_size) as table:
+        for i in range(n):
+            title = f.get_info("title", i)
+            if data:
+                df = get_data(f, i)
+                df.insert(0, "title", title)
+                df.insert(0, "dataset", i)
+                table.append(df.reindex(columns=data_columns), key="data")
+                rows["data"] += len(df)
+            if peaks and len(components[i]):
+                try:
+                    text = f.get_info("peaks_err" if errors else "peaks", i)
+                except ExecuteError as e:
+                    print(f"WARNING! {e} Exporting peaks without errors for dataset @{i}.")
+                    text = f.get_info("peaks", i)
+                df = convert_peaks(text)
+                df.insert(0, "title", title)
+                df.insert(0, "dataset", i)
+                table.append(df.reindex(columns=peaks_columns), key="peaks")
+                rows["peaks"] += len(df)
+    return rows
+
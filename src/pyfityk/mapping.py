@@ -1,17 +1,114 @@
-from fityk import Fityk
+from fityk import Fityk, ExecuteError
 from sklearn.metrics.pairwise import pairwise_distances_argmin
-from scipy.stats import pearsonr
 from scipy.signal import savgol_filter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import multiprocessing as mp
+import queue
+from time import time, perf_counter
+import json
+import hashlib
+import shutil
 import pandas as pd
 import numpy as np
 from pyfityk.io import read_fityk_text
 from pyfityk.support import *
+from pyfityk.cache import DiskCache, default_cache_dir, hash_file, hash_key
+from pyfityk.table import TableWriter, table_parts
+from pyfityk.report import FitReport, CountingSession, Progress, stage
+from pyfityk.batchfit import parse_model, fit_settings, fit_spectra
 
 # -----------------------------------------------------------------
 # Help functions
 # -----------------------------------------------------------------
 
-def match_template(data_y, template_data, metric="pearsonr", normalize=True, smooth=True, baseline=True):
+def preprocess_spectra(data, normalize=True, smooth=True, baseline=True, window=50, polyorder=2, copy=True, dtype=np.float64, chunk_size=1024):
+    """
+    Preprocess spectra before the template matching. The steps work in
+    place on a single contiguous array, the smoothing is applied 
+    **chunk_size** spectra at a time to bound the memory used.
+
+    Input
+    ------
+    data: np.array (n_spectra, spectrum_y)
+        the spectra
+    baseline: bool, default=True
+        remove a costant baseline
+    smooth: bool, default=True
+        smooth data with a Savitzky-Golay filter
+    normalize: bool, default=True
+        normalize the data
+    window: int, default=50
+        window length of the Savitzky-Golay filter
+    polyorder: int, default=2
+        polynomial order of the Savitzky-Golay filter
+    copy: bool, default=True
+        if False and data is already a contiguous array of dtype, data is
+        modified in place
+    dtype: np.dtype, default=np.float64
+        dtype of the returned array
+    chunk_size: int, default=1024
+        number of spectra smoothed at once
+    Return
+    ------
+    numpy.array
+        the preprocessed spectra
+    """
+    if not (baseline or smooth or normalize):
+        return data
+    if copy:
+        data = np.array(data, dtype=dtype, order="C")
+    else:
+        data = np.ascontiguousarray(data, dtype=dtype)
+    if baseline:
+        data -= data.min(axis=1, keepdims=True)
+    if smooth:
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start+chunk_size]
+            chunk[:] = savgol_filter(chunk, window_length=window, polyorder=polyorder, mode='interp')
+    if normalize:
+        data /= data.max(axis=1, keepdims=True)
+    return data
+
+def _standardize(data, dtype):
+    """Returns the rows of data centered and scaled to unit norm"""
+    data = np.array(data, dtype=dtype)
+    data -= data.mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+    return data
+
+def pearson_match(data_y, template_data, chunk_size=1024, dtype=np.float64):
+    """
+    Finds the template with the highest Pearson correlation coefficient 
+    for each spectrum. The correlations are computed as a matrix product of
+    the standardized spectra, processing **chunk_size** spectra at a time.
+
+    Input
+    ------
+    data_y: np.array (n_spectra, spectrum_y)
+        the spectra to be matched
+    template_data: np.array (n_spectra, spectrum_y)
+        the template spectra used for matching
+    chunk_size: int, default=1024
+        number of spectra standardized and correlated at once. It bounds
+        the memory used to chunk_size*(spectrum_y + n_templates) values
+    dtype: np.dtype, default=np.float64
+        precision used for the computation (np.float32 or np.float64)
+    Return
+    ------
+    numpy.array
+        array of closest matches of template_data for each data_y
+    """
+    templates = _standardize(template_data, dtype)
+    ids = np.empty(len(data_y), dtype=np.intp)
+    for start in range(0, len(data_y), chunk_size):
+        r = _standardize(data_y[start:start+chunk_size], dtype) @ templates.T
+        # as np.argmin of 1-r, the first nan (constant spectra) is returned
+        ids[start:start+chunk_size] = np.argmax(r, axis=1)
+    return ids
+
+def match_template(data_y, template_data, metric="pearsonr", normalize=True, smooth=True, baseline=True, template_preprocessed=False, chunk_size=1024, dtype=np.float64, window=50, polyorder=2):
     """
     Finds the spectrum in template_data that is most similar to each one in 
     data_y. Metric is the method used for the matching.
@@ -42,28 +139,143 @@ def match_template(data_y, template_data, metric="pearsonr", normalize=True, smo
         smooth data before computing the distance
     normalize: bool, default=True
         normalize the data before computing the distance
+    template_preprocessed: bool, default=False
+        if True template_data is already preprocessed (see preprocess_spectra)
+    chunk_size: int, default=1024
+        number of spectra preprocessed and matched at once
+    dtype: np.dtype, default=np.float64
+        precision used by the pearsonr metric and the preprocessing 
+        (np.float32 or np.float64)
+    window, polyorder: int, default=50, 2
+        Savitzky-Golay filter settings used when smooth is True
     Return
     ------
     numpy.array
         array of closest matches of template_data for each data_y
     """
-    if baseline:
-        template_data = np.array([s-s.min()for s in template_data])
-        data_y = np.array([s-s.min()for s in data_y])
-    if smooth:
-        win = 50
-        template_data = savgol_filter(template_data, window_length=win, polyorder=2, mode='interp')
-        data_y = savgol_filter(data_y, window_length=win, polyorder=2, mode='interp')
-    if normalize:
-        template_data = np.array([s/s.max()for s in template_data])
-        data_y = np.array([s/s.max()for s in data_y])
+    options = dict(normalize=normalize, smooth=smooth, baseline=baseline, window=window, polyorder=polyorder, dtype=dtype, chunk_size=chunk_size)
+    if not template_preprocessed:
+        template_data = preprocess_spectra(template_data, **options)
 
-    #compute distance
-    if metric == "pearsonr":
-        return np.array([np.argmin([1 - pearsonr(y, ref)[0] for ref in template_data]) for y in data_y]) 
-    else:
-        return pairwise_distances_argmin(data_y, template_data, metric=metric)
+    # the preprocessing works on a copy: the spectra are preprocessed and
+    # matched chunk_size rows at a time, so a memory mapped map is never
+    # copied to RAM at once
+    ids = np.empty(len(data_y), dtype=np.intp)
+    for start in range(0, len(data_y), chunk_size):
+        chunk = preprocess_spectra(data_y[start:start+chunk_size], **options)
+        #compute distance
+        if metric == "pearsonr":
+            ids[start:start+chunk_size] = pearson_match(chunk, template_data, chunk_size, dtype)
+        else:
+            ids[start:start+chunk_size] = pairwise_distances_argmin(chunk, template_data, metric=metric)
+    return ids
+
+def compile_template(template_file, normalize=False, smooth=False, baseline=False, window=50, polyorder=2):
+    """
+    Reads a template file and prepares everything fitMap needs from it.
+
+    Input
+    ------
+    template_file: str
+        name of a Fityk file used as template
+    normalize, smooth, baseline: bool
+        preprocessing applied to the template spectra for the matching
+    window, polyorder: int, default=50, 2
+        Savitzky-Golay filter settings used when smooth is True
+    Return
+    ------
+    dict:
+        - initials: defines and sets (see get_session_initials)
+        - template: list of the template datasets (see read_fityk_text).
+          Each element has also the compiled active mask in "mask"
+        - template_y: np.array of the preprocessed template spectra
+    """
+    session = Fityk()
+    session.execute(f"exec '{template_file}'")
+    initials = get_session_initials(session)
+
+    #TODO: once read_fityk is properly implemented to read limits and constants merge it with the above part of defines 
+    template = read_fityk_text(template_file)
+    for d in template:
+        d["mask"] = compile_active_mask(d["data"]["active"])
+    template_y = np.array([d["data"]["y"] for d in template], dtype=float)
+    template_y = preprocess_spectra(template_y, normalize, smooth, baseline, window, polyorder, copy=False)
+    return dict(initials=initials, template=template, template_y=template_y)
+
+# version of the compile_template output, change it to invalidate the cache
+TEMPLATE_CACHE_VERSION = 1
+
+def load_template(template_file, cache=None, **options):
+    """
+    Compiled template (see compile_template) loaded from an on disk cache.
+    The cache is keyed by the file content and the preprocessing options.
+
+    Input
+    ------
+    template_file: str
+        name of a Fityk file used as template
+    cache: str, bool or DiskCache, default=None
+        cache to use. If True the default cache folder is used, if a string
+        it is used as the cache folder. None or False disable the cache
+    options:
+        preprocessing options passed to compile_template
+    Return
+    ------
+    dict:
+        see compile_template
+    """
+    if not cache:
+        return compile_template(template_file, **options)
+    if not isinstance(cache, DiskCache):
+        folder = default_cache_dir() if cache is True else cache
+        cache = DiskCache(os.path.join(folder, "templates"))
+    # the compiled template pickles DataFrames and arrays
+    key = hash_key("template", TEMPLATE_CACHE_VERSION, hash_file(template_file), sorted(options.items()), pd.__version__, np.__version__)
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = compile_template(template_file, **options)
+        cache.put(key, compiled)
+    return compiled
+
+# version of the fitted functions cached by fitMap, change it to invalidate the cache
+FIT_CACHE_VERSION = 3
+
+def fit_key(x, y, template, initials, fit=True, seed=None, coarse=1, backend="fityk"):
+    """
+    Key of the fit of a spectrum in the fit cache. It is the hash of the
+    x, y arrays, the template model and active mask, the defines and sets 
+    of the session (verbosity excluded), the fit flag and the warm start 
+    seed.
+
+    Input
+    ------
+    x,y: array like of floats
+    template: dict
+        template element used for the spectrum (see compile_template)
+    initials: dict
+        defines and sets as returned by get_session_initials
+    fit: bool, default=True
+    seed: tuple, default=None
+        warm start (functions, fitted WSSR of the seed spectrum), see 
+        fitSpectrum
+    coarse: int, default=1
+        binning factor of the coarse fit (see fitSpectrum)
+    backend: str, default="fityk"
+        fitting backend (see fitMap)
+    Return
+    ------
+    str
+    """
+    h = hashlib.sha256(np.ascontiguousarray(x, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(y, dtype=float).tobytes())
+    mask = template.get("mask") or compile_active_mask(template["data"]["active"])
+    sets = re.sub(r"set verbosity = .*?;", "", initials["sets"])
+    return hash_key("fit", FIT_CACHE_VERSION, h.hexdigest(), template["model"], mask, initials["defines"], sets, bool(fit), seed, int(coarse), backend)
 
+def fit_cache_folder(cache):
+    """Folder of the fit cache: the default cache folder if **cache** is
+    True, else **cache**"""
+    return os.path.join(default_cache_dir() if cache is True else cache, "fits")
 
 def edit_filename(filename, obj, replace=False):
     """Edits filename. If replace==True **obj** will replace the extension.
@@ -83,7 +295,42 @@ def edit_filename(filename, obj, replace=False):
 # Fitting
 # -----------------------------------------------------------------
 
-def fitSpectrum(session, buffer_session, x, y, template, dataset, fit=True):
+def bin_spectrum(x, y, active, factor):
+    """
+    Bins a spectrum averaging **factor** consecutive points. The last 
+    points are dropped if the length is not a multiple of factor. A bin 
+    is active only if all its points are active.
+
+    Return
+    ------
+    tuple:
+        (x, y, active) of the binned spectrum
+    """
+    n = len(x)//factor*factor
+    xb = np.asarray(x, dtype=float)[:n].reshape(-1, factor).mean(axis=1)
+    yb = np.asarray(y, dtype=float)[:n].reshape(-1, factor).mean(axis=1)
+    ab = np.asarray(active, dtype=bool)[:n].reshape(-1, factor).all(axis=1)
+    return xb, yb, ab
+
+def _coarse_fit(buffer_session, x, y, active, mask, factor):
+    """Fits the model of the buffer dataset 0 on the spectrum binned by 
+    **factor**, then reloads the full resolution data with the result as 
+    starting model"""
+    start = format_functions(buffer_session, 0)
+    xb, yb, ab = bin_spectrum(x, y, active, factor)
+    buffer_session.load_data(0, xb, yb, [])
+    deactivate_points(buffer_session, ab, 0)
+    set_functions(buffer_session, 0, start)
+    try:
+        buffer_session.execute("@0: fit")
+    except ExecuteError:
+        pass
+    result = format_functions(buffer_session, 0)
+    buffer_session.load_data(0, x, y, [])
+    buffer_session.execute(f"@0: {mask}")
+    set_functions(buffer_session, 0, result)
+
+def fitSpectrum(session, buffer_session, x, y, template, dataset, fit=True, seed=None, stats=None, report=None, coarse=1, seed_wssr=None, fallback_ratio=2.):
     """
     Fit a spectrum using a buffer session and adds is to another session.
     
@@ -98,25 +345,918 @@ def fitSpectrum(session, buffer_session, x, y, template, dataset, fit=True):
         index of the dataset
     fit: bool, default=True
         flag used to enable/disable the spectra fit once the template is loaded
+    seed: dict, default=None
+        fitted functions of another spectrum (as returned by this function)
+        used as starting point instead of the template model (warm start).
+        The template model is used if it starts from a lower WSSR.
+    stats: dict, default=None
+        if passed, the counters 'fits', 'warm_starts', 'fallback_fits', 
+        'fallbacks' and the 'fit_time' (s) of cold and warm started fits 
+        are incremented. Fityk does not expose the number of iterations
+    report: pyfityk.report.FitReport, default=None
+        if passed, the time of the stages (load_data, deactivate_points,
+        model, fit, read_functions, transfer) is added to the report. If 
+        stats is None the report counters are used as stats
+    coarse: int, default=1
+        if larger than 1, the spectrum binned by **coarse** points is fitted
+        first (see bin_spectrum) and the result is refined on the full 
+        resolution spectrum. The first iterations, far from the minimum, 
+        are cheaper
+    seed_wssr: float, default=None
+        fitted WSSR of the spectrum the seed comes from. If the warm 
+        started fit ends above fallback_ratio*seed_wssr the spectrum is 
+        fitted again from the template model and the result with the lower 
+        WSSR is kept ('fallback_fits' and, if the template wins, 'fallbacks')
+    fallback_ratio: float, default=2.
+    Return
+    ------
+    dict:
+        the fitted functions as returned by pyfityk.support.format_functions
     """
-    buffer_session.load_data(0, x, y, []) #dataset n, x, y, sigma
-    active = template["data"]["active"]
+    if stats is None and report is not None:
+        stats = report.counters
+    with stage(report, "load_data"):
+        buffer_session.load_data(0, x, y, []) #dataset n, x, y, sigma
+    mask = template.get("mask") or compile_active_mask(template["data"]["active"])
     model = template["model"]
-    deactivate_points(buffer_session, active, 0)
-    deactivate_points(session, active, dataset)
-    if model != 0:
-        buffer_session.execute("F="+model)
+    with stage(report, "deactivate_points"):
+        buffer_session.execute(f"@0: {mask}")
+        session.execute(f"@{dataset}: {mask}")
+    with stage(report, "model"):
+        if model != 0:
+            buffer_session.execute("F="+model)
+
+        warm = False
+        if fit and seed and model != 0:
+            wssr_template = buffer_session.get_wssr(0)
+            seed_model = " + ".join(seed.values())
+            buffer_session.execute("F="+seed_model)
+            warm = buffer_session.get_wssr(0) < wssr_template
+            if not warm:
+                buffer_session.execute("F="+model)
     if fit:
+        t = time()
+        if coarse > 1 and model != 0 and len(x) >= 4*coarse:
+            with stage(report, "coarse_fit"):
+                _coarse_fit(buffer_session, x, y, template["data"]["active"], mask, coarse)
+        with stage(report, "fit"):
+            try:
+                buffer_session.execute("@0: fit")
+            except:
+                print("No fittable parameters.")
+            wssr_warm = buffer_session.get_wssr(0) if warm and seed_wssr is not None else None
+            if wssr_warm is not None and wssr_warm > fallback_ratio*seed_wssr:
+                # much worse than the seed spectrum: the warm start may be
+                # stuck in another minimum, compare with the template fit
+                warm_funcs = format_functions(buffer_session, 0)
+                buffer_session.execute("F="+model)
+                try:
+                    buffer_session.execute("@0: fit")
+                except ExecuteError:
+                    pass
+                if stats is not None:
+                    stats["fallback_fits"] = stats.get("fallback_fits", 0) + 1
+                if buffer_session.get_wssr(0) < wssr_warm:
+                    if stats is not None:
+                        stats["fallbacks"] = stats.get("fallbacks", 0) + 1
+                else:
+                    set_functions(buffer_session, 0, warm_funcs)
+        if stats is not None:
+            kind = "warm" if warm else "cold"
+            stats["fits"] = stats.get("fits", 0) + 1
+            stats["warm_starts"] = stats.get("warm_starts", 0) + warm
+            stats[f"fit_time_{kind}"] = stats.get(f"fit_time_{kind}", 0) + time() - t
+    with stage(report, "read_functions"):
+        funcs = format_functions(buffer_session, 0)
+    with stage(report, "transfer"):
+        set_functions(session, dataset, funcs)
+    return funcs
+
+def set_functions(session, dataset, funcs):
+    """Replaces the model of a dataset with the functions (as returned by
+    pyfityk.support.format_functions) in a single command"""
+    session.execute(f"@{dataset}: F = {' + '.join(funcs.values()) or 0}")
+
+def restore_spectrum(session, dataset, x, y, title, active, funcs):
+    """
+    Adds an already fitted spectrum to a session without fitting it again.
+
+    Inputs
+    ------
+    session: Fityk
+    dataset: int
+        index of the dataset. A new dataset is created if dataset!=0
+    x,y: array like of floats
+    title: str
+        title of the dataset
+    active: array(bool)
+        bolean array for each point of the data
+    funcs: dict
+        functions as returned by pyfityk.support.format_functions
+    """
+    if dataset!=0: session.execute("@+ = 0")
+    session.load_data(dataset, x, y, [], title)
+    deactivate_points(session, active, dataset)
+    if funcs:
+        set_functions(session, dataset, funcs)
+
+def init_session(session, initials):
+    """Set defines and sets obtained from get_session_initials in a session"""
+    set_define_functions(session, initials["defines"])
+    session.execute(initials["sets"])
+
+# -----------------------------------------------------------------
+# Parameters table
+# -----------------------------------------------------------------
+
+def table_columns(n_params):
+    """Columns of the parameters table written by fitMap for functions with
+    up to **n_params** parameters"""
+    return (["spectrum", "title", "x", "y", "templ_id", "fid", "fname", "Center", "Height", "Area", "FWHM"]
+        + [f"a{i}" for i in range(n_params)] + [f"err_a{i}" for i in range(n_params)]
+        + ["wssr", "rsquared", "dof"])
+
+def _max_params(template):
+    """Maximum number of parameters of the template functions"""
+    n = [sum(1 for c in d["functions"].columns if re.fullmatch(r"a\d+", str(c))) for d in template if d["functions"] is not None]
+    return max(n, default=0)
+
+def param_rows(session, dataset, index, title, coord, templ_id, n_params):
+    """
+    Rows of the parameters table for a fitted dataset, one per function.
+
+    Inputs
+    ------
+    session: Fityk
+    dataset: int
+        index of the dataset in the session
+    index: int
+        index of the spectrum in the map
+    title: str
+        title of the dataset
+    coord: tuple
+        map coordinates of the spectrum. They are converted to float (NaN
+        if not numeric)
+    templ_id: int
+        matched template index
+    n_params: int
+        number of parameters columns (see table_columns)
+    Return
+    ------
+    pd.DataFrame or None
+        None if the dataset has no functions
+    """
+    if not session.get_components(dataset):
+        return None
+    try:
+        peaks = session.get_info("peaks_err", dataset)
+    except ExecuteError:
+        # no parametrized functions
+        peaks = session.get_info("peaks", dataset)
+    df = convert_peaks(peaks)
+    columns = table_columns(n_params)
+    numeric = columns[7:-3]
+    df = df.reindex(columns=columns)
+    df[numeric] = df[numeric].astype(float)
+    def as_float(c):
         try:
-            buffer_session.execute(f"@0: fit")
-        except:
-            print("No fittable parameters.")
-    funcs = read_functions(buffer_session, 0)
-    session.execute(f"@{dataset}.F=0") #reset functions
-    for func in funcs.values():
-        session.execute(f"@{dataset}.F+={func}")
+            return float(c)
+        except (ValueError, TypeError):
+            return np.nan
+    xy = (list(coord) if isinstance(coord, tuple) else [coord]) + [None, None]
+    df["spectrum"] = index
+    df["title"] = title
+    df["x"], df["y"] = as_float(xy[0]), as_float(xy[1])
+    df["templ_id"] = int(templ_id)
+    df["wssr"] = session.get_wssr(dataset)
+    df["rsquared"] = session.get_rsquared(dataset)
+    df["dof"] = session.get_dof(dataset)
+    return df
 
-def fitMap(x, y_spectra, template_file, fileout="", verbosity=-1, split=0, fit=True, match_method="pearsonr", match_preprocess=False):
+# -----------------------------------------------------------------
+# Checkpoint journal
+# -----------------------------------------------------------------
+
+def journal_folder(fileout):
+    """Folder of the checkpoint journal of a fitMap output file"""
+    return fileout + ".journal"
+
+def _open_journal(fileout, start):
+    # each block (and process) appends to its own file
+    folder = journal_folder(fileout)
+    os.makedirs(folder, exist_ok=True)
+    return open(os.path.join(folder, f"{start}.jsonl"), "a")
+
+def remove_journal(fileout):
+    """Removes the checkpoint journal of a fitMap output file, if any"""
+    if fileout!="" and os.path.isdir(journal_folder(fileout)):
+        shutil.rmtree(journal_folder(fileout))
+
+def _write_journal(journal, **entry):
+    journal.write(json.dumps(entry) + "\n")
+    journal.flush()
+
+def read_journal(fileout):
+    """
+    Read the checkpoint journal written by fitMap.
+
+    Input
+    ------
+    fileout: str
+        fitMap output file
+    Return
+    ------
+    tuple:
+        (done, saved) where done is a dict {spectrum index: entry} of the
+        completed spectra (entry has title, templ_id, funcs and status) 
+        and saved is the set of the split files completely saved.
+    """
+    done, saved = {}, set()
+    folder = journal_folder(fileout)
+    if not os.path.isdir(folder):
+        return done, saved
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # line truncated by a crash
+                    continue
+                if "saved" in entry:
+                    if os.path.isfile(entry["saved"]):
+                        saved.add(entry["saved"])
+                else:
+                    done[entry["i"]] = entry
+    return done, saved
+
+# -----------------------------------------------------------------
+# Batched fit
+# -----------------------------------------------------------------
+
+# spectra fitted at once by the numpy backend
+BATCH_SIZE = 256
+
+def batch_fit(x, ys, templ_ids, template, initials, cache=None, report=None):
+    """
+    Fits spectra with the batched Levenberg-Marquardt of pyfityk.batchfit,
+    grouping them by template. Only the templates whose model has just
+    Constant, polynomials, Gaussian, Lorentzian and PseudoVoigt functions
+    with simple or constant parameters are supported.
+
+    Inputs
+    ------
+    x: np.array of float
+    ys: dict
+        {key: spectrum y} of the spectra to fit
+    templ_ids: dict
+        {key: matched template index}
+    template: list of dict
+        template (see compile_template)
+    initials: dict
+        defines and sets (see get_session_initials). The weights and the
+        Levenberg-Marquardt settings are read from the sets
+    cache: DiskCache, default=None
+        fit cache (see fit_key). The spectra found are not fitted
+    report: pyfityk.report.FitReport, default=None
+        the counters 'batch_fits', 'batch_failed' and the cache hits and
+        misses are incremented
+    Return
+    ------
+    dict:
+        {key: functions (as returned by pyfityk.support.format_functions)}
+        of the spectra fitted or found in the cache. The spectra of not
+        supported templates and the failed fits are missing
+    """
+    stats = report.counters if report is not None else {}
+    settings = fit_settings(initials["sets"])
+    models = {}
+    groups = {}
+    for key, templ_id in templ_ids.items():
+        if templ_id not in models:
+            models[templ_id] = parse_model(template[templ_id]["model"])
+        if models[templ_id] is not None:
+            groups.setdefault(templ_id, []).append(key)
+
+    out = {}
+    for templ_id, keys in groups.items():
+        model = models[templ_id]
+        match = template[templ_id]
+        if cache:
+            hashes = {key:fit_key(x, ys[key], match, initials, True, None, 1, "numpy") for key in keys}
+            missing = []
+            for key in keys:
+                funcs = cache.get(hashes[key])
+                if funcs is None:
+                    missing.append(key)
+                else:
+                    out[key] = funcs
+            stats["cache_hits"] = stats.get("cache_hits", 0) + len(keys) - len(missing)
+            keys = missing
+        active = np.asarray(match["data"]["active"], dtype=bool)
+        for i in range(0, len(keys), BATCH_SIZE):
+            chunk = keys[i:i+BATCH_SIZE]
+            y = np.array([ys[key] for key in chunk], dtype=float)
+            params, _, ok = fit_spectra(model, x, y, active, settings)
+            for key, p, success in zip(chunk, params, ok):
+                if not success:
+                    continue
+                out[key] = model.format(p)
+                if cache:
+                    cache.put(hashes[key], out[key])
+            stats["batch_fits"] = stats.get("batch_fits", 0) + int(ok.sum())
+            stats["batch_failed"] = stats.get("batch_failed", 0) + int((~ok).sum())
+            if cache:
+                stats["cache_misses"] = stats.get("cache_misses", 0) + len(chunk)
+    return out
+
+# -----------------------------------------------------------------
+# Background writer
+# -----------------------------------------------------------------
+
+def _state_writer(jobs, finished, x, initials, actives):
+    """Writer process: rebuilds each chunk of spectra in its own session
+    and saves it, until None is received"""
+    session = Fityk()
+    init_session(session, initials)
+    while (job := jobs.get()) is not None:
+        fout, stop, records = job
+        t = perf_counter()
+        try:
+            for dataset, (title, y, templ_id, funcs) in enumerate(records):
+                restore_spectrum(session, dataset, x, y, title, actives[templ_id], funcs)
+            session.execute(f"info state > '{fout}'")
+            session.execute("reset")
+            init_session(session, initials)
+            finished.put((fout, stop, perf_counter() - t, None))
+        except Exception as e:
+            finished.put((fout, stop, perf_counter() - t, f"{type(e).__name__}: {e}"))
+            session = Fityk()
+            init_session(session, initials)
+
+class StateWriter:
+    """
+    Saves the split files of fitMap in a background process, so that the
+    fit of the next chunk overlaps with the save. The chunks are passed as
+    records (title, y, template id, functions) through a bounded queue and
+    the process rebuilds them in its own Fityk session.
+
+    Inputs
+    ------
+    x: np.array of float
+        spectra x values
+    initials: dict
+        defines and sets (see get_session_initials)
+    actives: list of np.array of bool
+        active points of each template
+    on_saved: function, default=None
+        called as on_saved(fout, stop, seconds) for each saved file
+    max_pending: int, default=2
+        chunks waiting to be saved. submit blocks when the queue is full
+    report: pyfityk.report.FitReport, default=None
+        if passed, the time waited for the queue ('save_wait') and spent
+        by the writer ('save_background') are added to the report
+
+    Use it as a context manager: on exit the chunks already submitted are
+    saved (also on error) and the process is stopped.
+    """
+
+    def __init__(self, x, initials, actives, on_saved=None, max_pending=2, report=None):
+        self.on_saved = on_saved
+        self.report = report
+        self.pending = 0
+        self.errors = []
+        self.jobs = mp.Queue(max_pending)
+        self.finished = mp.Queue()
+        actives = [np.asarray(a, dtype=bool) for a in actives]
+        self.process = mp.Process(target=_state_writer, args=(self.jobs, self.finished, x, initials, actives), daemon=True)
+        self.process.start()
+
+    def submit(self, fout, stop, records):
+        """Queues the records of a chunk to be saved in **fout**"""
+        self.poll()
+        with stage(self.report, "save_wait"):
+            self._put((fout, stop, records))
+        self.pending += 1
+
+    def _put(self, job):
+        # blocks while the queue is full, unless the process died
+        while True:
+            if not self.process.is_alive():
+                raise RuntimeError("The state writer process is not running.")
+            try:
+                self.jobs.put(job, timeout=0.5)
+                return
+            except queue.Full:
+                self.poll()
+
+    def poll(self, timeout=None):
+        """Handles the saved chunks. With a timeout waits at most timeout
+        seconds for one"""
+        while self.pending:
+            try:
+                if timeout is None:
+                    fout, stop, seconds, error = self.finished.get_nowait()
+                else:
+                    fout, stop, seconds, error = self.finished.get(timeout=timeout)
+            except queue.Empty:
+                return
+            self.pending -= 1
+            if self.report is not None:
+                self.report.add_stage("save_background", seconds)
+            if error:
+                self.errors.append(f"{fout}: {error}")
+            elif self.on_saved:
+                self.on_saved(fout, stop, seconds)
+
+    def close(self):
+        """Waits for the submitted chunks and stops the process. Raises
+        RuntimeError if a chunk could not be saved"""
+        with stage(self.report, "save_wait"):
+            try:
+                self._put(None)
+            except RuntimeError:
+                pass
+            while self.pending and (self.process.is_alive() or not self.finished.empty()):
+                self.poll(timeout=0.1)
+            self.process.join()
+        if self.pending:
+            self.errors.append(f"writer process stopped with {self.pending} chunks not saved")
+        if self.errors:
+            raise RuntimeError("Saving failed: " + "; ".join(self.errors))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.close()
+        except RuntimeError:
+            if exc_type is None:
+                raise
+        return False
+
+def _fit_block(x, ys, coords, templ_ids, template, initials, options, start=0, rows=None, collect=False):
+    """
+    Fit a block of consecutive spectra of a map. Used by fitMap both for
+    the serial and the parallel execution.
+
+    Inputs
+    ------
+    x: array-like of float
+        spectra x values
+    ys: np.array (n_spectra, spectrum_y)
+        the spectra, one per row
+    coords: list of tuple of str
+        coordinates of each spectrum, used for the titles
+    templ_ids: array-like of int
+        matched template index for each spectrum
+    template: list of dict
+        template as returned by pyfityk.io.read_fityk_text
+    initials: dict
+        defines and sets as returned by get_session_initials
+    options: dict
+        fitMap options: fileout, split, fit, warm_start, coarse, backend, 
+        journal and the total number of spectra (None if unknown). On 
+        resume also the spectra already done ('done', see read_journal) 
+        and the saved split files ('saved').
+        With 'fit_cache' (a DiskCache, built once by fitMap and shared by
+        the blocks) the fitted functions are cached (see fit_key). With 'table' the parameters table is written (see 
+        param_rows) in batches of 'table_batch' rows, in a part file per 
+        block if 'table_parts' is set. With 'background_save' the split 
+        files are saved by a StateWriter process
+    start: int, default=0
+        index of the first spectrum of the block in the whole map. It is
+        used to name the split files.
+    rows: array-like of int, default=None
+        rows of ys to fit, in order. If None all the rows are fitted
+    collect: bool, default=False
+        if True the fitted functions of each spectrum are returned
+    Return
+    ------
+    dict:
+        - records: if **collect** a list of (title, template id, functions)
+        - report: pyfityk.report.FitReport of the block
+    """
+    fileout, split = options["fileout"], options["split"]
+    report = FitReport()
+    session = CountingSession(Fityk(), report)
+    buffer_session = CountingSession(Fityk(), report)
+
+    #initial general sets for sessions 
+    for f in [session, buffer_session]:
+        init_session(f, initials)
+
+    records = []
+    stats = report.counters
+    seeds = {} # last fitted (functions, WSSR) for each template, used for warm start
+    journal = _open_journal(fileout, start) if options["journal"] else None
+    done = options.get("done", {})
+    cache = options.get("fit_cache")
+    table = None
+    if options.get("table"):
+        tfile = edit_filename(options["table"], start) if options.get("table_parts") else options["table"]
+        table = TableWriter(tfile, options["table_batch"], table_columns(options["n_params"]))
+    label = f"[{start}:{start+len(coords)}] " if options.get("parallel") else ""
+    progress = Progress(len(coords), options.get("progress", 5.), label)
+
+    def saved(fout, stop, seconds=0.):
+        if journal:
+            _write_journal(journal, saved=fout, stop=stop)
+
+    writer = None
+    chunk = [] # records of the current split file, saved by the writer
+    if options.get("background_save") and split and fileout!="" and not collect:
+        actives = [d["data"]["active"].to_numpy() for d in template]
+        writer = StateWriter(x, initials, actives, saved, report=report)
+
+    def save(fout, stop):
+        if writer:
+            writer.submit(fout, stop, list(chunk))
+            chunk.clear()
+            return
+        with report.stage("save"):
+            session.execute(f"info state > '{fout}'")
+        saved(fout, stop)
+
+    def chunk_file(i):
+        # split file containing the spectrum i
+        stop = i - i%split + split
+        return edit_filename(fileout, stop if options["total"] is None else min(stop, options["total"]))
+
+    prefit = {}
+    if options.get("backend") == "numpy" and options["fit"]:
+        # fit at once the spectra not restored from a previous run
+        pending = {}
+        for k, (templ_id, coord) in enumerate(zip(templ_ids, coords)):
+            i = start + k
+            if split and fileout!="" and chunk_file(i) in options.get("saved", ()):
+                continue
+            record = done.get(i)
+            if record is not None and record["title"] == ";".join(coord) + f";ID-{templ_id}":
+                continue
+            pending[k] = templ_id
+        spectra = {k:ys[k if rows is None else rows[k]] for k in pending}
+        with report.stage("batch_fit"):
+            prefit = batch_fit(x, spectra, pending, template, initials, cache, report)
+        del spectra
+
+    with writer or nullcontext():
+        i = start - 1
+        for k, (templ_id, coord) in enumerate(zip(templ_ids, coords)):
+            i = start + k
+            dataset_idx = i%split if split else k
+            if split and fileout!="" and chunk_file(i) in options.get("saved", ()):
+                # the whole split file was already saved by a previous run
+                continue
+            t = perf_counter()
+
+            # fityk accepts only float arrays    
+            y = np.asarray(ys[k if rows is None else rows[k]], dtype=float)
+            match = template[templ_id]
+            title = ";".join(coord) + f";ID-{templ_id}"
+            record = done.get(i)
+            if record is not None and record["title"] == title:
+                # fitted by a previous run
+                funcs = record["funcs"]
+                with report.stage("restore"):
+                    restore_spectrum(session, dataset_idx, x, y, title, match["data"]["active"], funcs)
+            else:
+                if k in prefit:
+                    # fitted by the numpy backend
+                    funcs = prefit.pop(k)
+                    with report.stage("restore"):
+                        restore_spectrum(session, dataset_idx, x, y, title, match["data"]["active"], funcs)
+                else:
+                    seed, seed_wssr = seeds.get(templ_id, (None, None))
+                    with report.stage("cache"):
+                        key = fit_key(x, y, match, initials, options["fit"], seed and (seed, seed_wssr), options.get("coarse", 1)) if cache else None
+                        funcs = cache.get(key) if cache else None
+                    if funcs is not None:
+                        # same spectrum fitted with the same settings by a previous run
+                        stats["cache_hits"] = stats.get("cache_hits", 0) + 1
+                        with report.stage("restore"):
+                            restore_spectrum(session, dataset_idx, x, y, title, match["data"]["active"], funcs)
+                    else:
+                        with report.stage("load_data"):
+                            #Fityk creates an empty dataset at position 0. Do not create a new one for dataset 0
+                            if dataset_idx!=0: session.execute("@+ = 0")
+                            session.load_data(dataset_idx, x, y, [], title)
+                        funcs = fitSpectrum(session, buffer_session, x, y, match, dataset_idx, options["fit"], seed, stats, report, options.get("coarse", 1), seed_wssr)
+                        if cache:
+                            stats["cache_misses"] = stats.get("cache_misses", 0) + 1
+                            with report.stage("cache"):
+                                cache.put(key, funcs)
+                if journal:
+                    with report.stage("journal"):
+                        _write_journal(journal, i=i, title=title, templ_id=int(templ_id), funcs=funcs, status="fitted" if options["fit"] else "template")
+            if options["warm_start"]:
+                seeds[templ_id] = (funcs, session.get_wssr(dataset_idx))
+            if table:
+                with report.stage("table"):
+                    table.append(param_rows(session, dataset_idx, i, title, coord, templ_id, options["n_params"]))
+            if collect:
+                records.append((title, templ_id, funcs))
+            if writer:
+                chunk.append((title, y, templ_id, funcs))
+            report.spectrum(i, title, perf_counter() - t)
+            progress.update(k+1)
+            if (fileout!="") and split and ((i+1)%split == 0):
+                fout = edit_filename(fileout, i+1)
+                save(fout, i+1)
+                session.execute("reset")
+                init_session(session, initials)
+        if fileout!="" and not collect:
+            if split:
+                if (i+1)%split != 0 and chunk_file(i) not in options.get("saved", ()):
+                    fout = edit_filename(fileout, i+1)
+                    save(fout, i+1)
+            else:
+                save(fileout, i+1)
+    if journal:
+        journal.close()
+    if table:
+        with report.stage("table"):
+            table.close()
+    progress.update(len(coords), force=True)
+    return dict(records=records, report=report)
+
+# State shared by the fitMap worker processes, set once by _init_worker
+_worker_state = {}
+
+def _init_worker(x, template, initials, options):
+    _worker_state.update(x=x, template=template, initials=initials, options=options)
+
+def _fit_shard(ys, coords, templ_ids, start, rows, collect):
+    """Fits a shard of spectra in a worker process"""
+    s = _worker_state
+    if isinstance(ys, str):
+        # memory mapped spectra, read only the rows of the shard
+        ys = np.load(ys, mmap_mode="r")
+        ys = ys[start:start+len(coords)] if rows is None else ys[np.sort(rows)]
+        if rows is not None:
+            rows = np.searchsorted(np.sort(rows), rows)
+    return _fit_block(s["x"], ys, coords, templ_ids, s["template"], s["initials"], s["options"], start, rows, collect)
+
+def _spectra_input(y_spectra):
+    """
+    Returns the spectra passed to fitMap as (spectra, coordinates, path).
+    spectra is an array-like (n_spectra, spectrum_y), path is the memory
+    mapped spectra file or None.
+    """
+    if isinstance(y_spectra, pd.DataFrame):
+        return y_spectra.T.values, list(y_spectra.columns), None
+    if isinstance(y_spectra, dict):
+        return y_spectra["spectra"], y_spectra["coords"], y_spectra.get("path")
+    if _is_array(y_spectra):
+        return y_spectra, _default_coords(y_spectra.shape[0]), None
+    raise TypeError("y_spectra must be a pd.DataFrame, a map opened with pyfityk.io.open_map, a 2D array or an iterable of blocks")
+
+# -----------------------------------------------------------------
+# Chunked input
+# -----------------------------------------------------------------
+
+# spectra read at once from the chunked inputs (see fitMap chunk_size)
+CHUNK_SIZE = 1024
+
+def _is_array(y_spectra):
+    """2D array-like: np.array, np.memmap, HDF5 dataset..."""
+    return hasattr(y_spectra, "shape") and len(y_spectra.shape) == 2 and not isinstance(y_spectra, pd.DataFrame)
+
+def _is_indexable(y_spectra):
+    return isinstance(y_spectra, (pd.DataFrame, dict)) or _is_array(y_spectra)
+
+def _input_length(y_spectra):
+    """Number of spectra of an indexable input, None for the iterables"""
+    if isinstance(y_spectra, pd.DataFrame):
+        return y_spectra.shape[1]
+    if isinstance(y_spectra, dict):
+        return len(y_spectra["coords"])
+    if _is_array(y_spectra):
+        return y_spectra.shape[0]
+    return None
+
+def _default_coords(n):
+    """Coordinates of spectra passed without them: their index"""
+    return [(str(i),) for i in range(n)]
+
+def _read_rows(spectra, rows):
+    """
+    Reads the rows of an array-like of spectra (np.array, np.memmap, HDF5
+    dataset...) in a float array, in the order of **rows**. Consecutive
+    rows are read as a slice, the others in increasing order as required
+    by h5py.
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    if len(rows) == 0:
+        return np.empty((0, spectra.shape[1]))
+    order = np.argsort(rows, kind="stable")
+    ordered = rows[order]
+    if ordered[-1] - ordered[0] + 1 == len(rows):
+        block = spectra[int(ordered[0]):int(ordered[-1])+1]
+    else:
+        block = spectra[ordered.tolist()]
+    out = np.empty((len(rows), spectra.shape[1]))
+    out[order] = np.asarray(block, dtype=float)
+    return out
+
+def _rechunk(blocks, chunk_size):
+    """Regroups an iterable of blocks (pd.DataFrame with a column per spectrum
+    or (coordinates, spectra array) tuples) in blocks of **chunk_size**"""
+    coords, parts, n, start = [], [], 0, 0
+    for block in blocks:
+        if isinstance(block, pd.DataFrame):
+            c, y = list(block.columns), block.to_numpy(dtype=float).T
+        else:
+            c, y = list(block[0]), np.atleast_2d(np.asarray(block[1], dtype=float))
+            if len(c) != len(y):
+                raise ValueError(f"Block with {len(c)} coordinates and {len(y)} spectra.")
+        coords += c
+        parts.append(y)
+        n += len(c)
+        while n >= chunk_size:
+            ys = np.concatenate(parts) if len(parts) > 1 else parts[0]
+            yield start, coords[:chunk_size], np.ascontiguousarray(ys[:chunk_size])
+            coords, parts, n = coords[chunk_size:], [ys[chunk_size:]], n - chunk_size
+            start += chunk_size
+    if n:
+        yield start, coords, np.ascontiguousarray(np.concatenate(parts))
+
+def iter_spectra_blocks(y_spectra, chunk_size=CHUNK_SIZE, order="raster"):
+    """
+    Reads the spectra of a map a block at a time.
+
+    Input
+    ------
+    y_spectra: pd.DataFrame, dict, 2D array-like or iterable
+        - pd.DataFrame: a column per spectrum, the columns are the coordinates
+        - dict: 'spectra' (n_spectra, spectrum_y) array-like and 'coords', 
+          e.g. a map opened with pyfityk.io.open_map
+        - 2D array-like (n_spectra, spectrum_y): np.array, np.memmap, HDF5
+          dataset... The coordinates are the spectra indices
+        - iterable of blocks: pd.DataFrame as above or (coordinates, 
+          spectra array) tuples, of any size
+    chunk_size: int, default=CHUNK_SIZE
+        number of spectra of each block (the last one can be shorter)
+    order: str, default="raster"
+        traversal order (see map_order). Only 'raster' for the iterables
+    Yield
+    ------
+    tuple:
+        (index of the first spectrum of the block, coordinates, 
+        np.array of float (n_block, spectrum_y))
+    """
+    if not _is_indexable(y_spectra):
+        if order != "raster":
+            raise ValueError(f"Order {order} needs an indexable input (pd.DataFrame, dict or array).")
+        yield from _rechunk(y_spectra, chunk_size)
+        return
+    if isinstance(y_spectra, pd.DataFrame):
+        coords = list(y_spectra.columns)
+        read = lambda rows: np.ascontiguousarray(y_spectra.iloc[:, rows].to_numpy(dtype=float).T)
+    else:
+        spectra, coords, _ = _spectra_input(y_spectra)
+        read = lambda rows: _read_rows(spectra, rows)
+    rows = map_order(coords, order)
+    for start in range(0, len(coords), chunk_size):
+        r = rows[start:start+chunk_size]
+        yield start, [coords[i] for i in r], read(r)
+
+def _timed(blocks, report):
+    """Iterates the blocks adding the reading time to the 'read' stage"""
+    blocks = iter(blocks)
+    while True:
+        with report.stage("read"):
+            block = next(blocks, None)
+        if block is None:
+            return
+        yield block
+
+def _fit_chunks(x, blocks, compiled, initials, options, workers, match_method, preprocess, report):
+    """
+    Matches and fits the blocks of spectra of iter_spectra_blocks one at a
+    time. With workers>1 each block is split in shards fitted in parallel
+    and at most two blocks are kept in memory.
+    """
+    template = compiled["template"]
+    def match(ys):
+        with report.stage("match"):
+            return match_template(ys, compiled["template_y"], metric=match_method, template_preprocessed=True, **preprocess)
+
+    if workers <= 1:
+        for start, coords, ys in _timed(blocks, report):
+            result = _fit_block(x, ys, coords, match(ys), template, initials, options, start)
+            report.merge(result["report"])
+        return report
+
+    pending = []
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(x, template, initials, options)) as pool:
+        for start, coords, ys in _timed(blocks, report):
+            templ_ids = match(ys)
+            pending.append([pool.submit(_fit_shard, ys[a:b], coords[a:b], templ_ids[a:b], start+a, None, False)
+                for a, b in _shards(len(coords), options["split"], workers)])
+            while len(pending) > 2:
+                for future in pending.pop(0):
+                    report.merge(future.result()["report"])
+        for futures in pending:
+            for future in futures:
+                report.merge(future.result()["report"])
+    return report
+
+def _shards(n, split, workers):
+    """Returns the (start, stop) bounds of the shards used by the workers.
+    If **split** is set, the shards are aligned to the split files."""
+    size = split if split else max(1, -(-n//(4*workers)))
+    return [(start, min(start+size, n)) for start in range(0, n, size)]
+
+def _hilbert_index(n, ix, iy):
+    """Index along the Hilbert curve filling a n x n grid (n power of 2)"""
+    ix, iy = ix.copy(), iy.copy()
+    d = np.zeros_like(ix)
+    s = n//2
+    while s > 0:
+        rx = (ix & s) > 0
+        ry = (iy & s) > 0
+        d += s*s*((3*rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        ix[flip] = n-1 - ix[flip]
+        iy[flip] = n-1 - iy[flip]
+        swap = ~ry
+        ix[swap], iy[swap] = iy[swap], ix[swap].copy()
+        s //= 2
+    return d
+
+def map_order(coords, order="raster"):
+    """
+    Order used to traverse the map.
+
+    Input
+    ------
+    coords: list of tuple
+        (x, y) coordinates of each spectrum
+    order: str, default="raster"
+        - 'raster': the input order
+        - 'serpentine': row by row (same y), alternating the x direction
+        - 'hilbert': along a Hilbert curve over the map grid
+        With 'serpentine' and 'hilbert' consecutive spectra are neighbours
+    Return
+    ------
+    np.array
+        indices of the spectra in the traversal order
+    """
+    n = len(coords)
+    if order == "raster":
+        return np.arange(n)
+    try:
+        xy = np.array([[float(c[0]), float(c[1])] for c in coords]).reshape(-1, 2)
+    except (ValueError, TypeError, IndexError):
+        raise ValueError(f"Order {order} needs numeric (x, y) coordinates.")
+    # grid indices of each spectrum
+    ix = np.unique(xy[:,0], return_inverse=True)[1].ravel()
+    iy = np.unique(xy[:,1], return_inverse=True)[1].ravel()
+    if order == "serpentine":
+        ix_snake = np.where(iy % 2 == 0, ix, -ix)
+        return np.lexsort((ix_snake, iy))
+    if order == "hilbert":
+        side = 1 << int(max(ix.max(initial=0), iy.max(initial=0))).bit_length()
+        return np.argsort(_hilbert_index(side, ix, iy), kind="stable")
+    raise ValueError(f"Order {order} not recognized.")
+
+def _print_fit_stats(stats):
+    """Print the fit statistics collected by fitSpectrum"""
+    hits, misses = stats.get("cache_hits", 0), stats.get("cache_misses", 0)
+    if hits or misses:
+        print("-"*10, "Fit cache","-"*10, sep="\n")
+        print(f"hits: {hits}, misses: {misses}")
+    if "batch_fits" in stats:
+        print("-"*10, "Batched fit","-"*10, sep="\n")
+        print(f"fits: {stats['batch_fits']}, failed: {stats.get('batch_failed', 0)}, fitted by Fityk: {stats.get('fits', 0)}")
+    fits = stats.get("fits", 0)
+    if not fits:
+        return
+    warm = stats.get("warm_starts", 0)
+    cold = fits - warm
+    t_cold, t_warm = stats.get("fit_time_cold", 0), stats.get("fit_time_warm", 0)
+    print("-"*10, "Fit statistics","-"*10, sep="\n")
+    print(f"fits: {fits}, warm starts: {warm}, refitted from template: {stats.get('fallback_fits', 0)}, template result kept: {stats.get('fallbacks', 0)}")
+    # Fityk does not expose the Levenberg-Marquardt iterations of a fit
+    print("iterations per fit: not available from Fityk, wall time per fit below")
+    print(f"fit time: {t_cold+t_warm:.2f} s")
+    if cold: print(f"template start: {cold} fits, {t_cold/cold*1e3:.2f} ms/fit")
+    if warm: print(f"warm start: {warm} fits, {t_warm/warm*1e3:.2f} ms/fit")
+
+def _finish_report(report, t_start, report_out=""):
+    """Sets the wall time of the fitMap report, prints and saves it"""
+    report.wall_time = perf_counter() - t_start
+    _print_fit_stats(report.counters)
+    print("-"*10, "Report","-"*10, sep="\n")
+    print(report.summary())
+    if report_out:
+        report.write(report_out)
+    return report
+
+def fitMap(x, y_spectra, template_file, fileout="", verbosity=-1, split=0, fit=True, match_method="pearsonr", match_preprocess=False, workers=1, template_cache=None, match_window=50, match_polyorder=2, warm_start=False, order="raster", resume=False, table_out="", table_batch=10000, fit_cache=None, fit_cache_size=1024, progress=5., report_out="", coarse=1, backend="fityk", background_save=False, chunk_size=None):
     """
     Fit a batch of spectra. The initial conditions are obtained by matching
     the y_spectra to a template.
@@ -125,8 +1265,13 @@ def fitMap(x, y_spectra, template_file, fileout="", verbosity=-1, split=0, fit=T
     ------
     x: array-like of float
         spectra x values
-    y: pd.DataFrame
-        data frame where each column is a spectrum
+    y_spectra: pd.DataFrame, dict, 2D array-like or iterable
+        data frame where each column is a spectrum or a map returned by
+        pyfityk.io.open_map. Memory mapped spectra are read only when
+        needed, and the workers read only their shard. Also a dict with 
+        'spectra' and 'coords', a (n_spectra, spectrum_y) array-like 
+        (np.memmap, HDF5 dataset...) or an iterable of blocks of spectra
+        (see iter_spectra_blocks). The iterables are read in chunks
     template_file: str
         name of a Fityk file used as template for the initial model used
         for fitting the spectra
@@ -163,8 +1308,104 @@ def fitMap(x, y_spectra, template_file, fileout="", verbosity=-1, split=0, fit=T
         - str: the 'base', 'smooth' and 'norm' keywords can be used to toggle 
         the corresponging preprocess. For example: 'base norm' will perform
         baseline correction and normalization before performing the matching  
+    match_window, match_polyorder: int, default=50, 2
+        Savitzky-Golay filter settings used by the 'smooth' preprocess
+    workers: int, default=1
+        number of processes used for fitting. If larger than 1 the spectra
+        are split in shards (aligned to the **split** files if set) and each
+        shard is fitted in a separate process with its own Fityk sessions.
+        The saved files are the same as in the serial execution.
+    warm_start: bool, default=False
+        start each fit from the fitted functions of the last spectrum that
+        matched the same template, falling back to the template model when
+        it gives a lower WSSR. A warm fit ending above twice the WSSR of 
+        the seed spectrum is repeated from the template and the better 
+        result is kept. The number of fits and the wall time per fit of 
+        template and warm starts are printed at the end (Fityk does not 
+        expose the iteration count).
+    order: str, default="raster"
+        order used to fit (and save) the spectra, see map_order. Use
+        'serpentine' or 'hilbert' with warm_start so that neighbouring
+        spectra are fitted in sequence. The coordinates are kept in the
+        titles.
+    resume: bool, default=False
+        when fileout is set, every completed spectrum is appended to a 
+        checkpoint journal (fileout.journal folder), removed when the run
+        completes. After an interrupted run, with resume=True the
+        spectra in the journal are not fitted again and the split files
+        already saved are skipped. The other files are rebuilt from the 
+        journal. The map, template and order must be the same of the 
+        interrupted run.
+    template_cache: str|bool, default=None
+        cache the compiled template (initials, models, active masks and
+        preprocessed spectra) on disk, keyed by the template file content
+        and the preprocessing options. If True the default cache folder
+        is used (see pyfityk.cache.default_cache_dir), if a string it is
+        used as the cache folder. None or False disable the cache.
+    table_out: str, default=""
+        if different to "", the fitted parameters are also written to this
+        columnar file (.parquet, .h5 or .npz, see pyfityk.table.TableWriter)
+        with a row per spectrum and function: spectrum index, title, x, y,
+        template id, fid, fname, Center, Height, Area, FWHM, a0..an, 
+        err_a0..err_an, wssr, rsquared and dof. With workers>1 a part file 
+        per shard is written (table_out_<start>). Read it with 
+        pyfityk.table.read_table.
+    table_batch: int, default=10000
+        rows of the parameters table written at once
+    fit_cache: str|bool, default=None
+        cache the fitted functions of each spectrum on disk, keyed by the
+        spectrum, the template model and mask and the session settings 
+        (see fit_key). The spectra found in the cache are restored without
+        fitting. If True the default cache folder is used, if a string it 
+        is used as the cache folder. None or False disable the cache.
+        The cache hits and misses are printed at the end.
+    fit_cache_size: float, default=1024
+        maximum size (MB) of the fit cache. The least recently used fits
+        are removed when it is exceeded
+    progress: float, default=5.
+        the progress (spectra done and spectra/s) is printed at most every
+        **progress** seconds by each process. 0 disables it
+    report_out: str, default=""
+        if different to "", the report is saved to this file, in the
+        Prometheus text format if it ends with .prom, else in JSON
+    coarse: int, default=1
+        if larger than 1, each spectrum is first fitted binned by **coarse**
+        points and then refined at full resolution (see fitSpectrum)
+    backend: str, default="fityk"
+        - 'fityk': each spectrum is fitted by Fityk
+        - 'numpy': the spectra are fitted in batches with a vectorized 
+          Levenberg-Marquardt (see batch_fit) using the Fityk weights and 
+          lm_* settings of the template. Only the templates made of 
+          Constant, polynomials, Gaussian, Lorentzian and PseudoVoigt are 
+          supported, the other spectra and the failed fits are fitted by 
+          Fityk. The fitted functions are loaded in Fityk, so the output
+          files are the same. warm_start and coarse apply only to the 
+          spectra fitted by Fityk
+    background_save: bool, default=False
+        with **split**, each split file is saved by a background process
+        (see StateWriter) while the next one is fitted, instead of stopping
+        the fit during the save. The files and the journal are the same
+    chunk_size: int, default=None
+        if set, the spectra are read, matched and fitted **chunk_size** at
+        a time (rounded up to a multiple of **split**), so the memory used
+        depends on chunk_size and not on the map size. The iterables are
+        always chunked (CHUNK_SIZE by default). In chunked mode the output
+        is always split (every chunk_size spectra if split is not set), the
+        parameters table is written in a part per chunk and warm_start
+        restarts at each chunk
+    Return
+    ------
+    pyfityk.report.FitReport:
+        time spent in each stage (template, match, load_data, 
+        deactivate_points, model, fit, read_functions, transfer, save...),
+        Fityk calls, fit and cache counters, spectra/s and the slowest 
+        spectra. A summary is printed at the end.
     """
 
+    if backend not in ("fityk", "numpy"):
+        raise ValueError(f"Backend {backend} not recognized.")
+    t_start = perf_counter()
+    report = FitReport()
     if match_preprocess:
         if match_preprocess == True:
             normalize=smooth=baseline=True
@@ -175,53 +1416,96 @@ def fitMap(x, y_spectra, template_file, fileout="", verbosity=-1, split=0, fit=T
     else:
         normalize=smooth=baseline=False
 
-    template = Fityk()
-    template.execute(f"exec '{template_file}'")
-    initials = get_session_initials(template)
+    preprocess = dict(normalize=normalize, smooth=smooth, baseline=baseline, window=match_window, polyorder=match_polyorder)
+    with report.stage("template"):
+        compiled = load_template(template_file, cache=template_cache, **preprocess)
+    initials = dict(compiled["initials"])
     initials["sets"] = re.sub(r"set verbosity = (.*?);", f"set verbosity = {verbosity};", initials["sets"])
+    template = compiled["template"]
 
-    #TODO: once read_fityk is properly implemented to read limits and constants merge it with the above part of defines 
-    template = read_fityk_text(template_file)
-    template_y = np.array([d["data"]["y"] for d in template])
+    # fityk accepts only float arrays    
+    x = np.asarray(x, dtype=float)
+    chunked = chunk_size is not None or not _is_indexable(y_spectra)
+    if chunked:
+        chunk_size = chunk_size or CHUNK_SIZE
+        if fileout!="" and not split:
+            print(f"Chunked input: the output is split every {chunk_size} spectra.")
+            split = chunk_size
+        if split:
+            # blocks aligned to the split files
+            chunk_size = -(-chunk_size//split)*split
+        blocks = iter_spectra_blocks(y_spectra, chunk_size, order)
+        total = _input_length(y_spectra)
+        if total is None and order != "raster":
+            raise ValueError(f"Order {order} needs an indexable input (pd.DataFrame, dict or array).")
+    else:
+        ys, coords, path = _spectra_input(y_spectra)
+        with report.stage("match"):
+            templ_ids = match_template(ys, compiled["template_y"], metric=match_method, template_preprocessed=True, **preprocess)
 
-    templ_ids = match_template(y_spectra.T.values, template_y, metric=match_method, normalize=normalize, smooth=smooth, baseline=baseline)
-    session = Fityk()
-    buffer_session = Fityk()
+        # traversal order, the spectra are fitted and saved in this order
+        ordered = order != "raster"
+        rows = map_order(coords, order)
+        if ordered:
+            coords = [coords[r] for r in rows]
+            templ_ids = templ_ids[rows]
+        total = len(templ_ids)
+    options = dict(fileout=fileout, split=split, fit=fit, warm_start=warm_start, journal=fileout!="", total=total, progress=progress, parallel=workers>1, coarse=coarse, backend=backend, background_save=background_save)
+    if fileout!="":
+        if resume:
+            options["done"], options["saved"] = read_journal(fileout)
+        else:
+            remove_journal(fileout)
+    if fit_cache:
+        # built once, the workers get a copy through _init_worker without
+        # scanning the cache folder again
+        options["fit_cache"] = DiskCache(fit_cache_folder(fit_cache), int(fit_cache_size*2**20))
+    if table_out!="":
+        options.update(table=table_out, table_batch=table_batch, n_params=_max_params(template), table_parts=workers>1 or chunked)
+        # the table is rebuilt completely, also the saved split files are needed
+        options["saved"] = set()
+        for f in table_parts(table_out) + [table_out]:
+            if os.path.isfile(f):
+                os.remove(f)
 
-    #initial general sets for sessions 
-    for f in [session, buffer_session]:
-        set_define_functions(f, initials["defines"])
-        f.execute(initials["sets"])
+    if chunked:
+        _fit_chunks(x, blocks, compiled, initials, options, workers, match_method, preprocess, report)
+        # the journal is needed only to resume an interrupted run
+        remove_journal(fileout)
+        return _finish_report(report, t_start, report_out)
 
-    if not pd.api.types.is_float_dtype(x):
-        # fityk accepts only float arrays    
-        x = x.astype(float)
+    if workers <= 1:
+        result = _fit_block(x, ys, coords, templ_ids, template, initials, options, 0, rows if ordered else None)
+        remove_journal(fileout)
+        return _finish_report(report.merge(result["report"]), t_start, report_out)
 
-    for i, (templ_id, (coord, y)) in enumerate(zip(templ_ids, y_spectra.items())):
-        print(f"-----Fitting @{i}")
-        dataset_idx = i%split if split else i
+    # without split the workers return the fitted functions and the output
+    # session is assembled here
+    collect = (fileout!="") and not split
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(x, template, initials, options)) as pool:
+        futures = []
+        for start, stop in _shards(len(templ_ids), split, workers):
+            shard_rows = rows[start:stop] if ordered else None
+            if path:
+                data = path
+            else:
+                data = ys[shard_rows] if ordered else ys[start:stop]
+                shard_rows = None
+            futures.append(pool.submit(_fit_shard, data, coords[start:stop], templ_ids[start:stop], start, shard_rows, collect))
+        results = [future.result() for future in futures]
 
-        if not pd.api.types.is_float_dtype(y):
-        # fityk accepts only float arrays    
-            y = y.astype(float)
-        match = template[templ_id]
-        title = ";".join(coord) + f";ID-{templ_id}"
-        #Fityk creates an empty dataset at position 0. Do not create a new one for dataset 0
-        if dataset_idx!=0: session.execute("@+ = 0")
-        session.load_data(dataset_idx, x, y, [], title)
-        fitSpectrum(session, buffer_session, x, y, match, dataset_idx, fit)
-        if (fileout!="") and split and ((i+1)%split == 0):
-            fout = edit_filename(fileout, i+1)
-            print("-"*10, "Saving file","-"*10, sep="\n")
-            session.execute(f"info state > '{fout}'")
-            session.execute("reset")
-            set_define_functions(session, initials["defines"])
-            session.execute(initials["sets"])
-    if fileout!="":
-        if split:
-            if len(templ_ids)%split!=0:
-                fout = edit_filename(fileout, i+1)
-                session.execute(f"info state > '{fout}'")
-        else:
-            session.execute(f"info state > '{fileout}'")
+    for result in results:
+        report.merge(result["report"])
 
+    if collect:
+        with report.stage("assemble"):
+            session = CountingSession(Fityk(), report)
+            init_session(session, initials)
+            records = [r for result in results for r in result["records"]]
+            for i, (title, templ_id, funcs) in enumerate(records):
+                y = np.asarray(ys[rows[i]], dtype=float)
+                restore_spectrum(session, i, x, y, title, template[templ_id]["data"]["active"], funcs)
+        with report.stage("save"):
+            session.execute(f"info state > '{fileout}'")
+    remove_journal(fileout)
+    return _finish_report(report, t_start, report_out)
@@ -0,0 +1,191 @@
+import json
+import heapq
+from time import perf_counter
+from contextlib import contextmanager
+
+# -----------------------------------------------------------------
+# Instrumentation of the mapping pipeline
+# -----------------------------------------------------------------
+
+class FitReport:
+    """
+    Timers and counters collected while fitting a map.
+
+    Attributes
+    ------
+    stages: dict
+        {stage name: [calls, time (s)]}
+    counters: dict
+        {name: count}, e.g. the Fityk calls ('fityk_execute',
+        'fityk_get_info', ...), the fit statistics of fitSpectrum and the
+        fit cache hits and misses
+    spectra: int
+        number of spectra processed
+    wall_time: float
+        elapsed time (s) of the whole run, set by fitMap
+    slowest: list
+        (time (s), spectrum index, title) of the slowest spectra
+    """
+
+    def __init__(self, n_slowest=10):
+        self.stages = {}
+        self.counters = {}
+        self.spectra = 0
+        self.wall_time = 0.
+        self.slowest = []
+        self.n_slowest = n_slowest
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing a stage"""
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, perf_counter() - t)
+
+    def add_stage(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, [0, 0.])
+        stage[0] += calls
+        stage[1] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def spectrum(self, index, title, seconds):
+        """Records the time spent on a spectrum"""
+        self.spectra += 1
+        item = (seconds, index, title)
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def merge(self, other):
+        """Adds the timers and counters of another report"""
+        for name, (calls, seconds) in other.stages.items():
+            self.add_stage(name, seconds, calls)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        self.spectra += other.spectra
+        for item in other.slowest:
+            if len(self.slowest) < self.n_slowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+        return self
+
+    @property
+    def spectra_per_second(self):
+        return self.spectra/self.wall_time if self.wall_time > 0 else 0.
+
+    def to_dict(self):
+        return dict(
+            spectra=self.spectra,
+            wall_time=self.wall_time,
+            spectra_per_second=self.spectra_per_second,
+            stages={name:dict(calls=calls, time=seconds) for name, (calls, seconds) in self.stages.items()},
+            counters=dict(self.counters),
+            slowest=[dict(time=t, index=int(i), title=title) for t, i, title in sorted(self.slowest, reverse=True)],
+            )
+
+    def to_prometheus(self, prefix="pyfityk"):
+        """Report in the Prometheus text exposition format"""
+        lines = [
+            f"# HELP {prefix}_spectra_total Spectra processed",
+            f"# TYPE {prefix}_spectra_total counter",
+            f"{prefix}_spectra_total {self.spectra}",
+            f"# HELP {prefix}_wall_seconds Elapsed time of the run",
+            f"# TYPE {prefix}_wall_seconds gauge",
+            f"{prefix}_wall_seconds {self.wall_time:.6f}",
+            f"# HELP {prefix}_spectra_per_second Throughput of the run",
+            f"# TYPE {prefix}_spectra_per_second gauge",
+            f"{prefix}_spectra_per_second {self.spectra_per_second:.6f}",
+            f"# HELP {prefix}_stage_seconds_total Time spent in each stage",
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            ]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {seconds:.6f}' for name, (_, seconds) in self.stages.items()]
+        lines += [
+            f"# HELP {prefix}_stage_calls_total Calls of each stage",
+            f"# TYPE {prefix}_stage_calls_total counter",
+            ]
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {calls}' for name, (calls, _) in self.stages.items()]
+        lines += [
+            f"# HELP {prefix}_events_total Counters (Fityk calls, fits, cache)",
+            f"# TYPE {prefix}_events_total counter",
+            ]
+        lines += [f'{prefix}_events_total{{name="{name}"}} {n:g}' for name, n in self.counters.items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """Writes the report in Prometheus format if filename ends with .prom,
+        else in JSON"""
+        with open(filename, "w") as f:
+            if filename.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self, n_stages=8, n_slowest=5):
+        """Short text summary of the report"""
+        lines = [f"spectra: {self.spectra}, time: {self.wall_time:.2f} s, {self.spectra_per_second:.2f} spectra/s"]
+        stages = sorted(self.stages.items(), key=lambda s: s[1][1], reverse=True)[:n_stages]
+        for name, (calls, seconds) in stages:
+            lines.append(f"  {name:<18} {seconds:9.3f} s {calls:>9} calls")
+        calls = {k:v for k, v in self.counters.items() if k.startswith("fityk_")}
+        if calls:
+            lines.append("Fityk calls: " + ", ".join(f"{k[6:]} {v}" for k, v in sorted(calls.items())))
+        if self.slowest:
+            lines.append("slowest spectra: " + ", ".join(f"@{i} {title} {t:.3f} s" for t, i, title in sorted(self.slowest, reverse=True)[:n_slowest]))
+        return "\n".join(lines)
+
+def stage(report, name):
+    """report.stage(name) or a context manager doing nothing if report is None"""
+    return report.stage(name) if report is not None else _nothing()
+
+@contextmanager
+def _nothing():
+    yield
+
+class CountingSession:
+    """
+    Wraps a Fityk session counting the calls of its methods in the report
+    counters ('fityk_execute', 'fityk_get_info', ...).
+    """
+
+    def __init__(self, session, report):
+        self._session = session
+        self._report = report
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+        if not callable(attr):
+            return attr
+        counters = self._report.counters
+        key = "fityk_" + name
+        def call(*args, **kwargs):
+            counters[key] = counters.get(key, 0) + 1
+            return attr(*args, **kwargs)
+        return call
+
+class Progress:
+    """
+    Rate limited progress output: prints at most once every **interval**
+    seconds (and at the end). interval <= 0 disables the output.
+    """
+
+    def __init__(self, total, interval=5., label=""):
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.start = self.last = perf_counter()
+
+    def update(self, done, force=False):
+        if self.interval <= 0:
+            return
+        now = perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        rate = done/(now - self.start) if now > self.start else 0.
+        print(f"{self.label}{done}/{self.total} spectra, {rate:.1f} spectra/s", flush=True)
@@ -0,0 +1,150 @@
+import numpy as np
+from scipy.special import wofz, erf, gammaln
+
+# -----------------------------------------------------------------
+# NumPy versions of the Fityk built-in functions
+# -----------------------------------------------------------------
+# The parameters follow the order of the Fityk definitions (see the
+# (un)defines section of a .fit file). All the functions broadcast, so the
+# parameters can be floats or arrays. Fityk function_cutoff is not applied,
+# pyfityk.support.get_func_y falls back to Fityk when it is set.
+
+LN2 = np.log(2)
+
+def constant(x, a):
+    return a + np.zeros_like(x, dtype=float)
+
+def polynomial(x, *a):
+    """Polynomial a0 + a1*x + ... + an*x^n (Linear, Quadratic, Cubic, Polynomial4..6)"""
+    y = np.zeros_like(x, dtype=float)
+    for ai in reversed(a):
+        y = y*x + ai
+    return y
+
+def gaussian(x, height, center, hwhm):
+    return height*np.exp(-LN2*((x-center)/hwhm)**2)
+
+def gaussian_a(x, area, center, hwhm):
+    return gaussian(x, area/hwhm/np.sqrt(np.pi/LN2), center, hwhm)
+
+def split_gaussian(x, height, center, hwhm1, hwhm2):
+    return np.where(x<center, gaussian(x, height, center, hwhm1), gaussian(x, height, center, hwhm2))
+
+def lorentzian(x, height, center, hwhm):
+    return height/(1+((x-center)/hwhm)**2)
+
+def lorentzian_a(x, area, center, hwhm):
+    return lorentzian(x, area/hwhm/np.pi, center, hwhm)
+
+def split_lorentzian(x, height, center, hwhm1, hwhm2):
+    return np.where(x<center, lorentzian(x, height, center, hwhm1), lorentzian(x, height, center, hwhm2))
+
+def pearson7(x, height, center, hwhm, shape):
+    return height/(1+((x-center)/hwhm)**2*(2**(1/shape)-1))**shape
+
+def pearson7_a(x, area, center, hwhm, shape):
+    height = area/(hwhm*np.exp(gammaln(shape-0.5)-gammaln(shape))*np.sqrt(np.pi/(2**(1/shape)-1)))
+    return pearson7(x, height, center, hwhm, shape)
+
+def split_pearson7(x, height, center, hwhm1, hwhm2, shape1, shape2):
+    return np.where(x<center, pearson7(x, height, center, hwhm1, shape1), pearson7(x, height, center, hwhm2, shape2))
+
+def pseudo_voigt(x, height, center, hwhm, shape):
+    z2 = ((x-center)/hwhm)**2
+    return height*((1-shape)*np.exp(-LN2*z2) + shape/(1+z2))
+
+def pseudo_voigt_a(x, area, center, hwhm, shape):
+    return gaussian_a(x, area*(1-shape), center, hwhm) + lorentzian_a(x, area*shape, center, hwhm)
+
+def split_pseudo_voigt(x, height, center, hwhm1, hwhm2, shape1, shape2):
+    return np.where(x<center, pseudo_voigt(x, height, center, hwhm1, shape1), pseudo_voigt(x, height, center, hwhm2, shape2))
+
+def _humlik(x, y):
+    """Real part of the Faddeeva function w(x+iy)"""
+    return np.real(wofz(x + 1j*y))
+
+def voigt(x, height, center, gwidth, shape):
+    shape = np.abs(shape)
+    return height*_humlik((x-center)/gwidth, shape)/_humlik(0, shape)
+
+def voigt_a(x, area, center, gwidth, shape):
+    return area/(np.sqrt(np.pi)*gwidth)*_humlik((x-center)/gwidth, np.abs(shape))
+
+def split_voigt(x, height, center, gwidth1, gwidth2, shape1, shape2):
+    return np.where(x<center, voigt(x, height, center, gwidth1, shape1), voigt(x, height, center, gwidth2, shape2))
+
+def emg(x, a, b, c, d):
+    return a*c*(2*np.pi)**0.5/(2*d) * np.exp((b-x)/d + c**2/(2*d**2)) * (np.abs(d)/d - erf((b-x)/(2**0.5*c) + c/(2**0.5*d)))
+
+def doniach_sunjic(x, h, a, f, e):
+    return h*np.cos(np.pi*a/2 + (1-a)*np.arctan((x-e)/f)) / (f**2+(x-e)**2)**((1-a)/2)
+
+def log_normal(x, height, center, width, asym):
+    a = 2.0*asym*(x-center)/width
+    with np.errstate(invalid="ignore", divide="ignore"):
+        b = np.log1p(a)/asym
+        return np.where(a > -1, height*np.exp(-LN2*b**2), 0.)
+
+def log_normal_a(x, area, center, width, asym):
+    height = np.sqrt(LN2/np.pi)*(2*area/width)*np.exp(-asym**2/4/LN2)
+    return log_normal(x, height, center, width, asym)
+
+def exp_decay(x, a, t):
+    return a*np.exp(-x/t)
+
+def sigmoid(x, lower, upper, xmid, wsig):
+    return lower + (upper-lower)/(1+np.exp((xmid-x)/wsig))
+
+SHAPES = {
+    "Constant":constant,
+    "Linear":polynomial,
+    "Quadratic":polynomial,
+    "Cubic":polynomial,
+    "Polynomial4":polynomial,
+    "Polynomial5":polynomial,
+    "Polynomial6":polynomial,
+    "Gaussian":gaussian,
+    "GaussianA":gaussian_a,
+    "SplitGaussian":split_gaussian,
+    "Lorentzian":lorentzian,
+    "LorentzianA":lorentzian_a,
+    "SplitLorentzian":split_lorentzian,
+    "Pearson7":pearson7,
+    "Pearson7A":pearson7_a,
+    "SplitPearson7":split_pearson7,
+    "PseudoVoigt":pseudo_voigt,
+    "PseudoVoigtA":pseudo_voigt_a,
+    "SplitPseudoVoigt":split_pseudo_voigt,
+    "Voigt":voigt,
+    "VoigtA":voigt_a,
+    "SplitVoigt":split_voigt,
+    "EMG":emg,
+    "DoniachSunjic":doniach_sunjic,
+    "LogNormal":log_normal,
+    "LogNormalA":log_normal_a,
+    "ExpDecay":exp_decay,
+    "Sigmoid":sigmoid,
+}
+
+def evaluate_shape(name, x, params):
+    """
+    Evaluates a Fityk built-in function with NumPy
+    -----------------------------------------------------------------
+    Input
+    ------
+    name: str
+        Fityk function type, e.g. 'Gaussian'
+    x: np.array
+        x values
+    params: list of float
+        function parameters in the Fityk order
+    Return
+    ------
+    np.array or None
+        y values calculated. None if the function is not a supported
+        built-in function
+    """
+    shape = SHAPES.get(name)
+    if shape is None:
+        return None
+    return np.asarray(shape(np.asarray(x, dtype=float), *params), dtype=float)
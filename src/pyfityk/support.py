@@ -2,6 +2,10 @@ import numpy as np
 import pandas as pd
 import re
 import os
+from io import StringIO
+from itertools import chain
+from functools import lru_cache
+from pyfityk.shapes import evaluate_shape
    
 def to_eV(n, wl=532.1):
     """
@@ -58,14 +62,17 @@ def points_to_arrays(data):
     Return
     ------
     np.array
-        array [x,y,active]
+        float64 array [x,y,active]
 
     """
-    return np.array([[i.x,i.y, i.is_active] for i in data])
+    points = chain.from_iterable((p.x, p.y, p.is_active) for p in data)
+    return np.fromiter(points, dtype=float, count=3*len(data)).reshape(-1, 3)
 
-def get_func_y(x, func):
+def get_func_y(x, func, cutoff=0.):
     """
-    Returns the values of the function calculated in the x values  
+    Returns the values of the function calculated in the x values.
+    Fityk built-in functions are evaluated at once with NumPy, the others
+    point by point through Fityk.
     -----------------------------------------------------------------
     Input
     ------
@@ -73,13 +80,37 @@ def get_func_y(x, func):
         x values
     func: fityk function
         function
+    cutoff: float, default=0.
+        Fityk function_cutoff setting of the session (see 
+        get_function_cutoff). The NumPy functions do not apply it, so when
+        it is not 0 all the functions are evaluated through Fityk
     
     Return
     ------
     np.array
         y values calculated
     """
-    return np.array([func.value_at(i) for i in x])
+    y = evaluate_shape(func.get_template_name(), x, get_func_params(func)) if not cutoff else None
+    if y is None:
+        y = get_func_y_pointwise(x, func)
+    return y
+
+def get_function_cutoff(session):
+    """Returns the function_cutoff setting of a Fityk session"""
+    m = re.search(r"\bfunction_cutoff = ([^\s;]+)", session.get_info("set"))
+    return float(m.group(1)) if m else 0.
+
+def get_func_y_pointwise(x, func):
+    """Returns the values of the function calculated in the x values 
+    calling Fityk for each point"""
+    return np.array([func.value_at(i) for i in x], dtype=float)
+
+def get_func_params(func):
+    """Returns the list of parameter values of a Fityk function"""
+    pars = []
+    while p:=func.get_param(len(pars)):
+        pars.append(func.get_param_value(p))
+    return pars
 
 def read_functions(session, dataset, as_text=True):
     """
@@ -108,6 +139,51 @@ def read_functions(session, dataset, as_text=True):
         funcs = [read_function_pars(func, std=False) for func in session.get_components(dataset)]
         return {f[0]:f[1:] for f in funcs}
 
+def format_variable(session, name):
+    """
+    Returns the definition of a variable as it is written in a function,
+    e.g. '~12.5 [10:15]'. The value of simple (fittable) variables is
+    written with repr, so the full double precision is kept. Constants and
+    compound variables are read with info.
+    """
+    var = session.get_variable(name)
+    if not var.is_simple():
+        return session.get_info("$" + name.lstrip("$")).split(" = ", 1)[1]
+    text = "~" + repr(float(var.value()))
+    domain = var.domain
+    if not (domain.from_inf() and domain.to_inf()):
+        lo = "" if domain.from_inf() else repr(float(domain.lo))
+        hi = "" if domain.to_inf() else repr(float(domain.hi))
+        text += f" [{lo}:{hi}]"
+    return text
+
+def format_functions(session, dataset):
+    """
+    Read all the fuctions of a dataset in the session as text, like
+    read_functions(as_text=True), directly from the functions and 
+    variables objects. Only the constant and compound variables need a 
+    get_info call.
+    
+    Input
+    ------
+    session: Fityk
+        Fityk session
+    dataset: int
+        dataset index
+    Return
+    ------
+    dict:
+        dictionary with the function id as a key and the function as the
+        value, e.g. {'%_1': 'Gaussian(~12.5, ~340.25, ~3.1)'}
+    """
+    funcs = {}
+    for func in session.get_components(dataset):
+        pars = []
+        while p:=func.get_param(len(pars)):
+            pars.append(format_variable(session, func.var_name(p)))
+        funcs["%" + func.name.lstrip("%")] = f"{func.get_template_name()}({', '.join(pars)})"
+    return funcs
+
 def read_function_pars(func, std=True):
     """
     Read the function parameters
@@ -144,6 +220,10 @@ def read_function_pars(func, std=True):
         i+=1
     return l
 
+PEAKS_COLUMNS = ["fid", "fname", "Center", "Height", "Area", "FWHM"]
+# inputs with at least this number of lines are parsed by pandas (see peaks_table)
+PEAKS_CSV_LINES = 100
+
 def convert_peaks(peaks):
     """
     Converts the output of info peaks in a DataFrame
@@ -157,22 +237,64 @@ def convert_peaks(peaks):
     -----------------------------------------------
     pandas.DataFrame:
         DataFrame containing the functions 
-        identifier, name and parameters
+        identifier, name and parameters (float columns)
 
     """
     errors = "+/-" in peaks #check if errors are present
-    peaks = peaks.strip() #trailing spaces 
-    peaks = peaks.replace("+/-","")
-    peaks = peaks.replace("?","0")
-    peaks = pd.DataFrame([re.split(r"\s+",s)for s in peaks.split("\n")[1:]]) #split the lines, then columns
-    peaks = peaks.replace("x",None)
-    peaks.loc[:,2:] = peaks.loc[:,2:].astype(float)
+    return peaks_table(clean_peaks(peaks), errors)
+
+def clean_peaks(peaks):
+    """Returns the lines of the output of info peaks without the header.
+    The errors separators '+/-' are removed and the unknown errors '?' 
+    replaced by 0"""
+    return peaks.strip().replace("+/-","").replace("?","0").split("\n")[1:]
 
+def peaks_table(lines, errors, indexed=False):
+    """
+    Parses the lines of info peaks (see clean_peaks) in a DataFrame. 
+    'x' (quantity not defined for the function) becomes NaN. Short inputs
+    are converted with NumPy, long ones with the pandas C parser.
+
+    Input
+    -----------------------------------------------
+    lines: list of str
+        lines to parse
+    errors: bool
+        the lines contain the parameters errors
+    indexed: bool, default=False
+        the first field of each line is an integer index, returned in the
+        'index' column
+    Returns
+    -----------------------------------------------
+    pandas.DataFrame
+    """
+    first = 3 if indexed else 2 # first numeric column
+    ncols = max((len(line.split()) for line in lines), default=0)
+    if ncols < first:
+        return pd.DataFrame(columns=(["index"] if indexed else []) + PEAKS_COLUMNS)
+    if len(lines) < PEAKS_CSV_LINES:
+        # the pandas parser overhead dominates for few lines
+        rows = [line.split() for line in lines]
+        tokens = np.array([r + ["nan"]*(ncols-len(r)) for r in rows], dtype=str)
+        values = tokens[:,first:]
+        values[values=="x"] = "nan"
+        peaks = pd.DataFrame(values.astype(float), columns=range(first, ncols))
+        for i in reversed(range(first)):
+            peaks.insert(0, i, tokens[:,i])
+    else:
+        dtype = {i:float for i in range(first, ncols)}
+        dtype.update({i:str for i in range(first)})
+        peaks = pd.read_csv(StringIO("\n".join(lines)), sep=r"\s+", header=None, names=range(ncols),
+            na_values=["x"], dtype=dtype, engine="c")
+    if indexed:
+        peaks[0] = peaks[0].astype(int)
+
+    n = ncols - first - 4
     if(errors):
-        pars_cols = [f"a{int(i/2)}" if (not i%2) else f"err_a{int(i/2)}" for i in range(len(peaks.columns)-6)]
+        pars_cols = [f"a{int(i/2)}" if (not i%2) else f"err_a{int(i/2)}" for i in range(n)]
     else:
-        pars_cols = [f"a{i}" for i in range(len(peaks.columns)-6)]
-    peaks.columns = ["fid", "fname", "Center", "Height", "Area", "FWHM"] + pars_cols
+        pars_cols = [f"a{i}" for i in range(n)]
+    peaks.columns = (["index"] if indexed else []) + PEAKS_COLUMNS + pars_cols
     return peaks
 
 # -----------------------------------------------------------------
@@ -316,7 +438,7 @@ def set_define_functions(session, functions):
 
 def deactivate_points(session, active, dataset):
     """
-    Activate, deactivate points
+    Activate, deactivate points with a single Fityk command
     
     Inputs
     ------
@@ -328,8 +450,46 @@ def deactivate_points(session, active, dataset):
         dataset index
 
     """
-    for i,val in enumerate(active):
-        t = "true" if val else "false"
-        session.execute(f"@{dataset}:A[{i}]={t}")
+    session.execute(f"@{dataset}: {compile_active_mask(active)}")
 
+def compile_active_mask(active):
+    """
+    Compile a boolean mask in a Fityk data transformation that sets the
+    active points, e.g. 'A = not (n>=0 and n<10 or n>=400 and n<512)'.
+    The points are identified by their index. The compiled expressions
+    are cached, so the same template mask is compiled only once.
 
+    Inputs
+    ------
+    active: array(bool)
+        bolean array for each point of the data
+    Return
+    ------
+    str:
+        the data transformation
+    """
+    active = np.asarray(active, dtype=bool)
+    return _compile_mask(np.packbits(active).tobytes(), len(active))
+
+@lru_cache(maxsize=512)
+def _compile_mask(packed, n):
+    active = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=n).astype(bool)
+    if active.all():
+        return "A = true"
+    if not active.any():
+        return "A = false"
+
+    # start and stop index of each run of active and inactive points
+    edges = np.flatnonzero(np.diff(active.astype(np.int8))) + 1
+    starts = np.concatenate([[0], edges])
+    stops = np.concatenate([edges, [n]])
+    runs_active = active[starts]
+
+    # write the shortest between the active and inactive runs
+    write_active = runs_active.sum() <= (~runs_active).sum()
+    keep = runs_active if write_active else ~runs_active
+    ranges = " or ".join(
+        f"n=={a}" if b-a == 1 else f"(n>={a} and n<{b})"
+        for a, b in zip(starts[keep], stops[keep])
+        )
+    return f"A = {ranges}" if write_active else f"A = not ({ranges})"
@@ -0,0 +1,213 @@
+import os
+import zipfile
+import importlib.util
+from glob import glob, escape
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------------------
+# Columnar tables written in batches
+# -----------------------------------------------------------------
+
+FORMATS = {".parquet":"parquet", ".pq":"parquet", ".h5":"hdf5", ".hdf5":"hdf5", ".hdf":"hdf5", ".npz":"npz"}
+
+def table_format(filename):
+    """Returns the table format ('parquet', 'hdf5' or 'npz') from the
+    extension of filename"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Table format {ext} not recognized. Use one of {', '.join(FORMATS)}.")
+    return FORMATS[ext]
+
+def key_filename(filename, key):
+    """File used for the table **key** by the formats storing one table per
+    file (Parquet)"""
+    if key is None:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f"{root}_{key}{ext}"
+
+class TableWriter:
+    """
+    Writes pd.DataFrame rows to a columnar file in bounded batches: the
+    appended rows are buffered and written every **batch_size** rows, so
+    the memory used does not depend on the size of the table.
+    The format is chosen from the extension:
+        - .parquet, .pq: Parquet (needs pyarrow). A file per key
+        - .h5, .hdf5, .hdf: HDF5 table (needs PyTables). A node per key
+        - .npz: NumPy zip, a .npy member per key, column and batch
+
+    Inputs
+    ------
+    filename: str
+        name of the output file. It is overwritten
+    batch_size: int, default=10000
+        number of rows written at once
+    columns: list of str, default=None
+        columns of the table. If None the columns of the first appended
+        rows are used. Missing columns are filled with NaN.
+    min_itemsize: int or dict, default=None
+        HDF5 only: size of the string columns (for all of them, or
+        {column: size}). By default twice the longest string of the first
+        batch, at least 64. Longer strings in the later batches raise
+        ValueError
+    """
+
+    def __init__(self, filename, batch_size=10000, columns=None, min_itemsize=None):
+        self.filename = filename
+        self.format = table_format(filename)
+        self.batch_size = max(1, int(batch_size))
+        self.columns = columns
+        self.min_itemsize = min_itemsize
+        self.rows = 0
+        self._buffers = {}
+        self._buffered = {} # rows in the buffer of each key
+        self._columns = {}
+        self._batches = {}
+        self._writers = {}
+        self._itemsizes = {} # HDF5 string columns size of each key
+        self._handle = None
+        if self.format == "hdf5":
+            self._handle = pd.HDFStore(filename, mode="w")
+        elif self.format == "npz":
+            self._handle = zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            if importlib.util.find_spec("pyarrow") is None:
+                raise ImportError("Parquet output needs pyarrow. Install it or use a .h5 or .npz file.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, df, key=None):
+        """Buffers the rows of **df** in the table **key** (None for the
+        default table) and writes them when the batch is full"""
+        if df is None or len(df) == 0:
+            return
+        columns = self._columns.setdefault(key, list(self.columns or df.columns))
+        extra = set(df.columns).difference(columns)
+        if extra:
+            raise ValueError(f"Columns {sorted(map(str, extra))} are not in the table.")
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append(df.reindex(columns=columns))
+        self._buffered[key] = self._buffered.get(key, 0) + len(df)
+        if self._buffered[key] >= self.batch_size:
+            self.flush(key)
+
+    def flush(self, key=None):
+        """Writes the buffered rows of the table **key**"""
+        buffer = self._buffers.get(key)
+        if not buffer:
+            return
+        df = pd.concat(buffer, ignore_index=True)
+        buffer.clear()
+        self._buffered[key] = 0
+        batch = self._batches.get(key, 0)
+        self._batches[key] = batch + 1
+        self.rows += len(df)
+        getattr(self, f"_write_{self.format}")(df, key, batch)
+
+    def close(self):
+        """Writes the remaining rows and closes the file"""
+        for key in list(self._buffers):
+            self.flush(key)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _write_parquet(self, df, key, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = self._writers.get(key)
+        if writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            writer = pq.ParquetWriter(key_filename(self.filename, key), table.schema)
+            self._writers[key] = writer
+        else:
+            table = pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+
+    def _write_hdf5(self, df, key, batch):
+        strings = [c for c in df.columns if pd.api.types.is_string_dtype(df[c].dtype)]
+        df = df.astype({c:str for c in strings})
+        lengths = {c:int(df[c].str.len().max()) for c in strings}
+        sizes = self._itemsizes.get(key)
+        if sizes is None:
+            # the size of the string columns is fixed when the table is created
+            sizes = {c:max(64, 2*n) for c, n in lengths.items()}
+            if isinstance(self.min_itemsize, dict):
+                sizes.update((c, n) for c, n in self.min_itemsize.items() if c in sizes)
+            elif self.min_itemsize:
+                sizes = dict.fromkeys(sizes, int(self.min_itemsize))
+            self._itemsizes[key] = sizes
+        long = [c for c, n in lengths.items() if n > sizes.get(c, n)]
+        if long:
+            raise ValueError(f"Strings of columns {long} are longer than the HDF5 column size {[sizes[c] for c in long]}. Set min_itemsize.")
+        # as data columns each string column has its own size
+        self._handle.append(key or "table", df, format="table", index=False, data_columns=strings, min_itemsize=sizes)
+
+    def _write_npz(self, df, key, batch):
+        for i, column in enumerate(df.columns):
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            # members are named key/column index/batch so that the column
+            # names are free
+            name = f"{key or 'table'}/{i}/{batch:06d}.npy"
+            with self._handle.open(name, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, values, allow_pickle=False)
+        if batch == 0:
+            with self._handle.open(f"{key or 'table'}/columns.npy", "w") as f:
+                np.lib.format.write_array(f, np.array(df.columns, dtype=str), allow_pickle=False)
+
+def _read_npz(filename, key):
+    key = key or "table"
+    with np.load(filename, allow_pickle=False) as data:
+        columns = data[f"{key}/columns"]
+        members = sorted(m for m in data.files if m.startswith(key + "/") and m != f"{key}/columns")
+        values = {}
+        for m in members:
+            i = int(m.split("/")[1])
+            values.setdefault(i, []).append(data[m])
+    return pd.DataFrame({c:np.concatenate(values[i]) for i, c in enumerate(columns)})
+
+def table_parts(filename):
+    """Returns the part files of a table (filename_<start>.ext), sorted by
+    their start index"""
+    root, ext = os.path.splitext(filename)
+    index = lambda p: p[len(root)+1:len(p)-len(ext)]
+    parts = [p for p in glob(escape(root) + "_*" + ext) if index(p).isdigit()]
+    return sorted(parts, key=lambda p: int(index(p)))
+
+def read_table(filename, key=None):
+    """
+    Read a table written with TableWriter.
+
+    Input
+    ------
+    filename: str
+        name of the file. If it does not exist, the part files written by
+        parallel runs (see edit_filename) are read and concatenated
+    key: str, default=None
+        table to read, None for the default table
+    Return
+    ------
+    pd.DataFrame
+    """
+    fmt = table_format(filename)
+    if not os.path.isfile(key_filename(filename, key) if fmt == "parquet" else filename):
+        parts = table_parts(filename)
+        if not parts:
+            raise FileNotFoundError(f"No table at {filename}")
+        return pd.concat([read_table(p, key) for p in parts], ignore_index=True)
+    if fmt == "parquet":
+        return pd.read_parquet(key_filename(filename, key))
+    if fmt == "hdf5":
+        return pd.read_hdf(filename, key or "table").reset_index(drop=True)
+    return _read_npz(filename, key)
+
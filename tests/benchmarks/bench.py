@@ -0,0 +1,239 @@
+"""
+Benchmark suite of pyfityk.
+
+Run the benchmarks and store the timings in a JSON file:
+    python tests/benchmarks/bench.py run -o results.json --preset default
+Compare two result files (exit status 1 if a benchmark is slower than
+--threshold times the reference):
+    python tests/benchmarks/bench.py compare reference.json results.json
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+from time import perf_counter
+from datetime import datetime, timezone
+import numpy as np
+from fityk import Fityk
+from pyfityk.io import read_fityk, read_fityk_text, read_map
+from pyfityk.support import convert_peaks
+from pyfityk.mapping import match_template, fitMap, fitSpectrum, load_template, init_session
+from generators import synthetic_map, map_dataframe, write_template, write_fit_file, peaks_texts, write_jasco_map
+
+# metrics documented in match_template
+METRICS = ["pearsonr", "cityblock", "cosine", "euclidean", "l1", "l2", "manhattan", "nan_euclidean",
+    "braycurtis", "canberra", "chebyshev", "correlation", "dice", "hamming", "jaccard", "kulsinski",
+    "mahalanobis", "minkowski", "rogerstanimoto", "russellrao", "seuclidean", "sokalmichener",
+    "sokalsneath", "sqeuclidean", "yule"]
+
+# (n_spectra, n_points) of each preset. The fitting benchmarks use the
+# sizes up to fit_spectra spectra
+PRESETS = {
+    "quick": dict(spectra=[100], points=[256], fit_spectra=100, repeat=1),
+    "default": dict(spectra=[100, 1000], points=[256, 1024], fit_spectra=1000, repeat=3),
+    "full": dict(spectra=[100, 1000, 10000, 50000], points=[256, 1024, 4096], fit_spectra=50000, repeat=3),
+}
+
+# -----------------------------------------------------------------
+# Benchmarks
+# -----------------------------------------------------------------
+# Each benchmark gets the inputs of a size and returns a dict
+# {name: function to time}. The inputs are generated outside the timings.
+
+def bench_read(inputs):
+    return {
+        "read_fityk": lambda: read_fityk(inputs["fit_file"]),
+        "read_fityk_text": lambda: read_fityk_text(inputs["fit_file"]),
+        "convert_peaks": lambda: [convert_peaks(p) for p in inputs["peaks"]],
+        "read_map": lambda: read_map(inputs["map_file"], save=False),
+    }
+
+def bench_match(inputs):
+    spectra, templates = inputs["spectra"], inputs["templates"]
+    return {f"match_template[{m}]": (lambda m=m: match_template(spectra, templates, metric=m)) for m in METRICS}
+
+def bench_fit(inputs):
+    x, spectra = inputs["x"], inputs["spectra"]
+    template_file = inputs["template_file"]
+    split = max(1, len(spectra)//4)
+
+    def fit_spectra(coarse=1):
+        compiled = load_template(template_file)
+        ids = match_template(spectra, compiled["template_y"], template_preprocessed=True, normalize=False, smooth=False, baseline=False)
+        session, buffer_session = Fityk(), Fityk()
+        for f in (session, buffer_session):
+            init_session(f, compiled["initials"])
+        for i, y in enumerate(spectra):
+            if i: session.execute("@+ = 0")
+            session.load_data(i, x, y, [])
+            fitSpectrum(session, buffer_session, x, y, compiled["template"][ids[i]], i, coarse=coarse)
+
+    return {
+        "fitSpectrum": fit_spectra,
+        "fitSpectrum[coarse=8]": lambda: fit_spectra(coarse=8),
+        "fitMap": lambda: fitMap(x, inputs["map"], template_file),
+        "fitMap[numpy]": lambda: fitMap(x, inputs["map"], template_file, backend="numpy"),
+        # the split files are written in the benchmark folder
+        "fitMap[split]": lambda: fitMap(x, inputs["map"], template_file, fileout="out.fit", split=split),
+        "fitMap[split,background_save]": lambda: fitMap(x, inputs["map"], template_file, fileout="out.fit", split=split, background_save=True),
+    }
+
+# -----------------------------------------------------------------
+# Runner
+# -----------------------------------------------------------------
+
+def make_inputs(folder, n_spectra, n_points, fit):
+    """Generates the inputs of a size in folder"""
+    x, templates, spectra, coords = synthetic_map(n_spectra, n_points)
+    inputs = dict(x=x, templates=templates, spectra=spectra)
+    inputs["map_file"] = os.path.join(folder, "map.txt")
+    write_jasco_map(inputs["map_file"], x, spectra, coords)
+    inputs["fit_file"] = os.path.join(folder, "map.fit")
+    session = write_fit_file(inputs["fit_file"], x, spectra, coords)
+    inputs["peaks"] = peaks_texts(session, n_spectra)
+    if fit:
+        inputs["template_file"] = os.path.join(folder, "template.fit")
+        write_template(inputs["template_file"], x, templates)
+        inputs["map"] = map_dataframe(spectra, coords)
+    return inputs
+
+def time_function(function, repeat):
+    times = []
+    for _ in range(repeat):
+        t = perf_counter()
+        function()
+        times.append(perf_counter() - t)
+    return times
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def run(preset="default", select=None, repeat=None, verbose=True):
+    """
+    Run the benchmarks of a preset.
+
+    Input
+    ------
+    preset: str or dict, default="default"
+        name of a preset in PRESETS or a dict with the same keys
+    select: str, default=None
+        run only the benchmarks whose name contains **select**
+    repeat: int, default=None
+        number of timings of each benchmark. If None the preset one is used
+    Return
+    ------
+    dict:
+        - meta: versions, platform, date and git commit
+        - results: list of dict with name, n_spectra, n_points, times (s),
+          best and median (s) or error
+    """
+    sizes = PRESETS[preset] if isinstance(preset, str) else preset
+    repeat = repeat or sizes["repeat"]
+    results = []
+    for n_spectra in sizes["spectra"]:
+        for n_points in sizes["points"]:
+            fit = n_spectra <= sizes["fit_spectra"]
+            with tempfile.TemporaryDirectory() as folder:
+                inputs = make_inputs(folder, n_spectra, n_points, fit)
+                benchmarks = {**bench_read(inputs), **bench_match(inputs)}
+                if fit:
+                    benchmarks.update(bench_fit(inputs))
+                cwd = os.getcwd()
+                os.chdir(folder)
+                try:
+                    for name, function in benchmarks.items():
+                        if select and select not in name:
+                            continue
+                        result = dict(name=name, n_spectra=n_spectra, n_points=n_points)
+                        try:
+                            times = time_function(function, repeat)
+                            result.update(times=times, best=min(times), median=float(np.median(times)))
+                        except Exception as e:
+                            # e.g. metrics that do not accept float spectra
+                            result["error"] = f"{type(e).__name__}: {e}"
+                        if verbose:
+                            timing = f"{result['median']:.4f} s" if "median" in result else result["error"]
+                            print(f"{name:<35} {n_spectra:>6} x {n_points:<5} {timing}", flush=True)
+                        results.append(result)
+                finally:
+                    os.chdir(cwd)
+    meta = dict(
+        date=datetime.now(timezone.utc).isoformat(),
+        commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        preset=preset if isinstance(preset, str) else "custom",
+        repeat=repeat,
+        )
+    return dict(meta=meta, results=results)
+
+def compare(reference, results, threshold=1.2):
+    """
+    Compare two benchmark results on the median times.
+
+    Input
+    ------
+    reference, results: dict
+        outputs of run (or the loaded JSON files)
+    threshold: float, default=1.2
+        a benchmark is a regression if its time is larger than threshold
+        times the reference
+    Return
+    ------
+    list of dict:
+        name, n_spectra, n_points, reference, time, ratio and regression
+        for the benchmarks present in both results
+    """
+    key = lambda r: (r["name"], r["n_spectra"], r["n_points"])
+    old = {key(r): r for r in reference["results"] if "median" in r}
+    rows = []
+    for r in results["results"]:
+        if "median" not in r or key(r) not in old:
+            continue
+        ref = old[key(r)]["median"]
+        ratio = r["median"]/ref if ref > 0 else np.inf
+        rows.append(dict(name=r["name"], n_spectra=r["n_spectra"], n_points=r["n_points"],
+            reference=ref, time=r["median"], ratio=ratio, regression=ratio > threshold))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyfityk benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run", help="Run the benchmarks")
+    p.add_argument("-o", "--output", default="benchmarks.json", help="JSON file for the results")
+    p.add_argument("--preset", choices=PRESETS, default="default")
+    p.add_argument("-k", "--select", default=None, help="Run only the benchmarks containing this string")
+    p.add_argument("--repeat", type=int, default=None)
+    p = sub.add_parser("compare", help="Compare two result files")
+    p.add_argument("reference")
+    p.add_argument("results")
+    p.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        out = run(args.preset, args.select, args.repeat)
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=1)
+        return 0
+
+    with open(args.reference) as f:
+        reference = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    rows = compare(reference, results, args.threshold)
+    for r in rows:
+        flag = "REGRESSION" if r["regression"] else ""
+        print(f"{r['name']:<35} {r['n_spectra']:>6} x {r['n_points']:<5} {r['reference']:.4f} -> {r['time']:.4f} s ({r['ratio']:.2f}x) {flag}")
+    return int(any(r["regression"] for r in rows))
+
+if __name__ == "__main__":
+    sys.exit(main())
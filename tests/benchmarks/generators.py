@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from fityk import Fityk
+
+# -----------------------------------------------------------------
+# Synthetic maps and templates used by the benchmarks
+# -----------------------------------------------------------------
+# Everything is generated from a seed, so the benchmarks need no data file
+# and two runs of the suite see exactly the same inputs.
+
+def synthetic_templates(n_templates=4, n_points=256, seed=0):
+    """
+    Template spectra: a constant background and a Gaussian peak at a
+    different position for each template.
+
+    Return
+    ------
+    tuple:
+        (x, templates (n_templates, n_points), centers)
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(100, 1100, n_points)
+    centers = np.linspace(250, 950, n_templates)
+    background = rng.uniform(5, 20, (n_templates, 1))
+    templates = background + 100*np.exp(-np.log(2)*((x - centers[:, None])/25)**2)
+    return x, templates, centers
+
+def synthetic_map(n_spectra, n_points=256, n_templates=4, noise=1.0, seed=0):
+    """
+    Map of spectra obtained from the templates with random shifts, scale and
+    noise, on a square grid of coordinates.
+
+    Return
+    ------
+    tuple:
+        (x, templates, spectra (n_spectra, n_points), coords list of (str, str))
+    """
+    rng = np.random.default_rng(seed)
+    x, templates, centers = synthetic_templates(n_templates, n_points, seed)
+    ids = rng.integers(0, n_templates, n_spectra)
+    shift = rng.normal(0, 5, (n_spectra, 1))
+    scale = rng.uniform(0.5, 2, (n_spectra, 1))
+    background = rng.uniform(5, 20, (n_spectra, 1))
+    spectra = background + scale*100*np.exp(-np.log(2)*((x - centers[ids][:, None] - shift)/25)**2)
+    spectra += rng.normal(0, noise, spectra.shape)
+    side = int(np.ceil(np.sqrt(n_spectra)))
+    coords = [(f"{i % side:.1f}", f"{i // side:.1f}") for i in range(n_spectra)]
+    return x, templates, spectra, coords
+
+def map_dataframe(spectra, coords):
+    """Spectra as the pd.DataFrame accepted by fitMap (a column per spectrum)"""
+    return pd.DataFrame(spectra.T, columns=pd.MultiIndex.from_tuples(coords))
+
+def _model(x, y):
+    center = x[np.argmax(y)]
+    return f"Constant(~{y.min():.6g}) + Gaussian(~{y.max()-y.min():.6g}, ~{center:.6g}, ~25)"
+
+def write_template(filename, x, templates):
+    """Writes a Fityk template file with a Constant + Gaussian model for each
+    template spectrum"""
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    for i, y in enumerate(templates):
+        if i != 0: f.execute("@+ = 0")
+        f.load_data(i, x, y, [], f"template{i}")
+        f.execute(f"@{i}: F = {_model(x, y)}")
+    f.execute(f"info state > '{filename}'")
+
+def write_fit_file(filename, x, spectra, coords):
+    """Writes a Fityk state file with a model (not fitted) for each spectrum,
+    as saved by fitMap"""
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    for i, (y, c) in enumerate(zip(spectra, coords)):
+        if i != 0: f.execute("@+ = 0")
+        f.load_data(i, x, y, [], ";".join(c))
+        f.execute(f"@{i}: F = {_model(x, y)}")
+    f.execute(f"info state > '{filename}'")
+    return f
+
+def peaks_texts(session, n):
+    """The output of info peaks_err for the first **n** datasets of a session,
+    as written in the .peaks files"""
+    count = session.get_dataset_count()
+    return [session.get_info("peaks_err", i % count) for i in range(n)]
+
+def write_jasco_map(filename, x, spectra, coords):
+    """Writes the spectra in the Jasco map text format read by pyfityk.io.read_map"""
+    with open(filename, "w") as f:
+        for i in range(13):
+            f.write(f"HEADER{i}\tvalue\n")
+        f.write("\t" + "\t".join(c[0] for c in coords) + "\n")
+        f.write("\t" + "\t".join(c[1] for c in coords) + "\n")
+        np.savetxt(f, np.column_stack([x, spectra.T]), delimiter="\t", fmt="%.6g")
@@ -0,0 +1,24 @@
+import json
+from bench import run, compare, main
+
+TINY = dict(spectra=[20], points=[64], fit_spectra=20, repeat=1)
+
+def test_run_tiny():
+    out = run(TINY, verbose=False)
+    names = {r["name"] for r in out["results"]}
+    for name in ["read_fityk", "read_fityk_text", "convert_peaks", "read_map", "match_template[pearsonr]", "fitSpectrum", "fitMap"]:
+        assert name in names
+    for r in out["results"]:
+        if not r["name"].startswith("match_template"):
+            assert "error" not in r, r
+    json.dumps(out)
+
+def test_compare(tmp_path):
+    reference = dict(results=[dict(name="a", n_spectra=1, n_points=1, median=1.0), dict(name="b", n_spectra=1, n_points=1, median=1.0)])
+    results = dict(results=[dict(name="a", n_spectra=1, n_points=1, median=1.1), dict(name="b", n_spectra=1, n_points=1, median=2.0)])
+    rows = compare(reference, results, threshold=1.2)
+    assert [r["regression"] for r in rows] == [False, True]
+    for name, data in [("ref.json", reference), ("new.json", results)]:
+        with open(tmp_path / name, "w") as f:
+            json.dump(data, f)
+    assert main(["compare", str(tmp_path / "ref.json"), str(tmp_path / "new.json")]) == 1
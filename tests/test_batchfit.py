@@ -0,0 +1,61 @@
+import numpy as np
+from pyfityk.batchfit import parse_model, fit_settings, fit_spectra, weights
+
+def test_parse_model():
+    model = parse_model("Constant(~12.5) + Gaussian(~100, ~5e+2 [400:600], 25) + PseudoVoigt(~1, ~2, ~3, ~0.5 [0:1])")
+    assert model.fnames == ["Constant", "Gaussian", "PseudoVoigt"]
+    assert model.n_params == 8
+    np.testing.assert_array_equal(model.free, [1, 1, 1, 0, 1, 1, 1, 1])
+    assert model.lo[2] == 400 and model.hi[2] == 600 and model.lo[7] == 0 and np.isinf(model.lo[0])
+    # the formatted functions are read back
+    funcs = model.format(model.p0)
+    again = parse_model(" + ".join(funcs.values()))
+    np.testing.assert_array_equal(again.p0, model.p0)
+    np.testing.assert_array_equal(again.hi, model.hi)
+    # not supported
+    assert parse_model("SplitGaussian(~1, ~2, ~3, ~4)") is None
+    assert parse_model("Gaussian(~1, ~2, ~3*2)") is None
+    assert parse_model(0) is None
+
+def test_jacobian():
+    model = parse_model("Linear(~1, ~0.01) + Gaussian(~50, ~400, ~30) + Lorentzian(~30, ~700, ~15) + PseudoVoigt(~100, ~500, ~20, ~0.4)")
+    x = np.linspace(100, 1100, 501)
+    params = np.vstack([model.p0, model.p0*1.1])
+    _, jac = model.evaluate(x, params)
+    for j in range(model.n_params):
+        step = np.zeros_like(params)
+        step[:, j] = 1e-6*np.maximum(1, np.abs(params[:, j]))
+        plus = model.evaluate(x, params + step, jacobian=False)[0]
+        minus = model.evaluate(x, params - step, jacobian=False)[0]
+        numeric = (plus - minus)/(2*step[:, j:j+1])
+        np.testing.assert_allclose(jac[:, :, j], numeric, rtol=1e-4, atol=1e-6)
+
+def test_fit_spectra():
+    rng = np.random.default_rng(0)
+    x = np.linspace(100, 1100, 512)
+    n = 50
+    center = rng.normal(500, 5, n)
+    height = rng.uniform(50, 200, n)
+    y = 10 + height[:, None]*np.exp(-np.log(2)*((x - center[:, None])/25)**2) + rng.normal(0, 0.5, (n, x.size))
+    model = parse_model("Constant(~5) + Gaussian(~80, ~495 [480:520], ~20)")
+    active = np.ones(x.size, dtype=bool)
+    active[:10] = False
+    y[:, :10] = 1e6 # inactive points are ignored
+    params, wssr, ok = fit_spectra(model, x, y, active)
+    assert ok.all()
+    np.testing.assert_allclose(params[:, 2], center, atol=0.3)
+    np.testing.assert_allclose(params[:, 1], height, rtol=0.02)
+    assert (wssr > 0).all()
+    # the Jacobian evaluated a spectrum at a time gives the same fit
+    blocked, wssr_blocked, _ = fit_spectra(model, x, y, active, settings=dict(max_memory=1))
+    np.testing.assert_allclose(blocked, params, rtol=1e-10)
+    np.testing.assert_allclose(wssr_blocked, wssr, rtol=1e-10)
+
+def test_fit_settings():
+    settings = fit_settings("set default_sigma = one;set lm_stop_rel_change = 1e-07;set max_wssr_evaluations = 100;")
+    assert settings["default_sigma"] == "one"
+    assert settings["rel_change"] == 1e-7 and settings["max_evaluations"] == 100
+    assert settings["lambda_start"] == 1e-3
+    y = np.array([[0.5, 4., 100.]])
+    np.testing.assert_allclose(weights(y, [True, True, False]), [[1., 0.25, 0.]])
+    np.testing.assert_allclose(weights(y, [True]*3, "one"), [[1., 1., 1.]])
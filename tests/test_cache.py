@@ -0,0 +1,52 @@
+import os
+import numpy as np
+from pyfityk.cache import DiskCache, hash_key
+from pyfityk.mapping import load_template
+
+FIT_SIMPLE = os.path.join(os.path.dirname(__file__), "fit_simple.fit")
+
+def test_disk_cache_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=10**6)
+    keys = [hash_key(i) for i in range(10)]
+    for i, key in enumerate(keys):
+        cache.put(key, np.zeros(100))
+        # explicit access times, the mtime resolution may be coarse
+        t = 1e9 + 100*i
+        os.utime(cache._path(key), (t, t))
+    # get marks the entry as recently used
+    assert cache.get(keys[1]) is not None
+    cache.max_size = 4000
+    cache.evict()
+    assert cache.size <= 0.8*4000
+    assert cache.get(keys[1]) is not None
+    assert cache.get(keys[-1]) is not None
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) is None
+
+def test_disk_cache_low_water(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=10000, low_water=0.5)
+    evictions = []
+    evict = cache.evict
+    cache.evict = lambda: (evictions.append(1), evict())
+    for i in range(40):
+        cache.put(hash_key(i), np.zeros(100))
+        assert cache.size <= 10000
+    # each eviction frees half of the cache, not a single entry
+    assert 0 < len(evictions) < 10
+    assert cache.size == sum(size for _, size, _ in cache._entries())
+
+def test_disk_cache_unreadable(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    key = hash_key("broken")
+    cache.put(key, 1)
+    # a pickle referring to a class that no longer exists
+    with open(cache._path(key), "wb") as f:
+        f.write(b"\x80\x04\x95\x1a\x00\x00\x00\x00\x00\x00\x00\x8c\x0cpyfityk_gone\x94\x8c\x05Thing\x94\x93\x94.")
+    assert cache.get(key, "miss") == "miss"
+
+def test_load_template_cache(tmp_path):
+    compiled = load_template(FIT_SIMPLE, cache=str(tmp_path), smooth=True)
+    cached = load_template(FIT_SIMPLE, cache=str(tmp_path), smooth=True)
+    np.testing.assert_array_equal(compiled["template_y"], cached["template_y"])
+    assert compiled["initials"] == cached["initials"]
+    assert [d["mask"] for d in compiled["template"]] == [d["mask"] for d in cached["template"]]
@@ -0,0 +1,29 @@
+import os
+import json
+import shutil
+from pyfityk.cli import exporter
+
+FIT_SIMPLE = os.path.join(os.path.dirname(__file__), "fit_simple.fit")
+
+def test_exporter_folder(tmp_path):
+    inputs = tmp_path / "fits"
+    inputs.mkdir()
+    for i in range(3):
+        shutil.copy(FIT_SIMPLE, inputs / f"map_{i}.fit")
+    (inputs / "broken.fit").write_text("not a fityk command\n")
+    out = tmp_path / "out"
+    out.mkdir()
+    report = str(tmp_path / "report.json")
+
+    assert exporter([str(inputs), "-o", str(out), "-j", "2", "--bundle", "all.npz", "--report", report]) == 1
+    with open(report) as f:
+        status = {os.path.basename(r["file"]):r["status"] for r in json.load(f)}
+    assert status == {"map_0.fit":"exported", "map_1.fit":"exported", "map_2.fit":"exported", "broken.fit":"failed"}
+    assert all((out / f"map_{i}_all.npz").is_file() for i in range(3))
+
+    # only the changed file is exported again
+    os.utime(inputs / "map_1.fit", (os.path.getmtime(report) + 10,)*2)
+    exporter([str(inputs / "map_*.fit"), "-o", str(out), "--bundle", "all.npz", "--report", report])
+    with open(report) as f:
+        status = {os.path.basename(r["file"]):r["status"] for r in json.load(f)}
+    assert status == {"map_0.fit":"skipped", "map_1.fit":"exported", "map_2.fit":"skipped"}
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+from fityk import Fityk
+from pyfityk.fitfile import iter_fityk_text, scan_fit_file
+from pyfityk.support import points_to_arrays
+
+FIT_SIMPLE = os.path.join(os.path.dirname(__file__), "fit_simple.fit")
+
+def test_scan():
+    info = scan_fit_file(FIT_SIMPLE)
+    assert [i for i, _ in info["datasets"]] == [0, 1, 2, 3, 4]
+    assert sorted(info["models"]) == [0, 1, 3, 4]
+    assert "define BgPol(a0=intercept, a1=slope, a2=0, a3=0, a4=0, a5=0, a6=0) = a0 + a1*x + a2*x^2 + a3*x^3 + a4*x^4 + a5*x^5 + a6*x^6" in info["defines"]
+
+def test_data_matches_fityk():
+    f = Fityk()
+    f.execute(f"reset; exec '{FIT_SIMPLE}'")
+    records = list(iter_fityk_text(FIT_SIMPLE))
+    assert len(records) == f.get_dataset_count()
+    for i, d in enumerate(records):
+        assert d["title"] == f.get_info("title", i)
+        np.testing.assert_allclose(d["data"][["x", "y", "active"]].to_numpy(), points_to_arrays(f.get_data(i)))
+        if d["model"] == 0:
+            assert d["functions"] is None
+        else:
+            assert len(d["functions"]) == len(f.get_components(i))
+
+def test_evaluate():
+    records = list(iter_fityk_text(FIT_SIMPLE, evaluate=True))
+    d = records[0]
+    assert list(d["functions"]["fname"]) == ["BgPol", "Si"]
+    assert {"f0", "f1", "ftot"} <= set(d["data"].columns)
+    assert isinstance(d["model_formula"], str)
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pytest
+from fityk import Fityk
+import pyfityk as pfk
+from pyfityk.shapes import SHAPES
+from pyfityk.support import get_define_functions
+from pyfityk.formula import (compile_define, compile_model, evaluate_models, parse_define,
+    FunctionLibrary, FormulaError)
+
+FIT_SIMPLE = os.path.join(os.path.dirname(__file__), "fit_simple.fit")
+
+def builtin_defines():
+    with open(FIT_SIMPLE) as f:
+        return [line[2:].strip() for line in f if line.startswith("# define ")]
+
+def test_parse_define():
+    name, params, formula = parse_define("define PseudoVoigt(height, center, hwhm, shape=0.5[0:1]) = height*x")
+    assert name == "PseudoVoigt"
+    assert params == ["height", "center", "hwhm", "shape"]
+    assert formula == "height*x"
+
+def test_builtin_defines():
+    # the compiled definitions match the NumPy shapes
+    x = np.linspace(-5, 5, 41)
+    rng = np.random.default_rng(0)
+    compiled = 0
+    for definition in builtin_defines():
+        name = parse_define(definition)[0]
+        try:
+            f = compile_define(definition, FunctionLibrary())
+        except FormulaError:
+            continue # e.g. Voigt, Spline
+        # LogNormal: Fityk (and shapes) set 0 out of the log domain
+        if name not in SHAPES or name == "LogNormal":
+            continue
+        p = rng.uniform(0.2, 0.9, f.n_params)
+        assert np.allclose(f(x, *p), SHAPES[name](x, *p)), name
+        compiled += 1
+    assert compiled > 20
+
+def test_formula_syntax():
+    library = FunctionLibrary({"Step":"Step(a, b) = x < b and not x < -b ? a : -a^2"})
+    x = np.array([-3., 0., 3.])
+    assert np.allclose(library["Step"](x, 2., 1.), [-4., 2., -4.])
+    with pytest.raises(FormulaError):
+        compile_define("Bad(a) = a + y")
+    with pytest.raises(FormulaError):
+        compile_define("Bad(a) = import(a)")
+
+def test_compile_model_broadcast():
+    defines = {"BgLorentz":"BgLorentz(area, center, hwhm) = Lorentzian(area/hwhm/pi, center, hwhm)"}
+    model = compile_model(["Linear", "BgLorentz", "Gaussian"], defines)
+    assert model.n_params == 8
+    x = np.linspace(0, 100, 200)
+    params = np.random.default_rng(1).uniform(1, 50, (30, model.n_params))
+    y = model(x, params)
+    assert y.shape == (30, 200)
+    for i in (0, 17):
+        p = params[i]
+        expected = (SHAPES["Linear"](x, *p[:2]) + SHAPES["LorentzianA"](x, *p[2:5])
+            + SHAPES["Gaussian"](x, *p[5:]))
+        assert np.allclose(y[i], expected)
+    with pytest.raises(ValueError):
+        model(x, params[:, :5])
+
+def test_evaluate_models_fityk():
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    f.execute(f"reset; exec '{FIT_SIMPLE}'")
+    defines = get_define_functions(f)
+    datasets = pfk.read_fityk(f)
+    x = datasets[0]["data"]["x"].to_numpy()
+    same_x = [d for d in datasets if np.array_equal(d["data"]["x"].to_numpy(), x)]
+    y = evaluate_models(x, same_x, defines)
+    for d, yi in zip(same_x, y):
+        if d["functions"] is None or len(d["functions"]) == 0:
+            assert not yi.any()
+        else:
+            assert np.allclose(yi, d["data"]["ftot"].to_numpy(), rtol=1e-6, atol=1e-8)
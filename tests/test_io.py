@@ -0,0 +1,261 @@
+import os
+import numpy as np
+from time import time
+from fityk import Fityk
+import pyfityk as pfk
+from pyfityk.support import get_func_y, get_func_y_pointwise, points_to_arrays
+
+FIT_SIMPLE = os.path.join(os.path.dirname(__file__), "fit_simple.fit")
+
+def get_data_pointwise(session, dataset):
+    """Reference implementation calling Fityk for each point"""
+    data = session.get_data(dataset)
+    xy = np.array([[p.x, p.y, p.is_active] for p in data])
+    funcs = [get_func_y_pointwise(xy[:,0], f) for f in session.get_components(dataset)]
+    return xy, funcs
+
+def test_builtin_functions_parity():
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    x = np.linspace(-10, 30, 801)
+    y = np.ones_like(x)
+    f.load_data(0, x, y, [])
+    models = [
+        "Constant(~2.5)",
+        "Linear(~1, ~-0.3)",
+        "Quadratic(~1, ~0.2, ~0.01)",
+        "Polynomial6(~1, ~0.1, ~0.01, ~1e-3, ~1e-4, ~1e-5, ~1e-6)",
+        "Gaussian(~10, ~5, ~2)",
+        "GaussianA(~10, ~5, ~2)",
+        "SplitGaussian(~10, ~5, ~2, ~4)",
+        "Lorentzian(~10, ~5, ~2)",
+        "LorentzianA(~10, ~5, ~2)",
+        "SplitLorentzian(~10, ~5, ~2, ~4)",
+        "Pearson7(~10, ~5, ~2, ~1.5)",
+        "Pearson7A(~10, ~5, ~2, ~1.5)",
+        "SplitPearson7(~10, ~5, ~2, ~3, ~1.5, ~2.5)",
+        "PseudoVoigt(~10, ~5, ~2, ~0.3)",
+        "PseudoVoigtA(~10, ~5, ~2, ~0.3)",
+        "SplitPseudoVoigt(~10, ~5, ~2, ~3, ~0.3, ~0.6)",
+        "Voigt(~10, ~5, ~2, ~0.2)",
+        "VoigtA(~10, ~5, ~2, ~0.2)",
+        "EMG(~10, ~5, ~2, ~0.5)",
+        "DoniachSunjic(~10, ~0.1, ~1, ~5)",
+        "LogNormal(~10, ~5, ~4, ~0.2)",
+        "ExpDecay(~10, ~20)",
+        "Sigmoid(~1, ~5, ~8, ~2)",
+    ]
+    for m in models:
+        f.execute(f"F += {m}")
+    for func in f.get_components(0):
+        # Fityk evaluates the Voigt profile in single precision
+        np.testing.assert_allclose(get_func_y(x, func), get_func_y_pointwise(x, func), rtol=1e-5, atol=1e-9)
+
+def test_get_data_parity():
+    f = Fityk()
+    f.execute(f"reset; exec '{FIT_SIMPLE}'")
+    for i in range(f.get_dataset_count()):
+        df = pfk.get_data(f, i)
+        xy, funcs = get_data_pointwise(f, i)
+        assert df[["x", "y", "active"]].dtypes.eq(np.float64).all()
+        np.testing.assert_array_equal(df[["x", "y", "active"]].to_numpy(), xy)
+        for n, fy in enumerate(funcs):
+            np.testing.assert_allclose(df[f"f{n}"], fy, rtol=1e-12)
+
+def test_get_data_function_cutoff():
+    from pyfityk.support import get_function_cutoff
+    f = Fityk()
+    f.execute(f"set verbosity = -1; reset; exec '{FIT_SIMPLE}'")
+    assert get_function_cutoff(f) == 0
+    f.execute("set function_cutoff = 0.05")
+    assert get_function_cutoff(f) == 0.05
+    # the curves follow Fityk value_at also when the peaks are cut
+    for i in range(f.get_dataset_count()):
+        df = pfk.get_data(f, i)
+        _, funcs = get_data_pointwise(f, i)
+        for n, fy in enumerate(funcs):
+            np.testing.assert_array_equal(df[f"f{n}"], fy)
+
+def write_jasco_map(filename, n_spectra, n_points=256, seed=0):
+    """Writes a synthetic map in the Jasco text format"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(100, 1000, n_points)
+    side = int(np.ceil(np.sqrt(n_spectra)))
+    xmap = [f"{-100 + 1.5*(i % side):g}" for i in range(n_spectra)]
+    ymap = [f"{-200 + 1.5*(i // side):g}" for i in range(n_spectra)]
+    spectra = 100 + 50*np.exp(-((x - rng.uniform(300, 800, (n_spectra, 1)))/20)**2) + rng.normal(0, 1, (n_spectra, n_points))
+    with open(filename, "w") as f:
+        for i in range(13):
+            f.write(f"HEADER{i}\t\n")
+        f.write("\t" + "\t".join(xmap) + "\n")
+        f.write("\t" + "\t".join(ymap) + "\n")
+        np.savetxt(f, np.column_stack([x, spectra.T]), delimiter="\t", fmt="%.6f")
+    return x, xmap, ymap, spectra
+
+def test_read_jasco_map(tmp_path):
+    file = str(tmp_path / "map.txt")
+    x, xmap, ymap, spectra = write_jasco_map(file, 20)
+    x2, xmap2, ymap2, spectra2 = pfk.read_jasco_map(file)
+    assert (xmap2, ymap2) == (xmap, ymap)
+    np.testing.assert_allclose(x2, x, atol=1e-6)
+    np.testing.assert_allclose(spectra2, spectra, atol=1e-6)
+
+def test_read_map(tmp_path):
+    file = str(tmp_path / "map.txt")
+    x, xmap, ymap, spectra = write_jasco_map(file, 25)
+    f = pfk.read_map(file, save=False)
+    assert f.get_dataset_count() == 25
+    for i in [0, 24]:
+        assert f.get_info("title", i) == f"{float(xmap[i])}:{float(ymap[i])}"
+        np.testing.assert_allclose(points_to_arrays(f.get_data(i))[:,1], spectra[i], atol=1e-6)
+
+    pfk.read_map(file, split=10, save=True)
+    assert [os.path.isfile(str(tmp_path / f"map_{n}.fit")) for n in (10, 20, 25)] == [True]*3
+
+def test_read_map_scaling(tmp_path):
+    times = []
+    for n in (200, 800):
+        file = str(tmp_path / f"map{n}.txt")
+        write_jasco_map(file, n)
+        t = time()
+        pfk.read_map(file, save=False)
+        times.append(time() - t)
+    print(f"read_map: 200 spectra {times[0]:.3f}s, 800 spectra {times[1]:.3f}s")
+    # linear scaling is 4x, the previous implementation was 16x
+    assert times[1] < 8*times[0]
+
+def test_open_map_cache(tmp_path):
+    file = str(tmp_path / "map.txt")
+    x, xmap, ymap, spectra = write_jasco_map(file, 12)
+    m = pfk.open_map(file)
+    assert isinstance(m["spectra"], np.memmap)
+    assert m["coords"] == list(zip(xmap, ymap))
+    np.testing.assert_allclose(m["spectra"][5], spectra[5], atol=1e-6)
+    mtime = os.path.getmtime(os.path.join(file + ".npmap", "spectra.npy"))
+
+    # reused while the source is unchanged
+    pfk.open_map(file)
+    assert os.path.getmtime(os.path.join(file + ".npmap", "spectra.npy")) == mtime
+
+    # converted again when the source changes
+    x, xmap, ymap, spectra = write_jasco_map(file, 15, seed=1)
+    m = pfk.open_map(file)
+    assert m["spectra"].shape == (15, len(x))
+    np.testing.assert_allclose(m["spectra"][14], spectra[14], atol=1e-6)
+
+def convert_peaks_legacy(peaks):
+    """Previous implementation of convert_peaks (re.split per line)"""
+    import re
+    import pandas as pd
+    errors = "+/-" in peaks
+    peaks = peaks.strip().replace("+/-","").replace("?","0")
+    peaks = pd.DataFrame([re.split(r"\s+",s)for s in peaks.split("\n")[1:]], dtype=object)
+    peaks = peaks.replace("x",None)
+    peaks.loc[:,2:] = peaks.loc[:,2:].astype(float)
+    if(errors):
+        pars_cols = [f"a{int(i/2)}" if (not i%2) else f"err_a{int(i/2)}" for i in range(len(peaks.columns)-6)]
+    else:
+        pars_cols = [f"a{i}" for i in range(len(peaks.columns)-6)]
+    peaks.columns = ["fid", "fname", "Center", "Height", "Area", "FWHM"] + pars_cols
+    return peaks
+
+PEAKS_ERR = """# PeakType\tCenter\tHeight\tArea\tFWHM\tparameters...
+%_1  Constant  x  x  x  x  12.5 +/- ?
+%_2  Gaussian  520.1  3000  1.5e4  4.2  3000 +/- 12  520.1 +/- 0.01  2.1 +/- 0.03
+%_3  Linear  x  x  x  x  1.5 +/- 0.1  -2e-3 +/- 1e-4
+"""
+
+def test_convert_peaks_parity():
+    for text in [PEAKS_ERR, PEAKS_ERR.replace(" +/- ?", "").replace(" +/- ", " ").replace("  0.01", "")]:
+        new, old = pfk.convert_peaks(text), convert_peaks_legacy(text)
+        assert list(new.columns) == list(old.columns)
+        assert list(new["fid"]) == list(old["fid"])
+        np.testing.assert_array_equal(new.iloc[:,2:].to_numpy(float), old.iloc[:,2:].to_numpy(float))
+        assert all(new[c].dtype == float for c in new.columns[2:])
+
+def test_peaks_table_long(monkeypatch):
+    import pyfityk.support
+    from pyfityk.support import clean_peaks, peaks_table
+    header, body = PEAKS_ERR.split("\n", 1)
+    long_text = header + "\n" + body*40
+    # long map exports are parsed by pandas, the result is the same of NumPy
+    for text in [long_text, long_text.replace(" +/- ?", "").replace(" +/- ", " ")]:
+        lines = clean_peaks(text)
+        assert len(lines) >= pyfityk.support.PEAKS_CSV_LINES
+        errors = "+/-" in text
+        indexed = [f"{i} {line}" for i, line in enumerate(lines)]
+        long, long_indexed = peaks_table(lines, errors), peaks_table(indexed, errors, indexed=True)
+        with monkeypatch.context() as m:
+            m.setattr(pyfityk.support, "PEAKS_CSV_LINES", len(lines) + 1)
+            short, short_indexed = peaks_table(lines, errors), peaks_table(indexed, errors, indexed=True)
+        for a, b in [(long, short), (long_indexed, short_indexed)]:
+            assert list(a.columns) == list(b.columns)
+            assert (a["fid"] == b["fid"]).all() and (a["fname"] == b["fname"]).all()
+            np.testing.assert_array_equal(a.loc[:, "Center":].to_numpy(float), b.loc[:, "Center":].to_numpy(float))
+            assert all(a[c].dtype == float for c in a.loc[:, "Center":].columns)
+        np.testing.assert_array_equal(long_indexed["index"], np.arange(len(lines)))
+        # 'x' is NaN and '?' is 0
+        assert np.isnan(long["Center"].iloc[0])
+        if errors:
+            assert long["err_a0"].iloc[0] == 0
+        np.testing.assert_array_equal(long.iloc[:,2:].to_numpy(float), convert_peaks_legacy(text).iloc[:,2:].to_numpy(float))
+
+def test_read_peaks_dir(tmp_path):
+    for i in range(20):
+        (tmp_path / f"{i}.0:-{i}.5.peaks").write_text(PEAKS_ERR)
+    (tmp_path / "other.txt").write_text("not a peaks file")
+    df = pfk.read_peaks_dir(str(tmp_path), workers=4)
+    assert len(df) == 60
+    assert set(df["title"]) == {f"{i}.0:-{i}.5" for i in range(20)}
+    one = df[df["title"] == "3.0:-3.5"].drop(columns=["source", "title"]).reset_index(drop=True)
+    pd_testing = __import__("pandas").testing
+    pd_testing.assert_frame_equal(one, pfk.convert_peaks(PEAKS_ERR), check_dtype=False)
+
+def test_export_bundle(tmp_path):
+    from pyfityk.table import read_table
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    f.execute(f"exec '{FIT_SIMPLE}'")
+    filename = str(tmp_path / "bundle.npz")
+    rows = pfk.export_bundle(f, filename, errors=True, batch_size=100)
+    data, peaks = read_table(filename, "data"), read_table(filename, "peaks")
+    assert rows == dict(data=len(data), peaks=len(peaks))
+    for i in range(f.get_dataset_count()):
+        expected = pfk.get_data(f, i)
+        df = data[data["dataset"] == i]
+        assert (df["title"] == f.get_info("title", i)).all()
+        np.testing.assert_allclose(df[expected.columns].to_numpy(float), expected.to_numpy(float))
+        if f.get_components(i):
+            expected = pfk.convert_peaks(f.get_info("peaks_err", i))
+            df = peaks[peaks["dataset"] == i]
+            assert list(df["fname"]) == list(expected["fname"])
+            np.testing.assert_allclose(df["Center"].to_numpy(float), expected["Center"].to_numpy(float))
+
+def test_read_fityk_lazy():
+    eager = pfk.read_fityk(FIT_SIMPLE)
+    view = pfk.read_fityk(FIT_SIMPLE, lazy=True, cache_size=2)
+    assert len(view) == len(eager)
+    for d, e in zip(view, eager):
+        assert d["title"] == e["title"]
+        assert d["model_formula"] == e["model_formula"]
+        np.testing.assert_array_equal(d["data"].to_numpy(), e["data"].to_numpy())
+    assert len(view._cache) == 2
+    assert view[-1].title == eager[-1]["title"]
+    assert view[eager[0]["title"]].index == 0
+    assert [d.index for d in view[:2]] == [0, 1]
+
+def test_lazy_dataset_title_only():
+    from pyfityk.io import SessionView, LazyDataset
+    from pyfityk.report import FitReport, CountingSession
+    f = Fityk()
+    f.execute(f"set verbosity = -1; reset; exec '{FIT_SIMPLE}'")
+    report = FitReport()
+    view = SessionView(CountingSession(f, report))
+    d = view[0]
+    assert d.title == f.get_info("title", 0)
+    # equality does not evaluate the values
+    assert d == LazyDataset(view.session, 0) and d != view[1]
+    assert len({d, LazyDataset(view.session, 0), view[1]}) == 2
+    assert "fityk_get_data" not in report.counters
+    assert "fityk_get_components" not in report.counters
+    assert repr(d) == "LazyDataset(@0, evaluated=['title'])"
@@ -0,0 +1,431 @@
+import os
+import tracemalloc
+from time import time
+import numpy as np
+import pandas as pd
+import pytest
+from fityk import Fityk
+from scipy.stats import pearsonr
+from scipy.signal import savgol_filter
+from pyfityk.io import read_fityk, read_fityk_text
+from pyfityk.fitfile import _parse_variable
+from pyfityk.formula import split_args
+from pyfityk.mapping import match_template, pearson_match, preprocess_spectra, map_order, fitMap, fitSpectrum, compile_template, init_session, edit_filename, journal_folder
+
+def synthetic_spectra(n_spectra, n_templates=8, n_points=512, noise=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, n_points)
+    centers = rng.uniform(0.1, 0.9, n_templates)
+    templates = np.exp(-((x - centers[:, None])/0.05)**2) + rng.uniform(0, 1, (n_templates, 1))
+    ids = rng.integers(0, n_templates, n_spectra)
+    spectra = templates[ids] * rng.uniform(0.5, 2, (n_spectra, 1)) + rng.normal(0, noise, (n_spectra, n_points))
+    return spectra, templates, ids
+
+def test_pearson_match_parity():
+    spectra, templates, _ = synthetic_spectra(500, noise=2)
+    reference = np.array([np.argmin([1 - pearsonr(y, ref)[0] for ref in templates]) for y in spectra])
+    np.testing.assert_array_equal(pearson_match(spectra, templates), reference)
+    np.testing.assert_array_equal(pearson_match(spectra, templates, chunk_size=37), reference)
+    np.testing.assert_array_equal(match_template(spectra, templates, normalize=False, smooth=False, baseline=False), reference)
+
+def test_pearson_match_float32():
+    spectra, templates, ids = synthetic_spectra(2000, noise=0.1)
+    np.testing.assert_array_equal(pearson_match(spectra, templates, dtype=np.float32), ids)
+
+def test_match_template_memmap(tmp_path):
+    spectra, templates, _ = synthetic_spectra(4000, n_points=1024)
+    np.save(tmp_path / "spectra.npy", spectra)
+    memmap = np.load(tmp_path / "spectra.npy", mmap_mode="r")
+    for metric in ("pearsonr", "euclidean"):
+        reference = match_template(spectra, templates, metric=metric, chunk_size=len(spectra))
+        tracemalloc.start()
+        ids = match_template(memmap, templates, metric=metric, chunk_size=256)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        np.testing.assert_array_equal(ids, reference)
+        # preprocessed in chunks, the map is not copied to RAM
+        assert peak < 0.25*spectra.nbytes
+
+def preprocess_legacy(data, win=50):
+    """Previous preprocessing of match_template"""
+    data = np.array([s-s.min()for s in data])
+    data = savgol_filter(data, window_length=win, polyorder=2, mode='interp')
+    return np.array([s/s.max()for s in data])
+
+def test_preprocess_parity():
+    spectra, _, _ = synthetic_spectra(300)
+    np.testing.assert_allclose(preprocess_spectra(spectra), preprocess_legacy(spectra))
+    np.testing.assert_allclose(preprocess_spectra(spectra, window=21, polyorder=3, chunk_size=7), preprocess_spectra(spectra, window=21, polyorder=3))
+    inplace = spectra.copy()
+    assert preprocess_spectra(inplace, copy=False) is inplace
+
+def test_preprocess_memory_benchmark():
+    spectra, _, _ = synthetic_spectra(4000, n_points=1024)
+    size = spectra.nbytes
+
+    tracemalloc.start()
+    preprocess_legacy(spectra)
+    _, peak_legacy = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    preprocess_spectra(spectra, chunk_size=256)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"peak memory / input size: legacy {peak_legacy/size:.2f}, in place {peak/size:.2f}")
+    assert peak < 1.5*size
+    assert peak < peak_legacy
+
+def test_map_order():
+    coords = [(str(x), str(y)) for y in range(4) for x in range(3)]
+    np.testing.assert_array_equal(map_order(coords), np.arange(12))
+    np.testing.assert_array_equal(map_order(coords, "serpentine"), [0, 1, 2, 5, 4, 3, 6, 7, 8, 11, 10, 9])
+    coords = [(str(x), str(y)) for y in range(8) for x in range(8)]
+    for order in ("serpentine", "hilbert"):
+        rows = map_order(coords, order)
+        assert sorted(rows) == list(range(64))
+        xy = np.array(coords, dtype=float)[rows]
+        # consecutive spectra are neighbours
+        assert np.abs(np.diff(xy, axis=0)).sum(axis=1).max() == 1
+
+def write_template(filename, x, templates):
+    """Writes a Fityk template file with a Gaussian peak model for each template spectrum"""
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    for i, y in enumerate(templates):
+        if i != 0: f.execute("@+ = 0")
+        f.load_data(i, x, y, [], f"template{i}")
+        center = x[np.argmax(y)]
+        f.execute(f"@{i}: F = Constant(~{y.min()}) + Gaussian(~{y.max()-y.min()}, ~{center}, ~0.05)")
+    f.execute(f"info state > '{filename}'")
+
+def synthetic_map(n_spectra, n_templates=3, n_points=256):
+    spectra, templates, _ = synthetic_spectra(n_spectra, n_templates, n_points, noise=0.02)
+    x = np.linspace(0, 1, n_points)
+    side = int(np.ceil(np.sqrt(n_spectra)))
+    columns = pd.MultiIndex.from_tuples([(str(i % side), str(i // side)) for i in range(n_spectra)])
+    return x, templates, pd.DataFrame(spectra.T, columns=columns)
+
+def warm_start_fit(tmp_path, seed, seed_wssr=None, model=None):
+    """Fits the first spectrum of a synthetic map starting from its template
+    (or **model**) and **seed**"""
+    x, templates, ys = synthetic_map(4)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+    compiled = compile_template(template)
+    y = ys.iloc[:, 0].to_numpy()
+    templ_id = match_template(y[None], compiled["template_y"], normalize=False, smooth=False, baseline=False)[0]
+    match = compiled["template"][templ_id]
+    if model is not None:
+        match = dict(match, model=model)
+    session, buffer_session = Fityk(), Fityk()
+    for f in (session, buffer_session):
+        init_session(f, compiled["initials"])
+    session.load_data(0, x, y, [], "spectrum")
+    stats = {}
+    funcs = fitSpectrum(session, buffer_session, x, y, match, 0, seed=seed, stats=stats, seed_wssr=seed_wssr)
+    return funcs, stats, buffer_session.get_wssr(0)
+
+def gaussian_params(funcs):
+    """Values of the Gaussian parameters of fitted functions"""
+    gaussian = [f for f in funcs.values() if f.startswith("Gaussian")][0]
+    return [_parse_variable(p)[0] for p in split_args(gaussian[gaussian.index("(")+1:-1])]
+
+def test_fitspectrum_warm_start(tmp_path):
+    cold, stats, wssr = warm_start_fit(tmp_path, None)
+    assert stats["warm_starts"] == 0
+
+    # a seed far from the spectrum is discarded, the template result is kept
+    bad = {"%_1": "Constant(~0)", "%_2": "Gaussian(~50, ~0.99, ~0.001)"}
+    funcs, stats, _ = warm_start_fit(tmp_path, bad)
+    assert stats["warm_starts"] == 0
+    assert funcs == cold
+
+    # the result of the same spectrum is a good seed and is used
+    funcs, stats, wssr_warm = warm_start_fit(tmp_path, cold, wssr)
+    assert stats["warm_starts"] == 1
+    assert stats.get("fallback_fits", 0) == 0
+    assert wssr_warm <= wssr*(1 + 1e-6)
+
+def test_fitspectrum_warm_start_fallback(tmp_path):
+    cold, _, wssr = warm_start_fit(tmp_path, None)
+    height, center, hwhm = gaussian_params(cold)
+    # the seed starts closer than the template but its center is fixed
+    # half a width off, so the warm fit stops far above the seed WSSR
+    constant = [f for f in cold.values() if f.startswith("Constant")][0]
+    stuck = {"%_1": constant, "%_2": f"Gaussian(~{height}, {center + hwhm/2}, ~{hwhm})"}
+    model = f"Constant(~0) + Gaussian(~{3*height}, ~{center + hwhm/2}, ~{hwhm})"
+    funcs, stats, wssr_fallback = warm_start_fit(tmp_path, stuck, wssr, model)
+    assert stats["warm_starts"] == 1
+    assert stats["fallback_fits"] == 1
+    assert stats["fallbacks"] == 1
+    np.testing.assert_allclose(wssr_fallback, wssr, rtol=1e-3)
+    np.testing.assert_allclose(gaussian_params(funcs), [height, center, hwhm], rtol=1e-3)
+
+    # without the seed WSSR the warm result is kept
+    _, stats, wssr_warm = warm_start_fit(tmp_path, stuck, None, model)
+    assert stats.get("fallback_fits", 0) == 0
+    assert wssr_warm > 2*wssr
+
+def session_results(filename):
+    """Titles, functions and WSSR of each dataset of a Fityk file"""
+    f = Fityk()
+    f.execute(f"set verbosity = -1; reset; exec '{filename}'")
+    return [(d["title"], d["functions"], f.get_wssr(i)) for i, d in enumerate(read_fityk(f))]
+
+def test_fitmap_workers_parity(tmp_path):
+    x, templates, ys = synthetic_map(13)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    for split in (0, 5):
+        serial = str(tmp_path / f"serial_{split}.fit")
+        parallel = str(tmp_path / f"parallel_{split}.fit")
+        fitMap(x, ys, template, fileout=serial, split=split)
+        # without split the output is assembled from the records of the workers
+        fitMap(x, ys, template, fileout=parallel, split=split, workers=3)
+        stops = (5, 10, 13) if split else (None,)
+        for n in stops:
+            fserial, fparallel = (f if n is None else edit_filename(f, n) for f in (serial, parallel))
+            expected, result = session_results(fserial), session_results(fparallel)
+            assert len(expected) == len(result) > 0
+            for (title_a, funcs_a, wssr_a), (title_b, funcs_b, wssr_b) in zip(expected, result):
+                assert title_a == title_b
+                pd.testing.assert_frame_equal(funcs_a, funcs_b)
+                np.testing.assert_allclose(wssr_b, wssr_a, rtol=1e-9)
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(monkeypatch, n):
+    """Makes fitMap fail when fitting the spectrum n+1, as a killed run"""
+    import pyfityk.mapping
+    fit_spectrum = pyfityk.mapping.fitSpectrum
+    calls = []
+    def fit(*args, **kwargs):
+        calls.append(1)
+        if len(calls) > n:
+            raise Interrupted()
+        return fit_spectrum(*args, **kwargs)
+    monkeypatch.setattr(pyfityk.mapping, "fitSpectrum", fit)
+
+def test_fitmap_resume(tmp_path, monkeypatch):
+    x, templates, ys = synthetic_map(25)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    out = str(tmp_path / "reference.fit")
+    fitMap(x, ys, template, fileout=out, split=10)
+    reference = [d["functions"] for n in (10, 20, 25) for d in read_fityk_text(edit_filename(out, n))]
+    # the journal of a completed run is removed
+    assert not os.path.exists(journal_folder(out))
+
+    # run killed while fitting the last split file
+    out = str(tmp_path / "map.fit")
+    with monkeypatch.context() as m:
+        interrupt_after(m, 22)
+        with pytest.raises(Interrupted):
+            fitMap(x, ys, template, fileout=out, split=10)
+    assert not os.path.exists(edit_filename(out, 25))
+    assert os.path.isdir(journal_folder(out))
+    mtime = os.path.getmtime(edit_filename(out, 10))
+
+    report = fitMap(x, ys, template, fileout=out, split=10, resume=True)
+    assert report.counters["fits"] == 3
+    assert os.path.getmtime(edit_filename(out, 10)) == mtime
+    resumed = [d["functions"] for n in (10, 20, 25) for d in read_fityk_text(edit_filename(out, n))]
+    for a, b in zip(reference, resumed):
+        pd.testing.assert_frame_equal(a, b)
+    assert not os.path.exists(journal_folder(out))
+
+def test_fitmap_table(tmp_path):
+    from pyfityk.table import read_table
+    x, templates, ys = synthetic_map(12)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    out = str(tmp_path / "map.fit")
+    table_out = str(tmp_path / "params.npz")
+    fitMap(x, ys, template, fileout=out, table_out=table_out, table_batch=5)
+    table = read_table(table_out)
+    fitted = read_fityk_text(out)
+    assert len(table) == sum(len(d["functions"]) for d in fitted)
+    assert list(table["title"].unique()) == [d["title"] for d in fitted]
+    for d in fitted:
+        rows = table[table["title"] == d["title"]]
+        np.testing.assert_allclose(rows["Center"], d["functions"]["Center"].astype(float), rtol=1e-5)
+    assert (table["x"] == [float(t.split(";")[0]) for t in table["title"]]).all()
+
+    # the parallel execution writes a part per shard
+    fitMap(x, ys, template, table_out=table_out, workers=2)
+    parallel = read_table(table_out)
+    np.testing.assert_allclose(parallel["a0"], table["a0"], rtol=1e-5)
+
+def test_fitmap_fit_cache(tmp_path, capsys):
+    x, templates, ys = synthetic_map(9)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+    cache = str(tmp_path / "cache")
+
+    out = str(tmp_path / "map.fit")
+    fitMap(x, ys, template, fileout=out, fit_cache=cache)
+    assert "hits: 0, misses: 9" in capsys.readouterr().out
+    reference = read_fityk_text(out)
+
+    # the verbosity is not part of the key
+    fitMap(x, ys, template, fileout=out, fit_cache=cache, verbosity=0)
+    assert "hits: 9, misses: 0" in capsys.readouterr().out
+    for a, b in zip(reference, read_fityk_text(out)):
+        pd.testing.assert_frame_equal(a["functions"], b["functions"])
+
+    # a changed spectrum is fitted again
+    ys.iloc[:,0] *= 2
+    fitMap(x, ys, template, fileout=out, fit_cache=cache)
+    assert "hits: 8, misses: 1" in capsys.readouterr().out
+
+def test_fitmap_report(tmp_path):
+    x, templates, ys = synthetic_map(6)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+    report_out = str(tmp_path / "report.prom")
+    report = fitMap(x, ys, template, fileout=str(tmp_path / "map.fit"), report_out=report_out)
+    assert report.spectra == 6
+    assert report.counters["fits"] == 6
+    assert report.counters["fityk_execute"] > 0
+    for name in ["match", "load_data", "fit", "read_functions", "transfer", "save"]:
+        assert name in report.stages
+    assert len(report.slowest) == 6
+    assert "pyfityk_spectra_total 6" in open(report_out).read()
+
+def test_coarse_fit():
+    from pyfityk.mapping import fitSpectrum, bin_spectrum
+    from pyfityk.support import get_func_params
+    rng = np.random.default_rng(1)
+    x = np.linspace(0, 100, 4096)
+    _, yb, ab = bin_spectrum(x, x, np.arange(4096) % 100 != 0, 8)
+    assert len(yb) == 512 and yb[0] == x[:8].mean() and not ab[0] and ab[1]
+
+    centers = rng.uniform(30, 70, 10)
+    ys = 5 + 100*np.exp(-np.log(2)*((x - centers[:, None])/3)**2) + rng.normal(0, 0.5, (len(centers), x.size))
+    template = dict(model="Constant(~5) + Gaussian(~80, ~50, ~8)", data=pd.DataFrame(dict(active=np.ones(4096, dtype=bool))))
+    params, times = {}, {}
+    for coarse in (1, 8):
+        session, buffer_session = Fityk(), Fityk()
+        for f in (session, buffer_session):
+            f.execute("set verbosity = -1")
+        t = time()
+        for i, y in enumerate(ys):
+            if i: session.execute("@+ = 0")
+            session.load_data(i, x, y, [])
+            fitSpectrum(session, buffer_session, x, y, template, i, coarse=coarse)
+        times[coarse] = time() - t
+        params[coarse] = np.array([get_func_params(f) for i in range(len(centers)) for f in session.get_components(i)][1::2])
+    print(f"direct: {times[1]:.3f} s, coarse: {times[8]:.3f} s")
+    np.testing.assert_allclose(params[8][:,1], centers, atol=0.05)
+    np.testing.assert_allclose(params[8], params[1], rtol=1e-4)
+
+def test_fitmap_numpy_backend(tmp_path):
+    x, templates, ys = synthetic_map(12)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    out = str(tmp_path / "fityk.fit")
+    fitMap(x, ys, template, fileout=out)
+    reference = read_fityk_text(out)
+    wssr_reference = [wssr for _, _, wssr in session_results(out)]
+    out = str(tmp_path / "numpy.fit")
+    report = fitMap(x, ys, template, fileout=out, backend="numpy")
+    assert report.counters["batch_fits"] == 12
+    assert report.counters.get("fits", 0) == 0
+    for a, b, wssr_a, (_, _, wssr_b) in zip(reference, read_fityk_text(out), wssr_reference, session_results(out)):
+        assert a["title"] == b["title"]
+        # every fitted parameter and the final WSSR match the Fityk fit
+        columns = [c for c in a["functions"].columns if c.startswith("a")]
+        assert columns == [c for c in b["functions"].columns if c.startswith("a")]
+        np.testing.assert_allclose(b["functions"][columns].astype(float), a["functions"][columns].astype(float), rtol=1e-3, atol=1e-4)
+        np.testing.assert_allclose(wssr_b, wssr_a, rtol=1e-4)
+
+    # not supported functions are fitted by Fityk
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    f.execute(f"exec '{template}'")
+    f.execute("@0: F = SplitGaussian(~1, ~0.5, ~0.05, ~0.05)")
+    f.execute(f"info state > '{template}'")
+    report = fitMap(x, ys, template, backend="numpy")
+    assert report.counters.get("fits", 0) + report.counters["batch_fits"] == 12
+    assert report.counters.get("fits", 0) > 0
+
+def test_fitmap_background_save(tmp_path, monkeypatch):
+    from pyfityk.mapping import read_journal
+    x, templates, ys = synthetic_map(25)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    out = str(tmp_path / "reference.fit")
+    fitMap(x, ys, template, fileout=out, split=10)
+    reference = [read_fityk_text(edit_filename(out, n)) for n in (10, 20, 25)]
+
+    out = str(tmp_path / "map.fit")
+    report = fitMap(x, ys, template, fileout=out, split=10, background_save=True)
+    assert report.stages["save_background"][0] == 3
+    assert "save" not in report.stages
+    for n, expected in zip((10, 20, 25), reference):
+        saved = read_fityk_text(edit_filename(out, n))
+        assert [d["title"] for d in saved] == [d["title"] for d in expected]
+        for a, b in zip(expected, saved):
+            pd.testing.assert_frame_equal(a["functions"], b["functions"])
+            pd.testing.assert_frame_equal(a["data"], b["data"])
+    assert not os.path.exists(journal_folder(out))
+
+    # the chunks handed to the writer before a failure are saved and journaled
+    out = str(tmp_path / "killed.fit")
+    with monkeypatch.context() as m:
+        interrupt_after(m, 22)
+        with pytest.raises(Interrupted):
+            fitMap(x, ys, template, fileout=out, split=10, background_save=True)
+    done, saved = read_journal(out)
+    assert len(done) == 22
+    assert saved == {edit_filename(out, n) for n in (10, 20)}
+
+def test_iter_spectra_blocks(tmp_path):
+    from pyfityk.mapping import iter_spectra_blocks
+    y = np.arange(40.).reshape(10, 4)
+    coords = [(str(i % 4), str(i // 4)) for i in range(10)]
+    df = pd.DataFrame(y.T, columns=pd.MultiIndex.from_tuples(coords))
+    np.save(tmp_path / "spectra.npy", y)
+    memmap = np.load(tmp_path / "spectra.npy", mmap_mode="r")
+    generator = ((coords[a:a+3], y[a:a+3]) for a in range(0, 10, 3))
+    for spectra in (df, dict(spectra=memmap, coords=coords), generator):
+        blocks = list(iter_spectra_blocks(spectra, 4))
+        assert [b[0] for b in blocks] == [0, 4, 8]
+        assert [c for b in blocks for c in b[1]] == coords
+        np.testing.assert_array_equal(np.concatenate([b[2] for b in blocks]), y)
+    # traversal order on indexable inputs
+    order = map_order(coords, "serpentine")
+    blocks = list(iter_spectra_blocks(dict(spectra=memmap, coords=coords), 3, "serpentine"))
+    np.testing.assert_array_equal(np.concatenate([b[2] for b in blocks]), y[order])
+
+def test_fitmap_chunked(tmp_path):
+    from pyfityk.table import read_table
+    x, templates, ys = synthetic_map(23)
+    template = str(tmp_path / "template.fit")
+    write_template(template, x, templates)
+
+    out = str(tmp_path / "reference.fit")
+    fitMap(x, ys, template, fileout=out, split=5)
+    files = [edit_filename(out, n) for n in (5, 10, 15, 20, 23)]
+    reference = [d for f in files for d in read_fityk_text(f)]
+
+    # chunk_size is rounded to a multiple of split
+    blocks = (ys.iloc[:, a:a+7] for a in range(0, 23, 7))
+    for name, spectra, workers in [("frame", ys, 1), ("blocks", blocks, 1), ("parallel", ys, 2)]:
+        out = str(tmp_path / f"{name}.fit")
+        table_out = str(tmp_path / f"{name}.npz")
+        report = fitMap(x, spectra, template, fileout=out, split=5, chunk_size=8, workers=workers, table_out=table_out)
+        assert report.spectra == 23
+        chunked = [d for n in (5, 10, 15, 20, 23) for d in read_fityk_text(edit_filename(out, n))]
+        assert [d["title"] for d in chunked] == [d["title"] for d in reference]
+        for a, b in zip(reference, chunked):
+            pd.testing.assert_frame_equal(a["functions"], b["functions"])
+        assert read_table(table_out)["spectrum"].nunique() == 23
@@ -0,0 +1,47 @@
+import json
+from pyfityk.report import FitReport, CountingSession, Progress
+
+class Session:
+    def execute(self, s):
+        return s
+    def get_info(self, s, n):
+        return s
+
+def test_report_merge(tmp_path):
+    a, b = FitReport(n_slowest=2), FitReport(n_slowest=2)
+    for report, times in [(a, [0.1, 0.5]), (b, [0.3, 0.2])]:
+        with report.stage("fit"):
+            pass
+        report.count("fits", len(times))
+        for i, t in enumerate(times):
+            report.spectrum(i, f"s{t}", t)
+    a.merge(b)
+    a.wall_time = 2.
+    assert a.spectra == 4
+    assert a.stages["fit"][0] == 2
+    assert a.counters["fits"] == 4
+    assert a.spectra_per_second == 2.
+    assert [s["title"] for s in a.to_dict()["slowest"]] == ["s0.5", "s0.3"]
+
+    a.write(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as f:
+        assert json.load(f)["spectra"] == 4
+    a.write(str(tmp_path / "report.prom"))
+    text = (tmp_path / "report.prom").read_text()
+    assert 'pyfityk_stage_calls_total{stage="fit"} 2' in text
+    assert 'pyfityk_events_total{name="fits"} 4' in text
+
+def test_counting_session():
+    report = FitReport()
+    session = CountingSession(Session(), report)
+    for i in range(3):
+        session.execute("x")
+    assert session.get_info("y", 0) == "y"
+    assert report.counters == {"fityk_execute":3, "fityk_get_info":1}
+
+def test_progress_rate_limit(capsys):
+    progress = Progress(1000, interval=60)
+    for i in range(1000):
+        progress.update(i+1)
+    progress.update(1000, force=True)
+    assert len(capsys.readouterr().out.splitlines()) == 1
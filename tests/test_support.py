@@ -0,0 +1,62 @@
+import numpy as np
+from time import time
+from fityk import Fityk
+from pyfityk.support import deactivate_points, compile_active_mask, points_to_arrays, read_functions, format_functions, get_func_params
+from pyfityk.report import FitReport, CountingSession
+
+def deactivate_points_pointwise(session, active, dataset):
+    """Previous implementation: one execute per point"""
+    for i,val in enumerate(active):
+        t = "true" if val else "false"
+        session.execute(f"@{dataset}:A[{i}]={t}")
+
+def new_session(n):
+    f = Fityk()
+    f.execute("set verbosity = -1")
+    x = np.linspace(0, 1, n)
+    f.load_data(0, x, np.ones(n), [])
+    return f
+
+def test_compile_active_mask():
+    assert compile_active_mask([True]*4) == "A = true"
+    assert compile_active_mask([False]*4) == "A = false"
+    assert compile_active_mask([1, 0, 0, 1, 1, 0, 1]) == "A = not ((n>=1 and n<3) or n==5)"
+    assert compile_active_mask([0, 1, 1, 1, 0, 0]) == "A = (n>=1 and n<4)"
+
+def test_deactivate_points_benchmark():
+    n = 1024
+    rng = np.random.default_rng(0)
+    masks = [np.ones(n, bool), rng.random(n) > 0.02, np.r_[np.zeros(100, bool), np.ones(n-200, bool), np.zeros(100, bool)]]
+    for active in masks:
+        report_old, report_new = FitReport(), FitReport()
+        old, new = CountingSession(new_session(n), report_old), CountingSession(new_session(n), report_new)
+        t_old = time()
+        deactivate_points_pointwise(old, active, 0)
+        t_old = time() - t_old
+        t_new = time()
+        deactivate_points(new, active, 0)
+        t_new = time() - t_new
+        calls_old, calls_new = report_old.counters["fityk_execute"], report_new.counters["fityk_execute"]
+        print(f"execute calls: {calls_old} -> {calls_new}, time: {t_old:.4f}s -> {t_new:.4f}s")
+
+        assert calls_new == 1
+        assert calls_old == n
+        np.testing.assert_array_equal(points_to_arrays(new.get_data(0))[:,2], active)
+        np.testing.assert_array_equal(points_to_arrays(old.get_data(0))[:,2], active)
+
+def test_format_functions():
+    f = new_session(200)
+    f.execute("$c = 0.25")
+    f.execute("@0: F = Gaussian(~1.123456789012345, ~0.5, ~0.1) + Constant($c) + Linear(~0.1 [0:1], ~2)")
+    funcs = format_functions(f, 0)
+    assert list(funcs) == list(read_functions(f, 0))
+    assert funcs["%_1"].startswith("Gaussian(~1.123456789012345,")
+    assert "[0:1]" in funcs["%_3"]
+    assert funcs["%_2"] == "Constant(0.25)"
+
+    # the functions are copied without loss of precision
+    g = new_session(200)
+    g.execute(f"@0: F = {' + '.join(funcs.values())}")
+    for a, b in zip(f.get_components(0), g.get_components(0)):
+        assert get_func_params(a) == get_func_params(b)
+    assert format_functions(g, 0) == funcs
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pyfityk.table import TableWriter, read_table
+
+def random_table(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(dict(
+        title=[f"{i}:{i*2}" for i in range(n)],
+        fname=rng.choice(["Gaussian", "Constant"], n),
+        Center=rng.normal(size=n),
+        dof=rng.integers(0, 100, n),
+        ))
+
+@pytest.mark.parametrize("ext", [".npz", ".h5", ".parquet"])
+def test_table_roundtrip(tmp_path, ext):
+    if ext == ".h5":
+        pytest.importorskip("tables")
+    if ext == ".parquet":
+        pytest.importorskip("pyarrow")
+    df = random_table(95)
+    filename = str(tmp_path / f"table{ext}")
+    with TableWriter(filename, batch_size=20) as table:
+        for start in range(0, len(df), 7):
+            table.append(df.iloc[start:start+7])
+        table.append(df.iloc[:3], key="other")
+    assert table.rows == len(df) + 3
+    pd.testing.assert_frame_equal(read_table(filename), df, check_dtype=False)
+    pd.testing.assert_frame_equal(read_table(filename, "other"), df.iloc[:3], check_dtype=False)
+
+def test_table_missing_columns(tmp_path):
+    df = random_table(10)
+    filename = str(tmp_path / "table.npz")
+    with TableWriter(filename, columns=list(df.columns) + ["extra"]) as table:
+        table.append(df)
+        with pytest.raises(ValueError):
+            table.append(df.assign(unknown=1))
+    out = read_table(filename)
+    assert out["extra"].isna().all()
+
+def test_table_parts(tmp_path):
+    df = random_table(30)
+    filename = str(tmp_path / "table.npz")
+    for start in (20, 0, 10):
+        with TableWriter(str(tmp_path / f"table_{start}.npz")) as table:
+            table.append(df.iloc[start:start+10])
+    pd.testing.assert_frame_equal(read_table(filename), df, check_dtype=False)
+
+def test_table_hdf5_long_strings(tmp_path):
+    pytest.importorskip("tables")
+    df = random_table(30)
+    # titles of long Jasco coordinates
+    df["title"] = [f"{'%.15f' % (i/7)};{'%.15f' % (-i/3)};" + "x"*150 + f";ID-{i}" for i in range(30)]
+    filename = str(tmp_path / "table.h5")
+    with TableWriter(filename, batch_size=10) as table:
+        table.append(df)
+    pd.testing.assert_frame_equal(read_table(filename), df, check_dtype=False)
+
+    # the column size is fixed by the first batch or by min_itemsize
+    with TableWriter(filename, batch_size=10) as table:
+        table.append(df.iloc[:10].assign(title="short"))
+        with pytest.raises(ValueError):
+            table.append(df.iloc[10:20])
+    with TableWriter(filename, batch_size=10, min_itemsize=dict(title=300)) as table:
+        table.append(df.iloc[:10].assign(title="short"))
+        table.append(df.iloc[10:20])
+    assert list(read_table(filename)["title"][10:]) == list(df["title"][10:20])